@@ -0,0 +1,94 @@
+from common import logger
+from completion_log import read_completion_log
+
+from typing import Optional, Dict, Any, List, Tuple
+import hashlib, json, os
+
+CACHE_MODES = ("record", "replay", "passthrough")
+
+class Cache_Miss(RuntimeError):
+   pass
+
+class Completion_Cache:
+   dirpath: str
+   mode: str
+   max_bytes: int
+   total_bytes: int
+
+   # responses are stored one file per key under <dirpath>/<key[:2]>/<key>.json, least recently used files are evicted past max_bytes
+   def __init__(self, dirpath:str, mode:str="record", max_bytes:int=256*2**20):
+      assert mode in CACHE_MODES, f"unknown cache mode '{mode}', options are {CACHE_MODES}"
+      self.dirpath = dirpath
+      self.mode = mode
+      self.max_bytes = max_bytes
+      os.makedirs(dirpath, exist_ok=True)
+      self.total_bytes = sum(size for _, _, size in self._entries())
+
+   @staticmethod
+   def key(prompt:str, params:Dict[str,Any]) -> str:
+      return hashlib.sha256(json.dumps({ "prompt":prompt, "params":params }, sort_keys=True).encode()).hexdigest()
+
+   def _path(self, key:str) -> str:
+      return os.path.join(self.dirpath, key[:2], f"{key}.json")
+
+   def _entries(self) -> List[Tuple[float,str,int]]:
+      entries = []
+      for root, _, filenames in os.walk(self.dirpath):
+         for filename in filenames:
+            if filename.endswith(".json"):
+               stat = os.stat(os.path.join(root, filename))
+               entries.append((stat.st_mtime, os.path.join(root, filename), stat.st_size))
+      return entries
+
+   def get(self, prompt:str, params:Dict[str,Any]) -> Optional[str]:
+      if self.mode == "passthrough":
+         return None
+      path = self._path(Completion_Cache.key(prompt, params))
+      try:
+         with open(path, "r") as f:
+            response = json.load(f)["response"]
+         os.utime(path)
+         return response
+      except FileNotFoundError:
+         if self.mode == "replay":
+            raise Cache_Miss(f"no cached completion for prompt with key {Completion_Cache.key(prompt, params)}")
+         return None
+      except (ValueError, KeyError) as ex:
+         logger.warning(f"Ignoring unreadable cache entry '{path}': {ex}")
+         if self.mode == "replay":
+            raise Cache_Miss(f"unreadable cached completion '{path}'")
+         return None
+
+   def put(self, prompt:str, params:Dict[str,Any], response:str) -> None:
+      if self.mode == "record":
+         self._write(prompt, params, response)
+
+   # seeds the cache from a completion log (prompts.jsonl or prompts.json) so a logged session can be replayed without the LLM
+   def import_log(self, json_log:str, params:Dict[str,Any]) -> int:
+      count = 0
+      for query in read_completion_log(json_log):
+         self._write("\n".join(query["prompt"]), params, "\n".join(query["response"]))
+         count += 1
+      return count
+
+   def _write(self, prompt:str, params:Dict[str,Any], response:str) -> None:
+      path = self._path(Completion_Cache.key(prompt, params))
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      old_size = os.path.getsize(path) if os.path.exists(path) else 0
+      with open(path + ".tmp", "w") as f:
+         json.dump({ "params":params, "response":response }, f)
+      os.replace(path + ".tmp", path)
+      self.total_bytes += os.path.getsize(path) - old_size
+      if self.total_bytes > self.max_bytes:
+         self.evict()
+
+   def evict(self) -> None:
+      # trim to 90% of the budget so a full cache does not rescan the directory on every put
+      target = self.max_bytes * 0.9
+      entries = sorted(self._entries())
+      self.total_bytes = sum(size for _, _, size in entries)
+      for _, path, size in entries:
+         if self.total_bytes <= target:
+            break
+         os.remove(path)
+         self.total_bytes -= size
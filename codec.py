@@ -0,0 +1,153 @@
+from common import Event
+import events as E
+from game import Game
+
+from typing import List, Dict, Tuple, Iterable, Type, Any, get_type_hints
+from dataclasses import fields
+
+# Binary layout, all integers are unsigned LEB128 varints unless noted:
+#   magic "DBEV", version (u8)
+#   class table:  count, then per class its name and its fields as (name, type code)
+#   string table: count, then per string its utf-8 bytes, length-prefixed
+#   records:      count, then per event a length-prefixed payload of class id and field values
+# str fields are stored as string table ids, bool as a u8, int as a zigzag varint
+
+MAGIC = b"DBEV"
+VERSION = 1
+TYPE_CODES: Dict[Type,int] = { str:0, bool:1, int:2 }
+
+def event_fields(cls:Type[Event]) -> List[Tuple[str,int]]:
+   hints = get_type_hints(cls)
+   return [(f.name, TYPE_CODES[hints[f.name]]) for f in fields(cls)]
+
+def write_varint(out:bytearray, value:int) -> None:
+   while value >= 0x80:
+      out.append((value & 0x7F) | 0x80)
+      value >>= 7
+   out.append(value)
+
+def read_varint(data:bytes, pos:int) -> Tuple[int,int]:
+   value = 0
+   shift = 0
+   while True:
+      byte = data[pos]
+      pos += 1
+      value |= (byte & 0x7F) << shift
+      if byte < 0x80:
+         return value, pos
+      shift += 7
+
+def write_bytes(out:bytearray, value:bytes) -> None:
+   write_varint(out, len(value))
+   out += value
+
+def read_bytes(data:bytes, pos:int) -> Tuple[bytes,int]:
+   length, pos = read_varint(data, pos)
+   return data[pos:pos+length], pos + length
+
+def encode_events(events:Iterable[Event]) -> bytes:
+   class_ids: Dict[Type,int] = {}
+   class_fields: List[List[Tuple[str,int]]] = []
+   string_ids: Dict[str,int] = {}
+   records = bytearray()
+   count = 0
+
+   for event in events:
+      cls = type(event)
+      class_id = class_ids.get(cls, None)
+      if class_id is None:
+         class_id = class_ids[cls] = len(class_ids)
+         class_fields.append(event_fields(cls))
+      payload = bytearray()
+      write_varint(payload, class_id)
+      for name, code in class_fields[class_id]:
+         value = getattr(event, name)
+         if code == 0:
+            string_id = string_ids.get(value, None)
+            if string_id is None:
+               string_id = string_ids[value] = len(string_ids)
+            write_varint(payload, string_id)
+         elif code == 1:
+            payload.append(1 if value else 0)
+         else:
+            write_varint(payload, value << 1 if value >= 0 else ((-value) << 1) - 1)
+      write_bytes(records, payload)
+      count += 1
+
+   out = bytearray(MAGIC)
+   out.append(VERSION)
+   write_varint(out, len(class_ids))
+   for cls, class_id in class_ids.items():
+      write_bytes(out, cls.__name__.encode())
+      write_varint(out, len(class_fields[class_id]))
+      for name, code in class_fields[class_id]:
+         write_bytes(out, name.encode())
+         out.append(code)
+   write_varint(out, len(string_ids))
+   for value in string_ids.keys():
+      write_bytes(out, value.encode())
+   write_varint(out, count)
+   out += records
+   return bytes(out)
+
+def decode_events(data:bytes) -> List[Event]:
+   if data[:len(MAGIC)] != MAGIC:
+      raise ValueError("data does not start with the event codec magic bytes")
+   pos = len(MAGIC)
+   if data[pos] != VERSION:
+      raise ValueError(f"unsupported event codec version {data[pos]}, expected {VERSION}")
+   pos += 1
+
+   classes: List[Tuple[Type[Event],List[int]]] = []
+   class_count, pos = read_varint(data, pos)
+   for _ in range(class_count):
+      name, pos = read_bytes(data, pos)
+      cls = E.event_dictionary.get(name.decode(), None)
+      if cls is None:
+         raise ValueError(f"could not find event with name '{name.decode()}' in dictionary")
+      stored: List[Tuple[str,int]] = []
+      field_count, pos = read_varint(data, pos)
+      for _ in range(field_count):
+         field_name, pos = read_bytes(data, pos)
+         stored.append((field_name.decode(), data[pos]))
+         pos += 1
+      if stored != event_fields(cls):
+         raise ValueError(f"stored fields {stored} do not match the current fields of {cls.__name__}")
+      classes.append((cls, [code for _, code in stored]))
+
+   strings: List[str] = []
+   string_count, pos = read_varint(data, pos)
+   for _ in range(string_count):
+      value, pos = read_bytes(data, pos)
+      strings.append(value.decode())
+
+   events: List[Event] = []
+   record_count, pos = read_varint(data, pos)
+   for _ in range(record_count):
+      length, pos = read_varint(data, pos)
+      end = pos + length
+      class_id, pos = read_varint(data, pos)
+      cls, codes = classes[class_id]
+      values: List[Any] = []
+      for code in codes:
+         if code == 0:
+            string_id, pos = read_varint(data, pos)
+            values.append(strings[string_id])
+         elif code == 1:
+            values.append(data[pos] != 0)
+            pos += 1
+         else:
+            raw, pos = read_varint(data, pos)
+            values.append((raw >> 1) ^ -(raw & 1))
+      if pos != end:
+         raise ValueError(f"record for {cls.__name__} used {length - (end - pos)} bytes, expected {length}")
+      events.append(cls(*values))
+   if pos != len(data):
+      raise ValueError(f"found {len(data) - pos} trailing bytes after the last record")
+   return events
+
+def encode_game(game:Game) -> bytes:
+   return encode_events(game.events)
+
+def decode_game(data:bytes) -> Game:
+   return Game(decode_events(data))
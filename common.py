@@ -22,7 +22,7 @@ class State(Enum):
    TRAP_ENCOUNTER   = "TRAP_ENCOUNTER"
    COMBAT_ENCOUNTER = "COMBAT_ENCOUNTER"
 
-@dataclass
+@dataclass(slots=True)
 class Event:
    def implication(self) -> Optional[State]:
       return None
@@ -32,6 +32,9 @@ class Event:
       return str(self)
    def system(self, current_location_name:str) -> Optional[str]:
       return None
+   # the only town whose overview shows this event's system() line, None when it shows in every overview
+   def overview_town(self) -> Optional[str]:
+      return None
    def clean(self) -> None:
       pass
 
@@ -39,7 +42,9 @@ class Event:
       return text.strip().strip(",.")
    def _fix_name(self, text:str) -> str:
       chunks = self._strip_text(text).split(" ")
-      return " ".join(c[0].upper() + (c[1:].lower() if len(c) >= 2 else "") for c in chunks if len(c) >= 1)
+      return self._intern(" ".join(c[0].upper() + (c[1:].lower() if len(c) >= 2 else "") for c in chunks if len(c) >= 1))
+   def _intern(self, text:str) -> str:
+      return sys.intern(text)
 
 def exc_loc_str() -> str:
    _, _, exc_tb = sys.exc_info()
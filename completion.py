@@ -0,0 +1,306 @@
+from common import logger
+from cache import Completion_Cache, Cache_Miss
+from grammar import Grammar, GRAMMAR_FORMATS
+from completion_log import Completion_Log
+
+from typing import Optional, List, Dict, Any, Coroutine, TypeVar, Callable, Awaitable, Deque
+from collections import deque
+from openai import AsyncOpenAI
+import openai, httpx, asyncio, threading, random, time, os, concurrent.futures
+
+T = TypeVar('T')
+
+DEFAULT_BASE_URL = os.environ.get("LLM_BASE_URL", "http://localhost:1234/v1")
+DEFAULT_MODEL = "lmstudio-community/Meta-Llama-3.1-8B-Instruct-GGUF"
+
+json_log: Optional[Completion_Log] = None
+
+def log_completion(prompt:str, resp:str) -> None:
+   if json_log is not None:
+      json_log.write({
+         "prompt":   prompt.strip().split("\n"),
+         "response": resp  .strip().split("\n"),
+      })
+
+class Completion_Failed(RuntimeError):
+   pass
+class Budget_Exceeded(Completion_Failed):
+   pass
+
+RETRYABLE_ERRORS = (asyncio.TimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+class Deadline:
+   expires_at: float
+
+   def __init__(self, budget:float):
+      self.expires_at = time.monotonic() + budget
+
+   def remaining(self) -> float:
+      return self.expires_at - time.monotonic()
+
+   def expired(self) -> bool:
+      return self.remaining() <= 0
+
+class Completion_Client:
+   base_url: str
+   api_key: str
+   model: str
+   max_connections: int
+   max_concurrency: int
+   timeout: float
+   temperature: float
+   max_tokens: int
+   stop: List[str]
+   cache: Optional[Completion_Cache]
+   grammar_format: Optional[str]
+   retries: int
+   backoff: float
+   backoff_max: float
+   hedge_percentile: Optional[float]
+   hedge_min_samples: int
+   hedged: int
+
+   # the http pool and semaphore are created on first use, a client must only be used from a single event loop
+   # grammar_format is what the backend accepts for constrained decoding, "gbnf" (llama.cpp) or "regex" (vllm), grammars are not sent if None
+   # timeout applies to each attempt, failed attempts are retried with jittered exponential backoff
+   # with hedge_percentile set, a duplicate request is sent once an attempt runs longer than that percentile of recent latencies
+   def __init__(self, base_url:str=DEFAULT_BASE_URL, api_key:str="lm-studio", model:str=DEFAULT_MODEL, max_connections:int=8, max_concurrency:int=8, timeout:float=120.0,
+                temperature:float=0.8, max_tokens:int=256, stop:Optional[List[str]]=None, cache:Optional[Completion_Cache]=None, grammar_format:Optional[str]=None,
+                retries:int=2, backoff:float=0.5, backoff_max:float=8.0, hedge_percentile:Optional[float]=None, hedge_min_samples:int=20):
+      assert grammar_format is None or grammar_format in GRAMMAR_FORMATS, f"grammar_format must be one of {GRAMMAR_FORMATS}, got '{grammar_format}'"
+      self.base_url = base_url
+      self.api_key = api_key
+      self.model = model
+      self.max_connections = max_connections
+      self.max_concurrency = max_concurrency
+      self.timeout = timeout
+      self.temperature = temperature
+      self.max_tokens = max_tokens
+      self.stop = ["</", "<|"] if stop is None else stop
+      self.cache = cache
+      self.grammar_format = grammar_format
+      self.retries = retries
+      self.backoff = backoff
+      self.backoff_max = backoff_max
+      self.hedge_percentile = hedge_percentile
+      self.hedge_min_samples = hedge_min_samples
+      self.hedged = 0
+      self._latencies: Deque[float] = deque(maxlen=200)
+      self._client: Optional[AsyncOpenAI] = None
+      self._semaphore: Optional[asyncio.Semaphore] = None
+
+   def _get_client(self) -> AsyncOpenAI:
+      if self._client is None:
+         http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            timeout=self.timeout,
+         )
+         self._client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, http_client=http_client, max_retries=0)
+         self._semaphore = asyncio.Semaphore(self.max_concurrency)
+      return self._client
+
+   # `variant` separates cache entries for repeated samples of the same prompt (e.g. prompt testing iterations)
+   def sampling_params(self, variant:int=0, grammar:Optional[Grammar]=None) -> Dict[str,Any]:
+      params = { "model":self.model, "temperature":self.temperature, "max_tokens":self.max_tokens, "stop":self.stop, "variant":variant }
+      if (extra_body := self.grammar_body(grammar)) is not None:
+         params.update(extra_body)
+      return params
+
+   def grammar_body(self, grammar:Optional[Grammar]) -> Optional[Dict[str,str]]:
+      if grammar is None or self.grammar_format is None:
+         return None
+      if self.grammar_format == "gbnf":
+         return { "grammar":grammar.gbnf() }
+      return { "guided_regex":grammar.regex }
+
+   def attempt_timeout(self, timeout:Optional[float], deadline:Optional[Deadline]) -> float:
+      timeout = self.timeout if timeout is None else timeout
+      if deadline is not None:
+         remaining = deadline.remaining()
+         if remaining <= 0:
+            raise Budget_Exceeded("Latency budget ran out before the completion could be requested")
+         timeout = min(timeout, remaining)
+      return timeout
+
+   def hedge_delay(self) -> Optional[float]:
+      if self.hedge_percentile is None or len(self._latencies) < self.hedge_min_samples:
+         return None
+      latencies = sorted(self._latencies)
+      return latencies[min(len(latencies) - 1, int(self.hedge_percentile * len(latencies)))]
+
+   async def _with_retries(self, attempt:Callable[[float],Awaitable[str]], timeout:Optional[float], deadline:Optional[Deadline]) -> str:
+      error: Optional[BaseException] = None
+      for i in range(self.retries + 1):
+         attempt_timeout = self.attempt_timeout(timeout, deadline)
+         start = time.monotonic()
+         try:
+            resp = await asyncio.wait_for(attempt(attempt_timeout), attempt_timeout)
+            self._latencies.append(time.monotonic() - start)
+            return resp
+         except RETRYABLE_ERRORS as ex:
+            error = ex
+            logger.warning(f"Completion attempt {i+1}/{self.retries+1} failed: {type(ex).__name__} {ex}")
+         except openai.APIError as ex:
+            raise Completion_Failed(f"Completion failed with a non-retryable error: {type(ex).__name__} {ex}") from ex
+         if i < self.retries:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff * 2**i))
+            if deadline is not None:
+               delay = min(delay, max(0.0, deadline.remaining()))
+            await asyncio.sleep(delay)
+      if deadline is not None and deadline.expired():
+         raise Budget_Exceeded(f"Latency budget ran out after {self.retries+1} attempts, last error: {type(error).__name__} {error}") from error
+      raise Completion_Failed(f"Completion failed after {self.retries+1} attempts, last error: {type(error).__name__} {error}") from error
+
+   async def _hedged_request(self, prompt:str, timeout:float, extra_body:Optional[Dict[str,str]]) -> str:
+      delay = self.hedge_delay()
+      pending = { asyncio.ensure_future(self._request(prompt, timeout, extra_body)) }
+      try:
+         if delay is not None:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+               return done.pop().result()
+            self.hedged += 1
+            pending.add(asyncio.ensure_future(self._request(prompt, timeout, extra_body)))
+         error: Optional[BaseException] = None
+         while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+               if task.exception() is None:
+                  return task.result()
+               error = task.exception()
+         assert error is not None
+         raise error
+      finally:
+         for task in pending:
+            task.cancel()
+
+   # a replay cache without the prompt fails the completion like any other non-retryable error
+   def cached(self, prompt:str, variant:int, grammar:Optional[Grammar]) -> Optional[str]:
+      if self.cache is None:
+         return None
+      try:
+         return self.cache.get(prompt, self.sampling_params(variant, grammar))
+      except Cache_Miss as ex:
+         raise Completion_Failed(f"Completion failed, {ex}") from ex
+
+   # the deadline bounds every attempt and backoff, running out of it raises Budget_Exceeded
+   async def complete(self, prompt:str, timeout:Optional[float]=None, variant:int=0, grammar:Optional[Grammar]=None, deadline:Optional[Deadline]=None) -> str:
+      resp = self.cached(prompt, variant, grammar)
+      if resp is None:
+         extra_body = self.grammar_body(grammar)
+         resp = await self._with_retries(lambda attempt_timeout: self._hedged_request(prompt, attempt_timeout, extra_body), timeout, deadline)
+         if self.cache is not None:
+            self.cache.put(prompt, self.sampling_params(variant, grammar), resp)
+      log_completion(prompt, resp)
+      return resp.split("<")[0].strip()
+
+   # streams are only retried while nothing has been passed to on_delta, and are never hedged
+   async def stream(self, prompt:str, on_delta:Callable[[str],None], timeout:Optional[float]=None, variant:int=0, grammar:Optional[Grammar]=None, deadline:Optional[Deadline]=None) -> str:
+      resp = self.cached(prompt, variant, grammar)
+      if resp is not None:
+         on_delta(resp)
+      else:
+         extra_body = self.grammar_body(grammar)
+         emitted = False
+         def forward(delta:str) -> None:
+            nonlocal emitted
+            emitted = True
+            on_delta(delta)
+         async def attempt(attempt_timeout:float) -> str:
+            if emitted:
+               raise Completion_Failed("Completion stream failed after text was already shown")
+            return await self._request_stream(prompt, forward, attempt_timeout, extra_body)
+         resp = await self._with_retries(attempt, timeout, deadline)
+         if self.cache is not None:
+            self.cache.put(prompt, self.sampling_params(variant, grammar), resp)
+      log_completion(prompt, resp)
+      return resp.split("<")[0].strip()
+
+   async def _request_stream(self, prompt:str, on_delta:Callable[[str],None], timeout:Optional[float], extra_body:Optional[Dict[str,str]]=None) -> str:
+      client = self._get_client()
+      assert self._semaphore is not None
+      timeout = self.timeout if timeout is None else timeout
+
+      async def consume() -> str:
+         stream = await client.chat.completions.create(
+            model=self.model,
+            messages=[
+               { "role":"system", "content":prompt },
+            ],
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stop=self.stop,
+            timeout=timeout,
+            stream=True,
+            extra_body=extra_body,
+         )
+         chunks: List[str] = []
+         async for chunk in stream:
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+               chunks.append(chunk.choices[0].delta.content)
+               on_delta(chunk.choices[0].delta.content)
+         return "".join(chunks)
+
+      async with self._semaphore:
+         resp = await asyncio.wait_for(consume(), timeout)
+      return resp.strip()
+
+   # sends the prompt prefix for a single token so the server's KV cache already holds it when the full prompt arrives
+   # best effort, failures are logged and swallowed and nothing is cached or written to the completion log
+   async def warm(self, prefix:str, timeout:Optional[float]=None) -> bool:
+      try:
+         await self._request(prefix, timeout, { "cache_prompt":True }, max_tokens=1)
+         return True
+      except Exception as ex:
+         logger.debug(f"Prefix warming failed: {ex}")
+         return False
+
+   async def _request(self, prompt:str, timeout:Optional[float], extra_body:Optional[Dict[str,Any]]=None, max_tokens:Optional[int]=None) -> str:
+      client = self._get_client()
+      assert self._semaphore is not None
+      timeout = self.timeout if timeout is None else timeout
+      async with self._semaphore:
+         completion = await asyncio.wait_for(client.chat.completions.create(
+            model=self.model,
+            messages=[
+               { "role":"system", "content":prompt },
+            ],
+            temperature=self.temperature,
+            max_tokens=self.max_tokens if max_tokens is None else max_tokens,
+            stop=self.stop,
+            timeout=timeout,
+            extra_body=extra_body,
+         ), timeout)
+
+      resp = completion.choices[0].message.content
+      assert resp is not None
+      return resp.strip()
+
+   async def close(self) -> None:
+      if self._client is not None:
+         await self._client.close()
+         self._client = None
+         self._semaphore = None
+
+# sync callers share one background loop so the pooled client outlives each call
+_sync_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_lock = threading.Lock()
+
+def _get_sync_loop() -> asyncio.AbstractEventLoop:
+   global _sync_loop
+   with _sync_lock:
+      if _sync_loop is None:
+         _sync_loop = asyncio.new_event_loop()
+         threading.Thread(target=_sync_loop.run_forever, name="completion-loop", daemon=True).start()
+      return _sync_loop
+
+def run_sync(coro:Coroutine[Any,Any,T]) -> T:
+   return asyncio.run_coroutine_threadsafe(coro, _get_sync_loop()).result()
+
+# starts a coroutine on the shared background loop without waiting for it
+def run_in_background(coro:Coroutine[Any,Any,T]) -> "concurrent.futures.Future[T]":
+   return asyncio.run_coroutine_threadsafe(coro, _get_sync_loop())
+
+# awaits a coroutine on the shared background loop from any other event loop
+async def run_on_sync_loop(coro:Coroutine[Any,Any,T]) -> T:
+   return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, _get_sync_loop()))
@@ -0,0 +1,92 @@
+from common import logger
+
+from typing import Dict, Any, Iterator, List
+import json, os, queue, threading, atexit, argparse
+
+_CLOSE = object()
+
+class Completion_Log:
+   path: str
+   batch_size: int
+   flush_interval: float
+   dropped: int
+   written: int
+
+   # entries are handed to a writer thread through a bounded queue, a full queue drops the entry instead of blocking the caller
+   def __init__(self, path:str, max_queue:int=1024, batch_size:int=64, flush_interval:float=0.5):
+      self.path = path
+      self.batch_size = batch_size
+      self.flush_interval = flush_interval
+      self.dropped = 0
+      self.written = 0
+      self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+      self.thread = threading.Thread(target=self._run, name="completion-log", daemon=True)
+      self.thread.start()
+      atexit.register(self.close)
+
+   def write(self, entry:Dict[str,Any]) -> bool:
+      try:
+         self.queue.put_nowait(entry)
+         return True
+      except queue.Full:
+         self.dropped += 1
+         if self.dropped == 1 or self.dropped % 100 == 0:
+            logger.warning(f"Completion log queue is full, dropped {self.dropped} entries so far")
+         return False
+
+   def _run(self) -> None:
+      with open(self.path, "a") as f:
+         closing = False
+         while not closing:
+            batch: List[Dict[str,Any]] = []
+            try:
+               entry = self.queue.get(timeout=self.flush_interval)
+               while True:
+                  if entry is _CLOSE:
+                     closing = True
+                     break
+                  batch.append(entry)
+                  if len(batch) >= self.batch_size:
+                     break
+                  entry = self.queue.get_nowait()
+            except queue.Empty:
+               pass
+            if len(batch) > 0:
+               f.write("".join(json.dumps(e) + "\n" for e in batch))
+               f.flush()
+               self.written += len(batch)
+
+   def close(self) -> None:
+      if self.thread.is_alive():
+         self.queue.put(_CLOSE)
+         self.thread.join()
+
+def read_completion_log(path:str) -> Iterator[Dict[str,Any]]:
+   if path.endswith(".jsonl"):
+      with open(path, "r") as f:
+         for line in f:
+            if line.endswith("\n"):
+               yield json.loads(line)
+   else:
+      with open(path, "r") as f:
+         yield from json.load(f)["queries"]
+
+# writes the same `{"queries": [...]}` layout json.dump(..., indent="\t") produced, without holding the whole log in memory
+def convert(jsonl_path:str, json_path:str) -> int:
+   count = 0
+   with open(json_path, "w") as f:
+      f.write('{\n\t"queries": [')
+      for entry in read_completion_log(jsonl_path):
+         f.write(("," if count > 0 else "") + "\n" + "\n".join("\t\t" + line for line in json.dumps(entry, indent="\t").split("\n")))
+         count += 1
+      f.write("\n\t]\n}" if count > 0 else "]\n}")
+   return count
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="convert an append-only completion log (.jsonl) to the pretty prompts.json layout")
+   parser.add_argument('input', type=str)
+   parser.add_argument('output', type=str, nargs="?", default=None)
+   args = parser.parse_args()
+
+   output = args.output if args.output is not None else os.path.splitext(args.input)[0] + ".json"
+   print(f"Wrote {convert(args.input, output)} queries to {output}")
@@ -1,9 +1,11 @@
+from __future__ import annotations
 from common import State, Event
 from functions import Function_Map, Function, Parameter
-from game import Game
 
 from dataclasses import dataclass
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, TYPE_CHECKING
+if TYPE_CHECKING:
+   from game import Game
 
 
 # Request Player Input
@@ -16,7 +18,7 @@ Function_Map.register(
 
 
 # Player Input
-@dataclass
+@dataclass(slots=True)
 class Player_Input_Event(Event):
    text: str
    def player(self) -> str:
@@ -24,7 +26,7 @@ class Player_Input_Event(Event):
 
 
 # Create Town
-@dataclass
+@dataclass(slots=True)
 class Create_New_Town_Event(Event):
    name: str
    backstory: str
@@ -38,9 +40,8 @@ class Create_New_Town_Event(Event):
       self.backstory   = self._strip_text(self.backstory)
       self.description = self._strip_text(self.description)
 def create_location(self:Game, town_name:str, backstory:str, description:str) -> Tuple[bool,Optional[str]]:
-   for event in self.events:
-      if isinstance(event, Create_New_Town_Event) and event.name.lower() == town_name.lower():
-         return False, f"A location with the name '{town_name}' already exists, no need to create another"
+   if self.get_town(town_name) is not None:
+      return False, f"A location with the name '{town_name}' already exists, no need to create another"
    self.add_event(Create_New_Town_Event(town_name, backstory, description))
    return True, None
 Function_Map.register(
@@ -55,7 +56,7 @@ Function_Map.register(
 
 
 # Move to Town
-@dataclass
+@dataclass(slots=True)
 class Arrive_At_Town_Event(Event):
    town_name: str
    def implication(self) -> Optional[State]:
@@ -68,7 +69,7 @@ class Arrive_At_Town_Event(Event):
       self.town_name = self._fix_name(self.town_name)
 def arrive_at_town(self:Game, town_name:str) -> Tuple[bool,Optional[str]]:
    existing_locations: List[str] = []
-   for event in reversed(self.events):
+   for event in self.get_events(Begin_Traveling_Event, Arrive_At_Town_Event, Create_New_Town_Event, reverse=True):
       if isinstance(event, Begin_Traveling_Event) and len(existing_locations) == 0:
          return True, None
       if isinstance(event, Arrive_At_Town_Event) and event.town_name == town_name:
@@ -89,7 +90,7 @@ Function_Map.register(
 
 
 # Leave Town
-@dataclass
+@dataclass(slots=True)
 class Begin_Traveling_Event(Event):
    travel_goal: str
    def implication(self) -> Optional[State]:
@@ -109,7 +110,7 @@ def begin_traveling(self:Game, travel_goal:str):
 
 
 # Describe Surroundings
-@dataclass
+@dataclass(slots=True)
 class Describe_Environment_Event(Event):
    description: str
    town_name: str
@@ -119,10 +120,13 @@ class Describe_Environment_Event(Event):
       if self.town_name == current_town_name:
          return f"Described Surroundings in '{self.town_name}': {self.description}"
       return None
+   def overview_town(self) -> Optional[str]:
+      return self.town_name
    def clean(self) -> None:
       self.description = self._strip_text(self.description)
+      self.town_name   = self._intern(self.town_name)
 def describe_environment(self:Game, description:str) -> Tuple[bool,Optional[str]]:
-   self.add_event(Describe_Environment_Event(description, self.get_last_event(Arrive_At_Town_Event).town_name))
+   self.add_event(Describe_Environment_Event(description, self.get_current_town()))
    return True, None
 Function_Map.register(
    Function(
@@ -134,7 +138,7 @@ Function_Map.register(
 
 
 # Create NPC
-@dataclass
+@dataclass(slots=True)
 class Create_Character_Event(Event):
    character_name: str
    town_name: str
@@ -148,16 +152,19 @@ class Create_Character_Event(Event):
       if self.town_name == current_town_name:
          return f"A new character is created, '{self.character_name}', {self.background}, {self.description}"
       return None
+   def overview_town(self) -> Optional[str]:
+      return self.town_name
    def clean(self) -> None:
       self.character_name = self._fix_name(self.character_name)
+      self.town_name = self._intern(self.town_name)
       self.background = self._strip_text(self.background)
       self.description = self._strip_text(self.description)
 def create_npc(self:Game, name:str, character_background:str, physical_description:str) -> Tuple[bool,Optional[str]]:
-   current_location = self.get_last_event(Arrive_At_Town_Event).town_name
-   for event in reversed(self.events):
-      if isinstance(event, Create_Character_Event) and event.town_name == current_location and event.character_name == name:
+   current_location = self.get_current_town()
+   for event in self.get_characters():
+      if event.character_name == name:
          return False, f"Character '{name}' already exists, you can interact with them directly without calling `create_npc` again"
-   self.add_event(Create_Character_Event(name, self.get_last_event(Arrive_At_Town_Event).town_name, character_background, physical_description))
+   self.add_event(Create_Character_Event(name, current_location, character_background, physical_description))
    return True, None
 Function_Map.register(
    Function(
@@ -171,22 +178,23 @@ Function_Map.register(
 
 
 # Start Conversation
-@dataclass
+@dataclass(slots=True)
 class Start_Conversation_Event(Event):
    character_name: str
    def implication(self) -> Optional[State]:
       return State.TOWN_TALK
    def player(self) -> str:
       return f"You start talking with {self.character_name}"
+   def clean(self) -> None:
+      self.character_name = self._intern(self.character_name)
 def start_conversation(self:Game, npc_name:str) -> Tuple[bool,Optional[str]]:
    existing_characters = []
-   current_location = self.get_last_event(Arrive_At_Town_Event).town_name
-   for event in reversed(self.events):
-      if isinstance(event, Create_Character_Event) and event.town_name == current_location:
-         if npc_name == event.character_name:
-            self.add_event(Start_Conversation_Event(npc_name))
-            return True, None
-         existing_characters.append(event.character_name)
+   current_location = self.get_current_town()
+   for event in self.get_characters():
+      if npc_name == event.character_name:
+         self.add_event(Start_Conversation_Event(npc_name))
+         return True, None
+      existing_characters.append(event.character_name)
    return False, f"Failed to find character named '{npc_name}', the current location ({current_location}) has characters with the following names: {existing_characters}"
 Function_Map.register(
    Function(
@@ -198,7 +206,7 @@ Function_Map.register(
 
 
 # Speak Events
-@dataclass
+@dataclass(slots=True)
 class Speak_Event(Event):
    with_character: str
    is_player_speaking: bool
@@ -208,6 +216,8 @@ class Speak_Event(Event):
    def render(self) -> str:
       cleaned_text = self.text.replace('"', "'")
       return "speak_" + ("player_to_npc" if self.is_player_speaking else "npc_to_player") + f'("{cleaned_text}")'
+   def clean(self) -> None:
+      self.with_character = self._intern(self.with_character)
 def respond_as_npc(self:Game, response_text:str) -> Tuple[bool,Optional[str]]:
    self.add_event(Speak_Event(self.get_last_event(Start_Conversation_Event).character_name, False, response_text))
    return True, None
@@ -221,7 +231,7 @@ Function_Map.register(
 
 
 # Stop Conversation
-@dataclass
+@dataclass(slots=True)
 class End_Converstation_Event(Event):
    def implication(self) -> Optional[State]:
       return State.TOWN_IDLE
@@ -233,7 +243,7 @@ def stop_converstation(self:Game) -> Tuple[bool,Optional[str]]:
 
 
 # Add Quest
-@dataclass
+@dataclass(slots=True)
 class Quest_Start(Event):
    quest_name: str
    quest_description: str
@@ -243,8 +253,8 @@ class Quest_Start(Event):
       self.quest_name = self._fix_name(self.quest_name)
       self.quest_description = self._strip_text(self.quest_description)
 def add_quest(self:Game, quest_description:str, quest_name:str) -> Tuple[bool,Optional[str]]:
-   for event in reversed(self.events):
-      if isinstance(event, Quest_Start) and event.quest_name == quest_name:
+   for event in self.get_events(Quest_Start, reverse=True):
+      if event.quest_name == quest_name:
          return False, f"A quest with the name '{quest_name}' already exists"
    self.add_event(Quest_Start(quest_name, quest_description))
    return True, None
@@ -259,13 +269,15 @@ Function_Map.register(
 
 
 # Complete Quest
-@dataclass
+@dataclass(slots=True)
 class Quest_Complete(Event):
    quest_name: str
    def player(self) -> str:
       return f"You complete a quest, {self.quest_name}"
+   def clean(self) -> None:
+      self.quest_name = self._intern(self.quest_name)
 def complete_quest(self:Game, quest_name:str) -> Tuple[bool,Optional[str]]:
-   for event in reversed(self.events):
+   for event in self.get_events(Quest_Complete, Quest_Start, reverse=True):
       if isinstance(event, Quest_Complete) and event.quest_name == quest_name:
          return False, f"The quest named '{quest_name}' has already been completed"
       if isinstance(event, Quest_Start) and event.quest_name == quest_name:
@@ -282,7 +294,7 @@ Function_Map.register(
 
 
 # Shop Encounter
-@dataclass
+@dataclass(slots=True)
 class Shop_Encounter_Event(Event):
    merchant_name: str
    def implication(self) -> Optional[State]:
@@ -290,7 +302,7 @@ class Shop_Encounter_Event(Event):
 
 
 # Trap Encounter
-@dataclass
+@dataclass(slots=True)
 class Trap_Encounter_Event(Event):
    trap_description: str
    def implication(self) -> Optional[State]:
@@ -298,7 +310,7 @@ class Trap_Encounter_Event(Event):
 
 
 # Combat Encounter
-@dataclass
+@dataclass(slots=True)
 class Combat_Encounter_Event(Event):
    enemy_count: int
    def implication(self) -> Optional[State]:
@@ -306,3 +318,5 @@ class Combat_Encounter_Event(Event):
 
 
 event_dictionary = { n:E for n,E in locals().items() if isinstance(E, type) and issubclass(E, Event) }
+
+Function_Map.freeze()
@@ -1,11 +1,15 @@
 from common import State
 from functions import Function, Function_Map, parse_function, match_function
-from prompts import define_api, ask_for_scratchpad, end_scratchpad, ask_for_function_call, end_function_calling, update_scratchpad
+from grammar import Grammar, choose_function_grammar, fill_function_grammar, call_grammar, plan_and_call_grammar
+from prompts import define_api, ask_for_scratchpad, end_scratchpad, ask_for_function_call, end_function_calling, update_scratchpad, ask_for_plan_and_call
 
-from typing import Callable, Tuple
+from typing import Callable, Tuple, Optional, Dict
+from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
 
 class Micro_State(Enum):
+   FUSED             = "FUSED"
    CREATE_SCRATCHPAD = "CREATE_SCRATCHPAD"
    CHOOSE_FUNCTION   = "CHOOSE_FUNCTION"
    FILL_FUNCTION     = "FILL_FUNCTION"
@@ -15,28 +19,64 @@ class Micro_State(Enum):
    def __repr__(self) -> str: return self.value
    __str__ = __repr__
 
+# functions whose first argument is shown to the player verbatim, worth streaming while it is generated
+STREAMED_FUNCTIONS = { "speak_npc_to_player", "describe_surroundings" }
+
+CHOOSE_FUNCTION_TAIL = "\n" + end_scratchpad + "\n" + ask_for_function_call
+
+@dataclass
+class Extension_Prefixes:
+   fused: str
+   scratchpad: str
+   fill: Dict[str,str]
+
+# the parts of every extension that only depend on the state, built once per State from the frozen Function_Map
+@lru_cache(maxsize=None)
+def extension_prefixes(state:State, fused:bool) -> Extension_Prefixes:
+   assert Function_Map.frozen, "Function_Map.freeze() must be called before building extensions"
+   api_def = (Function_Map.api_long if fused else Function_Map.api_short).get(state, "")
+   def with_api(api:str, ask:str) -> str:
+      return define_api.replace("%%API%%", api) + "\n" + ask
+   return Extension_Prefixes(
+      fused      = with_api(api_def, ask_for_plan_and_call),
+      scratchpad = with_api(api_def, ask_for_scratchpad),
+      fill       = { f.name: with_api(f.render_long(), ask_for_scratchpad) for f in Function_Map.get(state) },
+   )
+
 class Prompt_Evolver:
    micro_state: Micro_State
    scratchpad: str
    selected_function: Function
    full_function_call: str
    call: Callable
+   fused: bool
+   prefixes: Extension_Prefixes
+   plan_prefix: Optional[str]
 
-   def __init__(self, current_state:State):
-      self.micro_state = Micro_State.CREATE_SCRATCHPAD
+   # fused evolvers ask for the scratchpad and a filled in call in one completion, falling back to the separate steps when it does not validate
+   def __init__(self, current_state:State, fused:bool=False):
+      self.fused = fused
+      self.micro_state = Micro_State.FUSED if fused else Micro_State.CREATE_SCRATCHPAD
       self.state_functions = Function_Map.get(current_state)
+      self.prefixes = extension_prefixes(current_state, fused)
+      self.plan_prefix = None
    
    def get_extension(self) -> str:
-      if self.micro_state != Micro_State.FILL_FUNCTION:
-         api_def = "".join(f.render_short() for f in self.state_functions)
-      else:
-         api_def = self.selected_function.render_long()
-      ext = define_api.replace("%%API%%", api_def) + "\n" + ask_for_scratchpad
+      if self.micro_state == Micro_State.FUSED:
+         return self.prefixes.fused
 
       if self.micro_state == Micro_State.CREATE_SCRATCHPAD:
-         return ext
+         return self.prefixes.scratchpad
 
-      ext += "\n" + self.scratchpad + "\n" + end_scratchpad + "\n" + ask_for_function_call
+      # a plan written in the fused prompt is continued from that same prompt
+      if self.plan_prefix is not None:
+         ext = self.plan_prefix
+      elif self.micro_state == Micro_State.FILL_FUNCTION:
+         ext = self.prefixes.fill[self.selected_function.name]
+      else:
+         ext = self.prefixes.scratchpad
+
+      ext += "\n" + self.scratchpad + CHOOSE_FUNCTION_TAIL
       if self.micro_state == Micro_State.CHOOSE_FUNCTION:
          return ext
       
@@ -50,10 +90,39 @@ class Prompt_Evolver:
 
       raise RuntimeError(f"[INVALID_STATE] Reached the end of get_extension, should have gotten a handled return by now")
    
+   # constrains the next output to what process_output will accept, the free text scratchpads are left unconstrained
+   def get_grammar(self) -> Optional[Grammar]:
+      if self.micro_state == Micro_State.FUSED:
+         return plan_and_call_grammar(self.state_functions)
+      if self.micro_state == Micro_State.CHOOSE_FUNCTION:
+         return call_grammar(self.state_functions) if self.fused else choose_function_grammar(self.state_functions)
+      if self.micro_state == Micro_State.FILL_FUNCTION:
+         return fill_function_grammar(self.selected_function)
+      return None
+
+   # the called function is remembered so revert() can ask for it to be filled in again when the call fails
+   def _accept_call(self, func_name:str, call:Callable, call_line:str) -> Tuple[bool,str]:
+      self.selected_function = next(f for f in self.state_functions if f.name == func_name)
+      self.call = call
+      self.full_function_call = call_line
+      self.micro_state = Micro_State.UPDATE_SCRATCHPAD
+      return True, ""
+
+   # without a plan there is nothing to continue the fused prompt from, so the scratchpad is asked for on its own
+   def _fall_back(self, micro_state:Micro_State, msg:str) -> Tuple[bool,str]:
+      if len(self.scratchpad) == 0:
+         micro_state = Micro_State.CREATE_SCRATCHPAD
+         self.plan_prefix = None
+      self.micro_state = micro_state
+      return True, f"{msg}, falling back to {self.micro_state}"
+
    def revert(self) -> None:
       assert self.micro_state == Micro_State.UPDATE_SCRATCHPAD
       self.micro_state = Micro_State.FILL_FUNCTION
 
+   def should_stream(self) -> bool:
+      return self.micro_state == Micro_State.FILL_FUNCTION and self.selected_function.name in STREAMED_FUNCTIONS
+
    def should_call(self) -> bool:
       return self.micro_state == Micro_State.UPDATE_SCRATCHPAD
    
@@ -68,7 +137,32 @@ class Prompt_Evolver:
       self.micro_state = Micro_State.CHOOSE_FUNCTION
 
    def process_output(self, output:str) -> Tuple[bool,str]:
-      if self.micro_state == Micro_State.CREATE_SCRATCHPAD:
+      if self.micro_state == Micro_State.FUSED:
+         lines = [line.strip() for line in output.strip().split("\n") if line.strip()]
+         # only a last line with a "(" is taken as the call, every other line is kept as the plan
+         call_line = lines.pop() if len(lines) > 0 and "(" in lines[-1] else None
+         self.scratchpad = "\n".join(lines)
+         self.plan_prefix = self.prefixes.fused
+         if call_line is None:
+            return self._fall_back(Micro_State.CHOOSE_FUNCTION, "Got no function call on the last line" if len(lines) > 0 else "Got an empty fused output")
+         ret, msg = parse_function(call_line)
+         if ret is None:
+            return self._fall_back(Micro_State.CHOOSE_FUNCTION, msg)
+         func_name, args, kwargs = ret
+         if func_name == "get_player_input":
+            self.scratchpad = ""
+            self.micro_state = Micro_State.DONE
+            return True, ""
+         call, msg = match_function(func_name, args, kwargs, self.state_functions)
+         if call is None:
+            for func in self.state_functions:
+               if func.name == func_name:
+                  self.selected_function = func
+                  return self._fall_back(Micro_State.FILL_FUNCTION, msg)
+            return self._fall_back(Micro_State.CHOOSE_FUNCTION, msg)
+         return self._accept_call(func_name, call, call_line)
+
+      elif self.micro_state == Micro_State.CREATE_SCRATCHPAD:
          self.scratchpad = output.strip()
          self.micro_state = Micro_State.CHOOSE_FUNCTION
          return True, ""
@@ -84,10 +178,7 @@ class Prompt_Evolver:
          if (param_count := (len(args) + len(kwargs))) > 0:
             call, msg = match_function(func_name, args, kwargs, self.state_functions)
             if call is not None:
-               self.call = call
-               self.full_function_call = lines[0]
-               self.micro_state = Micro_State.UPDATE_SCRATCHPAD
-               return True, ""
+               return self._accept_call(func_name, call, lines[0])
             return False, f"Got {param_count} parameters to function call, expected exactly 0"
          if func_name == "get_player_input":
             self.scratchpad = ""
@@ -26,23 +26,33 @@ class Function:
    name: str
    comment: str
    params: List[Parameter]
+   # functions are never changed after registration, so the renderings are built once up front
    def __init__(self, call:Callable, name:str, comment:str, *params:Parameter):
       self.call = call
       self.name = name
       self.comment = comment
       self.params = list(params)
+      signature = ", ".join(p.render() for p in self.params)
+      self._render = f"def {self.name}({signature}): # {self.comment}"
+      self._render_short = f"def {self.name}(): # {self.comment}\n"
+      self._render_long = f'def {self.name}({signature}):\n\t"""\n\t{self.comment}\n\n\tParameters:\n\t-----------\n\t' + "".join(p.render_long() for p in self.params) + '"""\n'
    def render(self) -> str:
-      return f"def {self.name}({', '.join(p.render() for p in self.params)}): # {self.comment}"
+      return self._render
    def render_short(self) -> str:
-      return f"def {self.name}(): # {self.comment}\n"
+      return self._render_short
    def render_long(self) -> str:
-      return f'def {self.name}({", ".join(p.render() for p in self.params)}):\n\t"""\n\t{self.comment}\n\n\tParameters:\n\t-----------\n\t' + "".join(p.render_long() for p in self.params) + '"""\n'
+      return self._render_long
 
 class Function_Map:
    mapping: Dict[State,List[Function]] = {}
+   frozen: bool = False
+   api_short: Dict[State,str] = {}
+   api_long: Dict[State,str] = {}
 
    @staticmethod
    def register(fxn:Function, *states:State) -> None:
+      if Function_Map.frozen:
+         raise RuntimeError(f"Cannot register '{fxn.name}', Function_Map was already frozen")
       for state in states:
          if state not in Function_Map.mapping:
             Function_Map.mapping[state] = []
@@ -55,6 +65,17 @@ class Function_Map:
          funcs = [f for f in funcs if f.name == specific_function]
       return funcs
 
+   # called once every function is registered, precomputes the API text each state shows the model
+   # the long text keeps functions without parameters short, as the fused evolver shows them
+   @staticmethod
+   def freeze() -> None:
+      if Function_Map.frozen:
+         return
+      for state, funcs in Function_Map.mapping.items():
+         Function_Map.api_short[state] = "".join(f.render_short() for f in funcs)
+         Function_Map.api_long[state]  = "".join((f.render_long() if len(f.params) > 0 else f.render_short()) for f in funcs)
+      Function_Map.frozen = True
+
 
 
 
@@ -118,6 +139,33 @@ def parse_function(line:str, allow_empty:bool=False) -> Tuple[Optional[Tuple[str
    return (func_name, args, kwargs), ""
 
 
+class Quoted_Text_Stream:
+   quote_char: Optional[str]
+   started: bool
+   done: bool
+
+   # incrementally reveals the contents of the first quoted argument in a function call as its characters arrive
+   def __init__(self):
+      self.quote_char = None
+      self.started = False
+      self.done = False
+
+   def feed(self, chunk:str) -> str:
+      text = ""
+      for char in chunk:
+         if self.done:
+            break
+         if self.quote_char is None:
+            if char in ("'", '"'):
+               self.quote_char = char
+               self.started = True
+         elif char == self.quote_char:
+            self.done = True
+         else:
+            text += char
+      return text
+
+
 def cast_value(value:str, param:Parameter) -> Tuple[Any,str]:
    if param.dtype is str:
       for quote in ('"', "'"):
@@ -2,89 +2,422 @@ from __future__ import annotations
 from common import Event, State
 import events as E
 
-from typing import List, Optional, Dict, Any, List, Callable, Type, TypeVar, Tuple
+from typing import List, Optional, Dict, Any, List, Callable, Type, TypeVar, Tuple, Iterator, Set, Iterable, Sequence
 from dataclasses import asdict
+from itertools import islice
+from bisect import bisect_left
+from functools import lru_cache
+import heapq
 
 T = TypeVar('T')
 
+class Event_Log:
+   parent: Optional['Event_Log']
+   base: int
+   entries: List[Event]
+   index: Dict[Type,List[int]]
+
+   # a fork shares the first `base` events of its parent and only stores its own appends
+   def __init__(self, parent:Optional['Event_Log']=None):
+      self.parent = parent
+      self.base = 0 if parent is None else len(parent)
+      self.entries = []
+      self.index = {}
+
+   def fork(self) -> 'Event_Log':
+      return Event_Log(self)
+
+   def __len__(self) -> int:
+      return self.base + len(self.entries)
+
+   def __getitem__(self, position:int) -> Event:
+      if position < 0:
+         position += len(self)
+      if position < 0 or position >= len(self):
+         raise IndexError(f"event position {position} out of range for log of length {len(self)}")
+      log = self
+      while position < log.base:
+         assert log.parent is not None
+         log = log.parent
+      return log.entries[position - log.base]
+
+   def __iter__(self) -> Iterator[Event]:
+      return self._iter(0, len(self))
+   def _iter(self, start:int, stop:int) -> Iterator[Event]:
+      if self.parent is not None and start < self.base:
+         yield from self.parent._iter(start, min(stop, self.base))
+      lo, hi = max(0, start - self.base), max(0, stop - self.base)
+      if lo >= hi:
+         return
+      # entries loaded from a snapshot are a lazy Journal_Prefix, which reads a range of the journal in one pass
+      iter_range = getattr(self.entries, "iter_range", None)
+      yield from (islice(self.entries, lo, hi) if iter_range is None else iter_range(lo, hi))
+
+   def tail(self, start:int) -> Iterator[Event]:
+      return self._iter(start, len(self))
+
+   # events at the given ascending positions, a Journal_Prefix reads them in one pass over the journal
+   def select(self, positions:Sequence[int]) -> Iterator[Event]:
+      split = bisect_left(positions, self.base)
+      if split > 0:
+         assert self.parent is not None
+         yield from self.parent.select(positions[:split])
+      own = [p - self.base for p in positions[split:]]
+      select = getattr(self.entries, "select", None)
+      yield from ((self.entries[i] for i in own) if select is None else select(own))
+
+   def __reversed__(self) -> Iterator[Event]:
+      return self._reversed(len(self))
+   def _reversed(self, stop:int) -> Iterator[Event]:
+      for i in range(min(len(self.entries), stop - self.base) - 1, -1, -1):
+         yield self.entries[i]
+      if self.parent is not None:
+         yield from self.parent._reversed(min(stop, self.base))
+
+   def append(self, event:Event) -> int:
+      position = len(self)
+      self.entries.append(event)
+      for cls in type(event).__mro__:
+         if issubclass(cls, Event):
+            self.index.setdefault(cls, []).append(position)
+      return position
+
+   def positions(self, target_event:Type, reverse:bool=False) -> Iterator[int]:
+      return self._positions(target_event, len(self), reverse)
+   def _positions(self, target_event:Type, stop:int, reverse:bool) -> Iterator[int]:
+      own = self.index.get(target_event, [])
+      end = bisect_left(own, stop)
+      if not reverse and self.parent is not None:
+         yield from self.parent._positions(target_event, min(stop, self.base), reverse)
+      for i in (range(end - 1, -1, -1) if reverse else range(end)):
+         yield own[i]
+      if reverse and self.parent is not None:
+         yield from self.parent._positions(target_event, min(stop, self.base), reverse)
+
+class Shared_List:
+   items: List
+   length: int
+   owner: object
+   __slots__ = ("items", "length", "owner")
+
+   # a view of the first `length` items of an append-only list, only the game that owns the list appends to it in place
+   # a fork sees the list as it was when it was made and copies it on its first append, like Event_Log sharing its parent's events below `base`
+   def __init__(self, items:List, length:int, owner:object):
+      self.items = items
+      self.length = length
+      self.owner = owner
+
+   def __len__(self) -> int:
+      return self.length
+
+   def __iter__(self) -> Iterator:
+      return islice(self.items, self.length)
+
+   def __reversed__(self) -> Iterator:
+      for i in range(self.length - 1, -1, -1):
+         yield self.items[i]
+
+   def __getitem__(self, i:Any) -> Any:
+      if isinstance(i, slice):
+         return self.items[slice(*i.indices(self.length))]
+      if i < 0:
+         i += self.length
+      if i < 0 or i >= self.length:
+         raise IndexError(f"index {i} out of range for shared list of length {self.length}")
+      return self.items[i]
+
+   def __eq__(self, other:object) -> bool:
+      return isinstance(other, Shared_List) and list(self) == list(other)
+
+   def append(self, item:Any, owner:object) -> 'Shared_List':
+      if self.owner is owner and len(self.items) == self.length:
+         self.items.append(item)
+         return Shared_List(self.items, self.length + 1, owner)
+      return Shared_List(self.items[:self.length] + [item], self.length + 1, owner)
+
+EMPTY_LIST = Shared_List([], 0, None)
+
+# event classes that add a line to every overview, and those whose line only shows in their own town's overview
+@lru_cache(maxsize=None)
+def overview_classes() -> Tuple[Tuple[Type,...],Tuple[Type,...]]:
+   shown = [cls for cls in E.event_dictionary.values() if cls.system is not Event.system]
+   return tuple(c for c in shown if c.overview_town is Event.overview_town), tuple(c for c in shown if c.overview_town is not Event.overview_town)
+
 class Game:
-   events: List[Event]
-   def __init__(self, events:Optional[List[Event]]=None):
-      self.events = [] if events is None else events
+   events: Event_Log
+   parent: Optional['Game']
+
+   # projection of the event list, kept current by add_event()
+   state: State
+   town: Optional[int]
+   quests: Shared_List
+   characters: Dict[str,Shared_List]
+   towns: Dict[str,int]
+   named_characters: Dict[str,int]
+   conversations: Dict[str,Shared_List]
+   # rendered lines of each conversation, joined when a prompt is built
+   conversation_text: Dict[str,Shared_List]
+
+   # rendered overview per location as (number of events covered, text), extended on demand
+   overview: Dict[str,Tuple[int,str]]
+   # lines every location shares as (events covered, text, event positions, text offsets), rendered once and spliced into each location's overview
+   overview_shared: Tuple[int,str,Tuple[int,...],Tuple[int,...]]
+   # positions of events whose overview line only shows in one town
+   overview_local: Dict[str,Shared_List]
+
+   # projection dicts shared with a fork are copied before their first write
+   _owned: Set[str]
+   # identifies this game as the owner of the Shared_Lists it may append to in place
+   _owner: object
+
+   def __init__(self, events:Optional[Iterable[Event]]=None):
+      self.events = Event_Log()
+      self.parent = None
+      self.state = State.ON_THE_MOVE
+      self.town = None
+      self._owner = object()
+      self.quests = EMPTY_LIST
+      self.characters = {}
+      self.towns = {}
+      self.named_characters = {}
+      self.conversations = {}
+      self.conversation_text = {}
+      self.overview = {}
+      self.overview_shared = (0, "", (), ())
+      self.overview_local = {}
+      self._owned = set()
+      if events is not None:
+         self.replay(events)
 
    def copy(self) -> 'Game':
-      return Game(self.events.copy())
+      fork = Game.__new__(Game)
+      fork.__dict__.update(self.__dict__)
+      fork.events = self.events.fork()
+      fork.parent = self
+      fork._owned = set()
+      fork._owner = object()
+      self._owned = set()
+      return fork
+
+   def commit(self) -> None:
+      assert self.parent is not None, "cannot commit a game that was not created by copy()"
+      if len(self.parent.events) != self.events.base:
+         raise RuntimeError(f"cannot commit, parent game has {len(self.parent.events)} events but this fork was made at {self.events.base}")
+      for event in self.events.entries:
+         self.parent._apply(event)
+      self.parent.overview = self.overview
+      self.parent._owned.discard("overview")
+      self.parent.overview_shared = self.overview_shared
+      self.discard()
+
+   def discard(self) -> None:
+      assert self.parent is not None, "cannot discard a game that was not created by copy()"
+      self.__dict__.update(self.parent.copy().__dict__)
+
+   @staticmethod
+   def event_to_json(event:Event) -> Dict[str,Any]:
+      entry: Dict[str,Any] = { "cls": event.__class__.__name__ }
+      entry.update(asdict(event))
+      return entry
+
+   @staticmethod
+   def event_from_json(event_data:Dict) -> Event:
+      assert isinstance(event_data, dict), f"expected event entry to be a dict, got {type(event_data).__name__}"
+      event_data = event_data.copy()
+      event_name = event_data.pop("cls", None)
+      assert event_name is not None, f"could not find cls in data: {event_data}"
+      event_cls = E.event_dictionary.get(event_name, None)
+      assert event_cls is not None, f"could not find event with name '{event_name}' in dictionary"
+      return event_cls(**event_data)
 
    def to_json(self) -> List[Dict[str,Any]]:
-      data: List[Dict[str,Any]] = []
-      for event in self.events:
-         entry: Dict[str,Any] = { "cls": event.__class__.__name__ }
-         entry.update(asdict(event))
-         data.append(entry)
-      return data
+      return [Game.event_to_json(event) for event in self.events]
 
    @staticmethod
-   def from_json(data:List[Dict]) -> 'Game':
-      assert isinstance(data, list) and all(isinstance(e, dict) for e in data)
-      events: List[Event] = []
-      for event_data in data:
-         event_data = event_data.copy()
-         event_name = event_data.pop("cls", None)
-         assert event_name is not None, f"could not find cls in data: {event_data}"
-         event_cls = E.event_dictionary.get(event_name, None)
-         assert event_cls is not None, f"could not find event with name '{event_name}' in dictionary"
-         events.append(event_cls(**event_data))
-      return Game(events)
+   def from_json(data:Iterable[Dict]) -> 'Game':
+      assert not isinstance(data, (dict, str)), f"expected a list of event entries, got {type(data).__name__}"
+      return Game(Game.event_from_json(event_data) for event_data in data)
+
+   def get_projection(self) -> Dict[str,Any]:
+      return {
+         "state": self.state.value,
+         "town": self.town,
+         "quests": list(self.quests),
+         "characters": { k:list(v) for k,v in self.characters.items() },
+         "towns": dict(self.towns),
+         "named_characters": dict(self.named_characters),
+         "conversations": { k:list(v) for k,v in self.conversations.items() },
+         "conversation_text": { k:list(v) for k,v in self.conversation_text.items() },
+         "overview": { k:list(v) for k,v in self.overview.items() },
+         "overview_shared": [self.overview_shared[0], self.overview_shared[1], list(self.overview_shared[2]), list(self.overview_shared[3])],
+         "overview_local": { k:list(v) for k,v in self.overview_local.items() },
+      }
+
+   def set_projection(self, data:Dict[str,Any]) -> None:
+      self.state = State(data["state"])
+      self.town = data["town"]
+      self.quests = self._shared(data["quests"])
+      self.characters = { k:self._shared(v) for k,v in data["characters"].items() }
+      self.towns = dict(data["towns"])
+      self.named_characters = dict(data["named_characters"])
+      self.conversations = { k:self._shared(v) for k,v in data.get("conversations", {}).items() }
+      self.conversation_text = { k:self._shared(v) for k,v in data.get("conversation_text", {}).items() }
+      self.overview = { k:(v[0],v[1]) for k,v in data.get("overview", {}).items() }
+      shared = data.get("overview_shared", [0, "", [], []])
+      self.overview_shared = (shared[0], shared[1], tuple(shared[2]), tuple(shared[3]))
+      self.overview_local = { k:self._shared(v) for k,v in data.get("overview_local", {}).items() }
+      self._owned = set()
+
+   def replay(self, events:Iterable[Event]) -> None:
+      for event in events:
+         self._apply(event)
 
    def add_event(self, event:Event) -> None:
       event.clean()
-      self.events.append(event)
+      self._apply(event)
+
+   def _mutable(self, name:str) -> Dict:
+      if name not in self._owned:
+         setattr(self, name, dict(getattr(self, name)))
+         self._owned.add(name)
+      return getattr(self, name)
+
+   def _shared(self, items:List) -> Shared_List:
+      return Shared_List(list(items), len(items), self._owner)
+
+   def _append(self, name:str, key:str, item:Any) -> None:
+      lists = self._mutable(name)
+      lists[key] = lists.get(key, EMPTY_LIST).append(item, self._owner)
+
+   def _apply(self, event:Event) -> None:
+      position = self.events.append(event)
+      state = event.implication()
+      if state is not None:
+         self.state = state
+      if isinstance(event, E.Arrive_At_Town_Event):
+         self.town = position
+      elif isinstance(event, E.Create_Character_Event):
+         self._append("characters", event.town_name, position)
+         self._mutable("named_characters")[event.character_name] = position
+      elif isinstance(event, E.Create_New_Town_Event):
+         self._mutable("towns").setdefault(event.name.lower(), position)
+      elif isinstance(event, E.Speak_Event):
+         self._append("conversations", event.with_character, position)
+         self._append("conversation_text", event.with_character, event.render() + "\n")
+      elif isinstance(event, E.Quest_Start):
+         self.quests = self.quests.append(position, self._owner)
+      elif isinstance(event, E.Quest_Complete):
+         self.quests = self._shared([p for p in self.quests if self.events[p].quest_name != event.quest_name]) # type: ignore
+      overview_town = event.overview_town()
+      if overview_town is not None:
+         self._append("overview_local", overview_town, position)
 
    def get_current_state(self) -> State:
-      for event in reversed(self.events):
-         state = event.implication()
-         if state is not None:
-            return state
-      return State.ON_THE_MOVE
-   
+      return self.state
+
+   def get_current_town(self) -> str:
+      if self.town is None:
+         raise RuntimeError(f"get_current_town() failed to find a {E.Arrive_At_Town_Event.__name__} in the event list")
+      return self.events[self.town].town_name # type: ignore
+
+   def get_events(self, *target_events:Type, reverse:bool=False) -> Iterator[Any]:
+      if len(target_events) == 1:
+         positions = self.events.positions(target_events[0], reverse)
+      elif reverse:
+         positions = heapq.merge(*(self.events.positions(t, reverse) for t in target_events), reverse=True)
+      else:
+         positions = heapq.merge(*(self.events.positions(t) for t in target_events))
+      for position in positions:
+         yield self.events[position]
+
    def get_last_event(self, target_event:Type[T], limit_fnx:Callable[[T],bool]=(lambda e: True), default=None) -> T:
-      for event in reversed(self.events):
-         if isinstance(event, target_event) and limit_fnx(event):
+      for event in self.get_events(target_event, reverse=True):
+         if limit_fnx(event):
             return event
       if default is not None:
          return default
       raise RuntimeError(f"get_last_event() failed to find a {target_event.__name__} in the event list")
 
+   def get_character(self, character_name:str) -> E.Create_Character_Event:
+      position = self.named_characters.get(character_name, None)
+      if position is None:
+         raise RuntimeError(f"get_character() failed to find a character named '{character_name}' in the event list")
+      return self.events[position] # type: ignore
+
+   def get_town(self, town_name:str) -> Optional[E.Create_New_Town_Event]:
+      position = self.towns.get(town_name.lower(), None)
+      return None if position is None else self.events[position] # type: ignore
+
    def get_conversation_history(self, character_name:str) -> List[E.Speak_Event]:
-      history = []
-      for event in self.events:
-         if isinstance(event, E.Speak_Event) and event.with_character == character_name:
-            history.append(event)
-      return history
-
-   def get_overview(self) -> str:
-      overview = []
-      current_location = self.get_last_event(E.Arrive_At_Town_Event).town_name
-      for event in self.events:
-         text = event.system(current_location)
-         if text is not None:
-            overview.append(text+"\n")
-      return "".join(overview)
+      return [self.events[p] for p in self.conversations.get(character_name, ())] # type: ignore
+
+   def get_last_speech(self, character_name:str) -> Optional[E.Speak_Event]:
+      positions = self.conversations.get(character_name, ())
+      return self.events[positions[-1]] if len(positions) > 0 else None # type: ignore
+
+   def get_conversation(self, character_name:str) -> str:
+      return "".join(self.conversation_text.get(character_name, EMPTY_LIST))
+
+   def get_shared_overview(self) -> Tuple[str,Tuple[int,...],Tuple[int,...]]:
+      covered, text, positions, offsets = self.overview_shared
+      if covered == len(self.events):
+         return text, positions, offsets
+      new_positions = sorted(p for cls in overview_classes()[0] for p in self.events.positions(cls) if p >= covered)
+      pieces, line_positions, line_offsets, length = [text], [], [], len(text)
+      for position, event in zip(new_positions, self.events.select(new_positions)):
+         line = event.system("")
+         if line is not None:
+            line_positions.append(position)
+            line_offsets.append(length)
+            pieces.append(line+"\n")
+            length += len(line) + 1
+      self.overview_shared = (len(self.events), "".join(pieces), positions + tuple(line_positions), offsets + tuple(line_offsets))
+      return self.overview_shared[1:]
+
+   # the overview as (event position, line) pairs, split into the lines every location shares and the given town's own lines
+   def get_overview_parts(self, current_location:Optional[str]=None) -> Tuple[List[Tuple[int,str]],List[Tuple[int,str]]]:
+      if current_location is None:
+         current_location = self.get_current_town()
+      text, positions, offsets = self.get_shared_overview()
+      ends = offsets[1:] + (len(text),)
+      shared = [(position, text[start:end]) for position, start, end in zip(positions, offsets, ends)]
+      local_positions = self.overview_local.get(current_location, ())
+      local = []
+      for position, event in zip(local_positions, self.events.select(local_positions)):
+         line = event.system(current_location)
+         if line is not None:
+            local.append((position, line+"\n"))
+      return shared, local
+
+   # a location's overview is the shared lines with only that town's own lines spliced in by event position
+   def get_overview(self, current_location:Optional[str]=None) -> str:
+      if current_location is None:
+         current_location = self.get_current_town()
+      covered, text = self.overview.get(current_location, (0, ""))
+      if covered == len(self.events):
+         return text
+      shared, positions, offsets = self.get_shared_overview()
+      def offset_before(position:int) -> int:
+         i = bisect_left(positions, position)
+         return offsets[i] if i < len(offsets) else len(shared)
+      local = self.overview_local.get(current_location, ())
+      local = local[bisect_left(local, covered):]
+      overview = [text]
+      cursor = offset_before(covered)
+      for position, event in zip(local, self.events.select(local)):
+         line = event.system(current_location)
+         if line is not None:
+            end = offset_before(position)
+            overview.append(shared[cursor:end])
+            overview.append(line+"\n")
+            cursor = end
+      overview.append(shared[cursor:])
+      text = "".join(overview)
+      self._mutable("overview")[current_location] = (len(self.events), text)
+      return text
 
    def get_active_quests(self) -> List[E.Quest_Start]:
-      active_quests = []
-      completed_quests = set()
-      for event in reversed(self.events):
-         if isinstance(event, E.Quest_Complete):
-            completed_quests.add(event.quest_name)
-         elif isinstance(event, E.Quest_Start) and event.quest_name not in completed_quests:
-            active_quests.append(event)
-      return active_quests
+      return [self.events[p] for p in reversed(self.quests)] # type: ignore
 
    def get_characters(self) -> List[E.Create_Character_Event]:
-      characters = []
-      current_location = self.get_last_event(E.Arrive_At_Town_Event).town_name
-      for event in reversed(self.events):
-         if isinstance(event, E.Create_Character_Event) and event.town_name == current_location:
-            characters.append(event)
-      return characters
+      return [self.events[p] for p in reversed(self.characters.get(self.get_current_town(), ()))] # type: ignore
@@ -0,0 +1,93 @@
+from functions import Function, Parameter
+
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import json, re
+
+GRAMMAR_FORMATS = ("gbnf", "regex")
+
+# every piece of a grammar is kept as a (gbnf expression, python regex) pair so both formats describe the same language
+Expr = Tuple[str,str]
+
+STRING:    Expr = ('"\\"" [^"\\n]* "\\""', '"[^"\\n]*"')
+INTEGER:   Expr = ('"-"? [0-9]+', '-?[0-9]+')
+PLAN_LINE: Expr = ('[^\\n<]+ "\\n"', '[^\\n<]+\\n')
+
+@dataclass
+class Grammar:
+   rules: Dict[str,str]
+   regex: str
+
+   def gbnf(self) -> str:
+      return "".join(f"{name} ::= {body}\n" for name, body in self.rules.items())
+
+   def matches(self, text:str) -> bool:
+      return re.fullmatch(self.regex, text) is not None
+
+def literal(text:str) -> Expr:
+   return json.dumps(text), re.escape(text)
+
+def sequence(*exprs:Expr) -> Expr:
+   return " ".join(g for g, _ in exprs), "".join(r for _, r in exprs)
+
+def choice(*exprs:Expr) -> Expr:
+   return "(" + " | ".join(g for g, _ in exprs) + ")", "(?:" + "|".join(r for _, r in exprs) + ")"
+
+def optional(expr:Expr) -> Expr:
+   return f"({expr[0]})?", f"(?:{expr[1]})?"
+
+def rule_name(name:str) -> str:
+   return name.replace("_", "-")
+
+def param_value(param:Parameter) -> Expr:
+   if param.dtype is str:
+      return STRING
+   elif param.dtype is int:
+      return INTEGER
+   raise RuntimeError(f"Got Parameter.dtype of '{param.dtype.__name__}' which is not yet supported by param_value()")
+
+# positional arguments only, parameters with defaults may be left off the end
+def arguments(params:List[Parameter]) -> Optional[Expr]:
+   expr: Optional[Expr] = None
+   for i, param in reversed(list(enumerate(params))):
+      value = sequence(literal(", "), param_value(param)) if i > 0 else param_value(param)
+      expr = value if expr is None else sequence(value, expr)
+      if param.default is not None:
+         expr = optional(expr)
+   return expr
+
+def function_call(func:Function) -> Expr:
+   args = arguments(func.params)
+   if args is None:
+      return literal(f"{func.name}()")
+   return sequence(literal(f"{func.name}("), args, literal(")"))
+
+def function_close(func:Function) -> Expr:
+   args = arguments(func.params)
+   if args is None:
+      return literal(")")
+   return sequence(args, literal(")"))
+
+def make_grammar(root:Expr, functions:List[Function]) -> Grammar:
+   rules = { "root": root[0] }
+   for func in functions:
+      rules[rule_name(func.name)] = function_call(func)[0]
+   return Grammar(rules, root[1])
+
+def calls(functions:List[Function]) -> Expr:
+   return choice(*((rule_name(f.name), function_call(f)[1]) for f in functions))
+
+def choose_function_grammar(functions:List[Function]) -> Grammar:
+   return make_grammar(sequence(choice(*(literal(f.name) for f in functions)), optional(literal("()"))), [])
+
+# the evolver has already written out "name(" so only the arguments and closing paren are generated
+def fill_function_grammar(func:Function) -> Grammar:
+   return make_grammar(function_close(func), [])
+
+def call_grammar(functions:List[Function]) -> Grammar:
+   return make_grammar(calls(functions), functions)
+
+def plan_and_call_grammar(functions:List[Function]) -> Grammar:
+   plan_g, plan_r = PLAN_LINE
+   call_g, call_r = calls(functions)
+   return make_grammar((f"({plan_g})* {call_g}", f"(?:{plan_r})*{call_r}"), functions)
@@ -0,0 +1,153 @@
+from common import Event, logger
+import events as E
+from game import Game
+
+from typing import Optional, Dict, List, Callable, Awaitable, Iterable, Tuple
+from dataclasses import dataclass, field
+import asyncio, hashlib, os
+
+# lower runs first, anything tied to the town the player is standing in jumps the queue
+PRIORITY_CURRENT_TOWN = 0
+PRIORITY_OTHER = 1
+
+Generator = Callable[[str],Awaitable[bytes]]
+
+@dataclass
+class Image_Job:
+   key: str
+   kind: str
+   name: str
+   description: str
+   future: "asyncio.Future[str]" = field(repr=False)
+   started: bool = False
+
+class Image_Cache:
+   dirpath: str
+
+   # images are stored one file per description hash under <dirpath>/<key[:2]>/<key>.png so repeated descriptions are only generated once
+   def __init__(self, dirpath:str):
+      self.dirpath = dirpath
+      os.makedirs(dirpath, exist_ok=True)
+
+   @staticmethod
+   def key(description:str) -> str:
+      return hashlib.sha256(description.strip().encode()).hexdigest()
+
+   def path(self, key:str) -> str:
+      return os.path.join(self.dirpath, key[:2], f"{key}.png")
+
+   def get(self, key:str) -> Optional[str]:
+      path = self.path(key)
+      return path if os.path.exists(path) else None
+
+   def put(self, key:str, image:bytes) -> str:
+      path = self.path(key)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path + ".tmp", "wb") as f:
+         f.write(image)
+      os.replace(path + ".tmp", path)
+      return path
+
+def image_requests(game:Game, events:Iterable[Event]) -> List[Tuple[int,str,str,str]]:
+   current_town = game.get_current_town() if game.town is not None else None
+   requests = []
+   for event in events:
+      if isinstance(event, E.Create_New_Town_Event):
+         requests.append((PRIORITY_CURRENT_TOWN if event.name == current_town else PRIORITY_OTHER, "town", event.name, event.description))
+      elif isinstance(event, E.Arrive_At_Town_Event) and event.town_name == current_town:
+         town = game.get_town(event.town_name)
+         if town is not None:
+            requests.append((PRIORITY_CURRENT_TOWN, "town", town.name, town.description))
+      elif isinstance(event, E.Create_Character_Event):
+         requests.append((PRIORITY_CURRENT_TOWN if event.town_name == current_town else PRIORITY_OTHER, "character", event.character_name, event.description))
+   return requests
+
+class Image_Queue:
+   generator: Generator
+   cache: Image_Cache
+   workers: int
+   on_ready: Callable[[Image_Job,str],None]
+   jobs: Dict[str,Image_Job]
+   generated: int
+   failed: int
+
+   # a pool of workers pulls jobs off a priority queue so generation never blocks the turn loop
+   # jobs are deduplicated by description hash, on_ready(job, path) is called as each image finishes
+   def __init__(self, generator:Generator, cache:Image_Cache, workers:int=2, on_ready:Callable[[Image_Job,str],None]=(lambda *_: None)):
+      self.generator = generator
+      self.cache = cache
+      self.workers = workers
+      self.on_ready = on_ready
+      self.jobs = {}
+      self.generated = 0
+      self.failed = 0
+      self._queue: Optional["asyncio.PriorityQueue[Tuple[int,int,Image_Job]]"] = None
+      self._tasks: List[asyncio.Task] = []
+      self._sequence = 0
+
+   def start(self) -> None:
+      if self._queue is None:
+         self._queue = asyncio.PriorityQueue()
+         self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+   def submit(self, kind:str, name:str, description:str, priority:int=PRIORITY_OTHER) -> "asyncio.Future[str]":
+      self.start()
+      assert self._queue is not None
+      key = Image_Cache.key(description)
+      job = self.jobs.get(key)
+      if job is None:
+         job = self.jobs[key] = Image_Job(key, kind, name, description, asyncio.get_running_loop().create_future())
+         path = self.cache.get(key)
+         if path is not None:
+            self._finish(job, path)
+            return job.future
+      elif job.future.done():
+         return job.future
+      # a job resubmitted at a higher priority is queued again, whichever copy is reached first runs it
+      self._sequence += 1
+      self._queue.put_nowait((priority, self._sequence, job))
+      return job.future
+
+   # enqueues images for the towns and characters created by the given events, e.g. the tail of a committed turn
+   def submit_events(self, game:Game, events:Iterable[Event]) -> List["asyncio.Future[str]"]:
+      return [self.submit(kind, name, description, priority) for priority, kind, name, description in image_requests(game, events)]
+
+   def _finish(self, job:Image_Job, path:str) -> None:
+      job.future.set_result(path)
+      try:
+         self.on_ready(job, path)
+      except Exception as ex:
+         logger.error(f"Image on_ready callback failed for '{job.name}': {ex}")
+
+   async def _worker(self) -> None:
+      assert self._queue is not None
+      while True:
+         _, _, job = await self._queue.get()
+         try:
+            if job.started or job.future.done():
+               continue
+            job.started = True
+            image = await self.generator(job.description)
+            self.generated += 1
+            self._finish(job, self.cache.put(job.key, image))
+         except asyncio.CancelledError:
+            raise
+         except Exception as ex:
+            logger.error(f"Image generation failed for {job.kind} '{job.name}': {ex}")
+            self.failed += 1
+            self.jobs.pop(job.key, None)
+            job.future.set_exception(ex)
+            job.future.exception()
+         finally:
+            self._queue.task_done()
+
+   async def join(self) -> None:
+      if self._queue is not None:
+         await self._queue.join()
+
+   async def close(self) -> None:
+      for task in self._tasks:
+         task.cancel()
+      await asyncio.gather(*self._tasks, return_exceptions=True)
+      self._tasks = []
+      self._queue = None
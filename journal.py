@@ -0,0 +1,287 @@
+from common import Event, logger
+import events as E
+from game import Game
+
+from typing import Iterator, BinaryIO, Optional, List, Dict, Any, Tuple
+from itertools import accumulate
+import json, os, time, glob, hashlib
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+class Journal:
+   path: str
+   fsync: str
+   interval: float
+   written: int
+   last_sync: float
+   file: BinaryIO
+
+   snapshot_every: Optional[int]
+   last_snapshot: int
+
+   # appends one JSON line per event, `written` is the number of game events already on disk
+   def __init__(self, path:str, written:int=0, fsync:str="interval", interval:float=1.0, snapshot_every:Optional[int]=None):
+      assert fsync in FSYNC_POLICIES, f"unknown fsync policy '{fsync}', options are {FSYNC_POLICIES}"
+      self.path = path
+      self.fsync = fsync
+      self.interval = interval
+      self.written = written
+      self.last_sync = time.monotonic()
+      self.snapshot_every = snapshot_every
+      self.last_snapshot = written
+      self.file = open(path, "ab")
+      truncate_torn_tail(self.file)
+
+   def write(self, game:Game) -> int:
+      if len(game.events) < self.written:
+         raise RuntimeError(f"game has {len(game.events)} events but the journal already holds {self.written}")
+      lines = [json.dumps(Game.event_to_json(event)).encode() + b"\n" for event in game.events.tail(self.written)]
+      if len(lines) == 0:
+         return 0
+      self.file.write(b"".join(lines))
+      self.file.flush()
+      self.written += len(lines)
+      if self.fsync == "always" or (self.fsync == "interval" and time.monotonic() - self.last_sync >= self.interval):
+         self.sync()
+      if self.snapshot_every is not None and self.written - self.last_snapshot >= self.snapshot_every:
+         self.snapshot(game)
+      return len(lines)
+
+   def snapshot(self, game:Game, keep:int=2) -> str:
+      if game.events.parent is not None:
+         raise RuntimeError("cannot snapshot a forked game, commit it first")
+      if len(game.events) != self.written:
+         raise RuntimeError(f"game has {len(game.events)} events but the journal holds {self.written}, write it before snapshotting")
+      self.sync()
+      # rendered here so a game loaded from the snapshot never reads old journal lines to build its first overview
+      game.get_shared_overview()
+      journal_bytes = self.file.tell()
+      data = {
+         "version": SNAPSHOT_VERSION,
+         "offset": self.written,
+         "journal_bytes": journal_bytes,
+         "last_line": last_line_hash(self.path, journal_bytes),
+         "index": { cls.__name__:positions for cls,positions in game.events.index.items() },
+         "projection": game.get_projection(),
+      }
+      path = snapshot_path(self.path, self.written)
+      with open(path + ".tmp", "w") as f:
+         json.dump(data, f)
+         f.flush()
+         os.fsync(f.fileno())
+      os.replace(path + ".tmp", path)
+      self.last_snapshot = self.written
+      for _, old_path in list_snapshots(self.path)[keep:]:
+         os.remove(old_path)
+      return path
+
+   def sync(self) -> None:
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.last_sync = time.monotonic()
+
+   def close(self) -> None:
+      if self.file.closed:
+         return
+      if self.fsync != "never":
+         self.sync()
+      self.file.close()
+
+   def __enter__(self) -> 'Journal':
+      return self
+   def __exit__(self, *_) -> None:
+      self.close()
+
+def truncate_torn_tail(f:BinaryIO, block_size:int=4096) -> int:
+   end = f.seek(0, os.SEEK_END)
+   with open(f.name, "rb") as reader:
+      position = end
+      while position > 0:
+         start = max(0, position - block_size)
+         reader.seek(start)
+         block = reader.read(position - start)
+         newline = block.rfind(b"\n")
+         if newline >= 0:
+            position = start + newline + 1
+            break
+         position = start
+   if position != end:
+      logger.warning(f"Truncating torn final line ({end - position} bytes) from journal '{f.name}'")
+      f.truncate(position)
+      f.seek(position)
+   return position
+
+def read_journal(path:str, start:int=0) -> Iterator[Event]:
+   with open(path, "rb") as f:
+      f.seek(start)
+      for line in f:
+         try:
+            data = json.loads(line)
+         except ValueError:
+            if line.endswith(b"\n"):
+               raise
+            logger.warning(f"Ignoring torn final line in journal '{path}'")
+            return
+         yield Game.event_from_json(data)
+
+def load_journal(path:str) -> Game:
+   return Game(read_journal(path))
+
+
+
+#################
+### Snapshots ###
+#################
+
+SNAPSHOT_VERSION = 3
+
+def snapshot_path(journal_path:str, offset:int) -> str:
+   return f"{journal_path}.snapshot.{offset}.json"
+
+def list_snapshots(journal_path:str) -> List[Tuple[int,str]]:
+   snapshots = []
+   for path in glob.glob(glob.escape(journal_path) + ".snapshot.*.json"):
+      offset = path[len(journal_path) + len(".snapshot."):-len(".json")]
+      if offset.isdigit():
+         snapshots.append((int(offset), path))
+   return sorted(snapshots, reverse=True)
+
+def last_line_hash(journal_path:str, journal_bytes:int, block_size:int=4096) -> Optional[str]:
+   if journal_bytes == 0:
+      return None
+   with open(journal_path, "rb") as f:
+      start = journal_bytes - 1
+      while start > 0:
+         chunk_start = max(0, start - block_size)
+         f.seek(chunk_start)
+         newline = f.read(start - chunk_start).rfind(b"\n")
+         if newline >= 0:
+            start = chunk_start + newline + 1
+            break
+         start = chunk_start
+      f.seek(start)
+      return hashlib.sha256(f.read(journal_bytes - start)).hexdigest()
+
+class Journal_Prefix:
+   path: str
+   count: int
+   end: int
+   offsets: Optional[List[int]]
+   cache: List[Optional[Event]]
+   extra: List[Event]
+
+   # stands in for Event_Log.entries, decoding the first `count` journal lines only when they are accessed
+   def __init__(self, path:str, count:int, end:int):
+      self.path = path
+      self.count = count
+      self.end = end
+      self.offsets = None
+      self.cache = [None] * count
+      self.extra = []
+
+   def __len__(self) -> int:
+      return self.count + len(self.extra)
+
+   def append(self, event:Event) -> None:
+      self.extra.append(event)
+
+   def _load_offsets(self) -> List[int]:
+      if self.offsets is None:
+         with open(self.path, "rb") as f:
+            data = f.read(self.end)
+         offsets = [0] + list(accumulate(len(line) + 1 for line in data.split(b"\n")[:-1]))
+         assert len(offsets) == self.count + 1, f"journal prefix holds {len(offsets) - 1} lines, expected {self.count}"
+         self.offsets = offsets
+      return self.offsets
+
+   def __getitem__(self, i:int) -> Event:
+      if i < 0:
+         i += len(self)
+      if i >= self.count:
+         return self.extra[i - self.count]
+      event = self.cache[i]
+      if event is None:
+         offsets = self._load_offsets()
+         with open(self.path, "rb") as f:
+            f.seek(offsets[i])
+            event = Game.event_from_json(json.loads(f.read(offsets[i+1] - offsets[i])))
+         self.cache[i] = event
+      return event
+
+   def __iter__(self) -> Iterator[Event]:
+      return self.iter_range(0, len(self))
+
+   # sequential reads open the journal once and stream lines from the first uncached event, filling the cache as they go
+   def iter_range(self, start:int, stop:int) -> Iterator[Event]:
+      position = start
+      prefix_stop = min(stop, self.count)
+      while position < prefix_stop and self.cache[position] is not None:
+         yield self.cache[position] # type: ignore
+         position += 1
+      if position < prefix_stop:
+         offsets = self._load_offsets()
+         with open(self.path, "rb") as f:
+            f.seek(offsets[position])
+            while position < prefix_stop:
+               line = f.readline()
+               event = self.cache[position]
+               if event is None:
+                  event = self.cache[position] = Game.event_from_json(json.loads(line))
+               yield event
+               position += 1
+      yield from self.extra[max(0, start - self.count):max(0, stop - self.count)]
+
+   def select(self, indices:List[int]) -> Iterator[Event]:
+      missing = [i for i in indices if i < self.count and self.cache[i] is None]
+      if len(missing) > 0:
+         offsets = self._load_offsets()
+         with open(self.path, "rb") as f:
+            for i in missing:
+               f.seek(offsets[i])
+               self.cache[i] = Game.event_from_json(json.loads(f.read(offsets[i+1] - offsets[i])))
+      for i in indices:
+         yield self[i]
+
+def read_snapshot(journal_path:str, snapshot_filepath:str) -> Optional[Dict[str,Any]]:
+   try:
+      with open(snapshot_filepath, "r") as f:
+         data = json.load(f)
+      if data.get("version") != SNAPSHOT_VERSION:
+         raise ValueError(f"unsupported snapshot version {data.get('version')}")
+      if os.path.getsize(journal_path) < data["journal_bytes"]:
+         raise ValueError(f"journal is shorter than the {data['journal_bytes']} bytes the snapshot covers")
+      if last_line_hash(journal_path, data["journal_bytes"]) != data["last_line"]:
+         raise ValueError("journal does not match the last line the snapshot covers")
+      return data
+   except (OSError, ValueError, KeyError) as ex:
+      logger.warning(f"Skipping invalid snapshot '{snapshot_filepath}': {ex}")
+      return None
+
+def load_game(journal_path:str, verify:bool=False) -> Game:
+   for _, snapshot_filepath in list_snapshots(journal_path):
+      data = read_snapshot(journal_path, snapshot_filepath)
+      if data is None:
+         continue
+      game = Game()
+      game.events.entries = Journal_Prefix(journal_path, data["offset"], data["journal_bytes"]) # type: ignore
+      game.events.index = { E.event_dictionary[name]:positions for name,positions in data["index"].items() }
+      game.set_projection(data["projection"])
+      game.replay(read_journal(journal_path, data["journal_bytes"]))
+      if verify and not matches_full_replay(game, journal_path):
+         logger.error(f"Game loaded from snapshot '{snapshot_filepath}' does not match a full replay, using the full replay")
+         return load_journal(journal_path)
+      return game
+   return load_journal(journal_path)
+
+def matches_full_replay(game:Game, journal_path:str) -> bool:
+   full = load_journal(journal_path)
+   projection, full_projection = game.get_projection(), full.get_projection()
+   overview = projection.pop("overview")
+   full_projection.pop("overview")
+   projection.pop("overview_shared")
+   full_projection.pop("overview_shared")
+   return len(full.events) == len(game.events) \
+      and full_projection == projection \
+      and full.events.index == game.events.index \
+      and all(full.get_overview(town) == game.get_overview(town) for town in overview) \
+      and full.to_json() == game.to_json()
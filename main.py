@@ -1,42 +1,137 @@
 from common import State, logger, LOG_FORMAT
-from prompts import Template, make_intro_prompt
+from prompts import Template, make_intro_prompt, summarize_history
 from evolver import Prompt_Evolver, Micro_State
+from functions import Quoted_Text_Stream
 import events as E
 from game import Game
+from journal import Journal
+from completion import Completion_Client, Completion_Failed, Deadline, run_sync, run_on_sync_loop, run_in_background
+from grammar import Grammar
+from prompt_budget import Prompt_Budget
+from completion_log import Completion_Log
+from images import Image_Queue, Image_Job, Image_Cache, Generator
+import completion
 
-from typing import Tuple, Callable, Optional, List, Dict
-import logging, os, datetime, json
-from openai import OpenAI
+from typing import Tuple, Callable, Optional, List, Dict, Awaitable
+import logging, os, datetime, json, asyncio, concurrent.futures
 
-def get_prompt_from_game_state(game:Game) -> Tuple[str,State]:
+# sections maps template keys to replacement text, e.g. compacted sections from a Prompt_Budget
+def get_prompt_from_game_state(game:Game, sections:Optional[Dict[str,str]]=None) -> Tuple[str,State]:
    current_state = game.get_current_state()
    template = Template(make_intro_prompt(current_state))
    template["OVERVIEW"] = game.get_overview()
    template["QUESTS"] = "".join(f'"{e.quest_name}": {e.quest_description}\n' for e in game.get_active_quests())
 
    if current_state == State.TOWN_IDLE:
-      template["PLAYER_INPUT"] = game.get_last_event(E.Player_Input_Event).text + "\n"
+      template["PLAYER_INPUT"] = get_player_line(game)
       template["CHARACTERS"] = "".join(f"'{e.character_name}': {e.background}\n" for e in game.get_characters())
 
    elif current_state == State.TOWN_TALK:
       speak_target = game.get_last_event(E.Start_Conversation_Event).character_name
       template["NPC_NAME"] = speak_target
-      template["NPC_DESCRIPTION"] = game.get_last_event(E.Create_Character_Event, limit_fnx=(lambda e: e.character_name == speak_target)).description
-      template["CONVERSATION"] = "".join(e.render()+"\n" for e in game.get_conversation_history(speak_target))
+      template["NPC_DESCRIPTION"] = game.get_character(speak_target).description
+      template["CONVERSATION"] = game.get_conversation(speak_target)
 
    elif current_state == State.ON_THE_MOVE:
       template["TRAVEL_GOAL"] = game.get_last_event(E.Begin_Traveling_Event).travel_goal
 
    else:
       raise ValueError(f"game_loop() does not support {current_state.value} state yet")
-   
+
+   if sections is not None:
+      for key, value in sections.items():
+         template[key] = value
    return template.render(), current_state
 
-def process_game_state(game:Game, output_from_prompt:Callable[[str],Optional[str]], decision_log:List[Dict], max_errors:int=3, max_loops:int=3) -> Optional[Game]:
+# the only line of the intro prompt that depends on the player's latest input
+def get_player_line(game:Game) -> str:
+   current_state = game.get_current_state()
+   if current_state == State.TOWN_IDLE:
+      return game.get_last_event(E.Player_Input_Event).text + "\n"
+   elif current_state == State.TOWN_TALK:
+      return game.get_last_event(E.Speak_Event).render() + "\n"
+   return ""
+
+SPECULATION_SENTINEL = "\x00PLAYER_INPUT\x00"
+
+class Speculative_Prompt:
+   state: State
+   event_count: int
+   sentinel_line: str
+   sections: Optional[Dict[str,str]]
+   prefix: str
+   suffix: str
+
+   # the intro prompt rendered before the player's input arrives, split around the line that input will fill
+   # only valid for the game it was made from plus exactly one player event that keeps the state the same
+   def __init__(self, state:State, event_count:int, sentinel_line:str, sections:Optional[Dict[str,str]], prefix:str, suffix:str):
+      self.state = state
+      self.event_count = event_count
+      self.sentinel_line = sentinel_line
+      self.sections = sections
+      self.prefix = prefix
+      self.suffix = suffix
+
+   def render(self, game:Game, sections:Optional[Dict[str,str]]=None) -> Optional[str]:
+      if len(game.events) != self.event_count + 1 or game.get_current_state() != self.state:
+         return None
+      if not isinstance(game.events[-1], (E.Player_Input_Event, E.Speak_Event)):
+         return None
+      line = get_player_line(game)
+      expected = None if self.sections is None else { k: v.replace(self.sentinel_line, line) for k, v in self.sections.items() }
+      if sections != expected:
+         return None
+      return self.prefix + line + self.suffix
+
+async def speculate_prompt(game:Game, prompt_budget:Optional[Prompt_Budget]=None) -> Optional[Speculative_Prompt]:
+   fork = game.copy()
+   add_player_input(fork, SPECULATION_SENTINEL, [])
+   sections = None if prompt_budget is None else await prompt_budget.compact(fork)
+   prompt, state = get_prompt_from_game_state(fork, sections)
+   line = get_player_line(fork)
+   if line == "":
+      prefix, suffix = prompt, ""
+   elif prompt.count(line) == 1:
+      prefix, suffix = prompt.split(line)
+   else:
+      return None
+   if SPECULATION_SENTINEL in prefix or SPECULATION_SENTINEL in suffix:
+      return None
+   return Speculative_Prompt(state, len(game.events), line, sections, prefix, suffix)
+
+async def get_budgeted_prompt(game:Game, prompt_budget:Optional[Prompt_Budget], speculation:Optional[Speculative_Prompt]=None, deadline:Optional[Deadline]=None) -> Tuple[str,State]:
+   sections = None if prompt_budget is None else await prompt_budget.compact(game, deadline)
+   if speculation is not None:
+      prompt = speculation.render(game, sections)
+      if prompt is not None:
+         return prompt, speculation.state
+   return get_prompt_from_game_state(game, sections)
+
+def process_game_state(game:Game, output_from_prompt:Callable[...,Optional[str]], decision_log:List[Dict], max_errors:int=3, max_loops:int=3, fused:bool=False,
+                       stream_from_prompt:Optional[Callable[...,Optional[str]]]=None, on_player_text:Callable[[str],None]=(lambda _: None), use_grammar:bool=False,
+                       budget:Optional[float]=None, prompt_budget:Optional[Prompt_Budget]=None, speculation:Optional[Speculative_Prompt]=None) -> Optional[Game]:
+   async def async_output_from_prompt(prompt:str, **kwargs) -> Optional[str]:
+      return output_from_prompt(prompt, **kwargs)
+   async_stream_from_prompt = None
+   if stream_from_prompt is not None:
+      sync_stream_from_prompt = stream_from_prompt
+      async def async_stream_from_prompt(prompt:str, on_delta:Callable[[str],None], **kwargs) -> Optional[str]:
+         return sync_stream_from_prompt(prompt, on_delta, **kwargs)
+   return asyncio.run(process_game_state_async(game, async_output_from_prompt, decision_log, max_errors, max_loops, fused, async_stream_from_prompt, on_player_text, use_grammar, budget, prompt_budget, speculation))
+
+# when stream_from_prompt is given, player-facing text of streamed functions is passed to on_player_text as it is generated
+# when use_grammar is set, the evolver's grammar for the next output is passed to the completion callbacks as the `grammar` keyword
+# when budget is set, the turn's Deadline is passed to the completion callbacks as the `deadline` keyword and the turn fails once it runs out
+# when prompt_budget is set, sections of the intro prompt over their token budget are compacted into rolling summaries
+# a speculation made by speculate_prompt() before the player's input was added is used for the first intro prompt when it still applies
+async def process_game_state_async(game:Game, output_from_prompt:Callable[...,Awaitable[Optional[str]]], decision_log:List[Dict], max_errors:int=3, max_loops:int=3, fused:bool=False,
+                                   stream_from_prompt:Optional[Callable[...,Awaitable[Optional[str]]]]=None, on_player_text:Callable[[str],None]=(lambda _: None), use_grammar:bool=False,
+                                   budget:Optional[float]=None, prompt_budget:Optional[Prompt_Budget]=None, speculation:Optional[Speculative_Prompt]=None) -> Optional[Game]:
+   deadline = None if budget is None else Deadline(budget)
    delta_game = game.copy()
-   prompt, current_state = get_prompt_from_game_state(delta_game)
+   prompt, current_state = await get_budgeted_prompt(delta_game, prompt_budget, speculation, deadline)
    decision_log.append({"event":"Got Initial Prompt", "prompt":prompt.split("\n")})
-   evolver = Prompt_Evolver(current_state)
+   evolver = Prompt_Evolver(current_state, fused)
    curr_errors = 0
    curr_loops = 0
 
@@ -46,6 +141,11 @@ def process_game_state(game:Game, output_from_prompt:Callable[[str],Optional[str
          decision_log.append({"event":f"Reached Max Errors ({max_errors}), Exiting"})
          return None
 
+      if deadline is not None and deadline.expired():
+         logger.error("Reached Latency Budget")
+         decision_log.append({"event":f"Reached Latency Budget ({budget}s), Exiting"})
+         return None
+
       if evolver.micro_state == Micro_State.DONE:
          if not evolver.can_loop()[0]:
             break
@@ -55,13 +155,32 @@ def process_game_state(game:Game, output_from_prompt:Callable[[str],Optional[str
             return None
          curr_loops += 1
          evolver.loop()
-         prompt, current_state = get_prompt_from_game_state(delta_game)
+         prompt, current_state = await get_budgeted_prompt(delta_game, prompt_budget, deadline=deadline)
          decision_log.append({"event":"Looping Evolver", "prompt":prompt.split("\n")})
 
       ext = evolver.get_extension()
       decision_log.append({"event":"Got Extension", "extension":ext.split("\n"), "micro_state":evolver.micro_state.value})
+      kwargs: Dict = { "grammar":evolver.get_grammar() } if use_grammar else {}
+      if deadline is not None:
+         kwargs["deadline"] = deadline
 
-      output = output_from_prompt(f"{prompt}\n\n{ext}")
+      try:
+         if stream_from_prompt is not None and evolver.should_stream():
+            text_stream = Quoted_Text_Stream()
+            def on_delta(delta:str) -> None:
+               text = text_stream.feed(delta)
+               if text:
+                  on_player_text(text)
+            output = await stream_from_prompt(f"{prompt}\n\n{ext}", on_delta, **kwargs)
+            if text_stream.started:
+               on_player_text("\n")
+         else:
+            output = await output_from_prompt(f"{prompt}\n\n{ext}", **kwargs)
+      except Completion_Failed as ex:
+         logger.error(str(ex))
+         decision_log.append({"event":"ERROR: Completion Failed", "message":str(ex)})
+         curr_errors += 1
+         continue
       assert output is not None, f"Ran out of outputs before completing evolver"
       ok, msg = evolver.process_output(output)
       if not ok:
@@ -70,6 +189,8 @@ def process_game_state(game:Game, output_from_prompt:Callable[[str],Optional[str
          curr_errors += 1
          continue
       decision_log.append({"event":"Processed Output OK", "output":output.split("\n"), "micro_state":evolver.micro_state.value})
+      if msg:
+         decision_log[-1]["message"] = msg
       if evolver.should_call():
          ok, msg = evolver.call(delta_game)
          if not ok:
@@ -82,99 +203,131 @@ def process_game_state(game:Game, output_from_prompt:Callable[[str],Optional[str
 
    return delta_game
 
-json_log = None
-client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
-def make_completion(prompt:str):
-   global client, json_log
-
-   completion = client.chat.completions.create(
-      model="lmstudio-community/Meta-Llama-3.1-8B-Instruct-GGUF",
-      messages=[
-         { "role":"system", "content":prompt },
-      ],
-      temperature=0.8,
-      max_tokens=256,
-      stop=["</", "<|"],
-   )
-
-   resp = completion.choices[0].message.content
-   assert resp is not None
-   resp = resp.strip()
-
-   if json_log is not None:
-      if os.path.exists(json_log):
-         with open(json_log) as f:
-            data = json.load(f)
+client = Completion_Client()
+def make_completion(prompt:str, variant:int=0, grammar:Optional[Grammar]=None, deadline:Optional[Deadline]=None) -> str:
+   return run_sync(client.complete(prompt, variant=variant, grammar=grammar, deadline=deadline))
+def stream_completion(prompt:str, on_delta:Callable[[str],None], grammar:Optional[Grammar]=None, deadline:Optional[Deadline]=None) -> str:
+   return run_sync(client.stream(prompt, on_delta, grammar=grammar, deadline=deadline))
+def print_streamed(text:str) -> None:
+   print(text, end="", flush=True)
+
+# builds the summarize callback of a Prompt_Budget, keywords such as `deadline` are passed through to complete
+def make_summarizer(complete:Callable[...,Awaitable[str]]) -> Callable[...,Awaitable[str]]:
+   async def summarize(section:str, previous:str, content:str, **kwargs) -> str:
+      template = Template(summarize_history)
+      template["SECTION"] = section.lower()
+      template["PREVIOUS"] = previous
+      template["CONTENT"] = content
+      return await complete(template.render(), **kwargs)
+   return summarize
+
+summarize_with_llm = make_summarizer(lambda prompt, **kwargs: run_on_sync_loop(client.complete(prompt, **kwargs)))
+prompt_budget = Prompt_Budget(summarize_with_llm)
+
+def new_game() -> Game:
+   game = Game()
+   game.add_event(E.Create_New_Town_Event("Whisperwind Village", "a small village nestled between two large hills with a quaint main street lined with shops and houses", ""))
+   game.add_event(E.Arrive_At_Town_Event("Whisperwind Village"))
+   return game
+
+def awaiting_player(game:Game) -> bool:
+   current_state = game.get_current_state()
+   if current_state in { State.TOWN_IDLE, State.ON_THE_MOVE }:
+      return not isinstance(game.events[-1], E.Player_Input_Event)
+   elif current_state == State.TOWN_TALK:
+      last_speech = game.get_last_speech(game.get_last_event(E.Start_Conversation_Event).character_name)
+      return last_speech is not None and not last_speech.is_player_speaking
+   raise ValueError(f"game_loop() does not support {current_state} state yet")
+
+def input_prompt(game:Game) -> str:
+   return "How do you respond or [leave]? " if game.get_current_state() == State.TOWN_TALK else "Response? "
+
+def add_player_input(game:Game, text:str, decision_log:List[Dict]) -> None:
+   if game.get_current_state() == State.TOWN_TALK:
+      if text.lower() == "leave":
+         decision_log.append({"event":"User chose to end conversation"})
+         game.add_event(E.End_Converstation_Event())
       else:
-         data = { "queries": [] }
-      data["queries"].append({
-         "prompt":   prompt.strip().split("\n"),
-         "response": resp  .strip().split("\n"),
-      })
-      with open(json_log, "w") as f:
-         json.dump(data, f, indent="\t")
+         decision_log.append({"event":"Got player response", "text":text})
+         game.add_event(E.Speak_Event(game.get_last_event(E.Start_Conversation_Event).character_name, True, text))
+   else:
+      decision_log.append({"event":"Got player input", "text":text})
+      game.add_event(E.Player_Input_Event(text))
+
+def warm_speculation(future:"concurrent.futures.Future[Optional[Speculative_Prompt]]") -> None:
+   if not future.cancelled() and future.exception() is None and (speculation := future.result()) is not None:
+      run_in_background(client.warm(speculation.prefix))
+
+# a speculation still rendering when the player answers is dropped rather than waited on
+def collect_speculation(future:"concurrent.futures.Future[Optional[Speculative_Prompt]]") -> Optional[Speculative_Prompt]:
+   if not future.done():
+      future.cancel()
+      return None
+   if future.cancelled():
+      return None
+   if (ex := future.exception()) is not None:
+      logger.warning(f"Prompt speculation failed: {ex}")
+      return None
+   return future.result()
 
-   return resp.split("<")[0].strip()
+async def submit_images(image_queue:Image_Queue, game:Game, start:int) -> int:
+   image_queue.submit_events(game, game.events.tail(start))
+   return len(game.events)
 
-def game_loop(game:Game, log_dirpath:str):
+def print_image_ready(job:Image_Job, path:str) -> None:
+   print(f"\n[image ready] {job.kind} '{job.name}': {path}", flush=True)
+
+# when image_queue is given, towns and characters are sent off for txt2img as their events are committed
+# set to a txt2img callback (description -> png bytes) to have towns and characters drawn while playing
+image_generator: Optional[Generator] = None
+
+def game_loop(game:Game, log_dirpath:str, fsync:str="interval", snapshot_every:Optional[int]=1000, fused:bool=False, turn_budget:Optional[float]=300.0, image_queue:Optional[Image_Queue]=None):
    decision_log = []
+   journal = Journal(f"{log_dirpath}/game.jsonl", fsync=fsync, snapshot_every=snapshot_every)
+   prompt_budget.persist(f"{log_dirpath}/summaries.jsonl")
+   speculation: Optional[Speculative_Prompt] = None
+   imaged = 0
    while True:
+      if image_queue is not None:
+         imaged = run_sync(submit_images(image_queue, game, imaged))
       current_state = game.get_current_state()
 
-      if current_state in { State.TOWN_IDLE, State.ON_THE_MOVE }:
-         if isinstance(game.events[-1], E.Player_Input_Event):
-            decision_log.append({"event":f"Processing {current_state.value} State", "message":"Requesting LLM completion"})
-            new_game = process_game_state(game, make_completion, decision_log)
-            if new_game is not None:
-               game = new_game
+      if not awaiting_player(game):
+         decision_log.append({"event":f"Processing {current_state.value} State", "message":"Requesting LLM completion"})
+         new_game = process_game_state(game, make_completion, decision_log, fused=fused, stream_from_prompt=stream_completion, on_player_text=print_streamed, use_grammar=client.grammar_format is not None, budget=turn_budget, prompt_budget=prompt_budget, speculation=speculation)
+         speculation = None
+         if new_game is not None:
+            new_game.commit()
+      else:
+         if current_state == State.TOWN_TALK:
+            decision_log.append({"event":f"Processing {current_state.value} State", "message":"Requesting player response"})
+            speak_target = game.get_last_event(E.Start_Conversation_Event).character_name
+            print("="*40 + "".join("\n" + c.player() for c in game.get_conversation_history(speak_target)))
          else:
             decision_log.append({"event":f"Processing {current_state.value} State", "message":"Requesting player input"})
             print("="*40 + "".join("\n" + e.player() for e in game.events))
-            text = ""
-            while not text:
-               text = input("Response? ").strip()
-            decision_log.append({"event":"Got player input", "text":text})
-            game.add_event(E.Player_Input_Event(text))
-
-      elif current_state == State.TOWN_TALK:
-         speak_target = game.get_last_event(E.Start_Conversation_Event).character_name
-         conv_history = game.get_conversation_history(speak_target)
-         if len(conv_history) == 0 or conv_history[-1].is_player_speaking:
-            decision_log.append({"event":f"Processing {current_state.value} State", "message":"Requesting LLM completion"})
-            new_game = process_game_state(game, make_completion, decision_log)
-            if new_game is not None:
-               game = new_game
-         else:
-            decision_log.append({"event":f"Processing {current_state.value} State", "message":"Requesting player response"})
-            print("="*40 + "".join("\n" + c.player() for c in conv_history))
-            text = ""
-            while not text:
-               text = input("How do you respond or [leave]? ").strip()
-            if text.lower() == "leave":
-               decision_log.append({"event":"User chose to end conversation"})
-               game.add_event(E.End_Converstation_Event())
-            else:
-               decision_log.append({"event":"Got player response", "text":text})
-               game.add_event(E.Speak_Event(speak_target, True, text))
-
-      else:
-         raise ValueError(f"game_loop() does not support {current_state} state yet")
+         # render and warm everything but the player's line while they are typing, the fork keeps the background thread off the live game
+         pending = run_in_background(speculate_prompt(game.copy(), prompt_budget))
+         pending.add_done_callback(warm_speculation)
+         text = ""
+         while not text:
+            text = input(input_prompt(game)).strip()
+         speculation = collect_speculation(pending)
+         add_player_input(game, text, decision_log)
 
       with open(f"{log_dirpath}/decision_log.json", "w") as f: json.dump(decision_log,   f, indent="\t")
-      with open(f"{log_dirpath}/game.json",         "w") as f: json.dump(game.to_json(), f, indent="\t")
+      journal.write(game)
 
 if __name__ == "__main__":
    FOLDER_DIR = datetime.datetime.now().strftime("logs/game/%m-%d-%Y_%H-%M-%S")
    if not os.path.exists(FOLDER_DIR):
       os.makedirs(FOLDER_DIR)
-   json_log = f"{FOLDER_DIR}/prompts.json"
+   completion.json_log = Completion_Log(f"{FOLDER_DIR}/prompts.jsonl")
 
    file = logging.FileHandler(f"{FOLDER_DIR}/debug.log")
    file.setLevel(logging.DEBUG)
    file.setFormatter(LOG_FORMAT)
    logger.addHandler(file)
 
-   game = Game()
-   game.add_event(E.Create_New_Town_Event("Whisperwind Village", "a small village nestled between two large hills with a quaint main street lined with shops and houses", ""))
-   game.add_event(E.Arrive_At_Town_Event("Whisperwind Village"))
-   game_loop(game, FOLDER_DIR)
+   image_queue = None if image_generator is None else Image_Queue(image_generator, Image_Cache("logs/images"), on_ready=print_image_ready)
+   game_loop(new_game(), FOLDER_DIR, image_queue=image_queue)
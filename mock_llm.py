@@ -0,0 +1,190 @@
+from common import State, logger
+import events as E
+from game import Game
+from stream import load_json_game
+from evolver import Prompt_Evolver, Micro_State
+from prompts import ask_for_scratchpad, ask_for_function_call, update_scratchpad, ask_for_plan_and_call, summarize_history
+
+from typing import Dict, List, Tuple, Optional
+import asyncio, json, random, re, time, argparse, os
+
+STATE_PATTERN = re.compile(r'The character is currently in the ([A-Z_]+) state\.')
+SUMMARY_TAIL = summarize_history.split("%%CONTENT%%")[1]
+
+# (state, micro state, selected function) -> outputs seen for that step
+Script = Dict[Tuple[str,str,str],List[str]]
+
+# when the scenario's game is given the calls are made on a copy of it, so an output after a failed call is filed under the retried step
+def script_from_injects(state:State, injects:Dict[str,List[str]], fused:bool=False, script:Optional[Script]=None, game:Optional[Game]=None) -> Script:
+   script = {} if script is None else script
+   for outputs in injects.values():
+      evolver = Prompt_Evolver(state, fused)
+      delta_game = None if game is None else game.copy()
+      for output in outputs:
+         if evolver.micro_state == Micro_State.DONE:
+            if not evolver.can_loop()[0]:
+               break
+            evolver.loop()
+         function = evolver.selected_function.name if evolver.micro_state == Micro_State.FILL_FUNCTION else ""
+         script.setdefault((state.value, evolver.micro_state.value, function), []).append(output)
+         if not evolver.process_output(output)[0]:
+            break
+         if delta_game is not None and evolver.should_call() and not evolver.call(delta_game)[0]:
+            evolver.revert()
+   return script
+
+def load_script(names:List[str]=["town_talk", "town_idle", "on_the_move"], dirpath:str="test/inputs") -> Script:
+   script: Script = {}
+   for name in names:
+      state = State(name.upper())
+      game = load_json_game(f"{dirpath}/{name}_events.json") if os.path.exists(f"{dirpath}/{name}_events.json") else None
+      for fused in (False, True):
+         try:
+            with open(f"{dirpath}/{name}{'_fused' if fused else ''}_injects.json") as f:
+               script_from_injects(state, json.load(f), fused, script, game)
+         except FileNotFoundError:
+            pass
+   return script
+
+def classify_prompt(prompt:str) -> Tuple[str,str,str]:
+   match = STATE_PATTERN.search(prompt)
+   state = match.group(1) if match else ""
+   if prompt.endswith(SUMMARY_TAIL):
+      return state, "SUMMARY", ""
+   if prompt.endswith(update_scratchpad):
+      return state, Micro_State.UPDATE_SCRATCHPAD.value, ""
+   if prompt.endswith(ask_for_plan_and_call):
+      return state, Micro_State.FUSED.value, ""
+   if prompt.endswith(ask_for_scratchpad):
+      return state, Micro_State.CREATE_SCRATCHPAD.value, ""
+   if prompt.endswith(ask_for_function_call):
+      return state, Micro_State.CHOOSE_FUNCTION.value, ""
+   if prompt.endswith("("):
+      return state, Micro_State.FILL_FUNCTION.value, prompt.rsplit("\n", 1)[-1][:-1]
+   return state, "", ""
+
+class Mock_LLM:
+   script: Script
+   latency: float
+   latency_sigma: float
+   error_rate: float
+   hang_rate: float
+   hang_seconds: float
+   chunk_size: int
+   rng: random.Random
+   requests: int
+   errors: int
+   unscripted: int
+
+   # replies to chat completions with outputs scripted from the inject files, picked by the state and micro state the prompt asks for
+   # latency is lognormal around the given median, error_rate requests get a 500 and hang_rate requests stall for hang_seconds
+   def __init__(self, script:Script, latency:float=0.05, latency_sigma:float=0.5, error_rate:float=0.0, hang_rate:float=0.0, hang_seconds:float=30.0, chunk_size:int=8, seed:int=0):
+      self.script = script
+      self.latency = latency
+      self.latency_sigma = latency_sigma
+      self.error_rate = error_rate
+      self.hang_rate = hang_rate
+      self.hang_seconds = hang_seconds
+      self.chunk_size = chunk_size
+      self.rng = random.Random(seed)
+      self.requests = 0
+      self.errors = 0
+      self.unscripted = 0
+
+   def reply(self, prompt:str) -> str:
+      state, micro_state, function = classify_prompt(prompt)
+      if micro_state == "SUMMARY":
+         return "The player has been exploring Iosla."
+      outputs = self.script.get((state, micro_state, function))
+      if not outputs:
+         self.unscripted += 1
+         return ""
+      return self.rng.choice(outputs)
+
+   def sample_latency(self) -> float:
+      if self.latency <= 0:
+         return 0.0
+      return self.rng.lognormvariate(0.0, self.latency_sigma) * self.latency
+
+   async def respond(self, writer:asyncio.StreamWriter, status:str, body:bytes) -> None:
+      writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+      await writer.drain()
+
+   async def completion(self, writer:asyncio.StreamWriter, request:Dict) -> None:
+      self.requests += 1
+      roll = self.rng.random()
+      if roll < self.hang_rate:
+         await asyncio.sleep(self.hang_seconds)
+      await asyncio.sleep(self.sample_latency())
+      if roll >= 1.0 - self.error_rate:
+         self.errors += 1
+         await self.respond(writer, "500 Internal Server Error", json.dumps({"error":{"message":"mock error", "type":"server_error"}}).encode())
+         return
+
+      content = self.reply(request["messages"][-1]["content"])
+      if not request.get("stream"):
+         await self.respond(writer, "200 OK", json.dumps({
+            "id":"mock", "object":"chat.completion", "created":int(time.time()), "model":request.get("model", "mock"),
+            "choices":[{ "index":0, "finish_reason":"stop", "message":{ "role":"assistant", "content":content } }],
+         }).encode())
+         return
+
+      writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+      def chunk(data:str) -> bytes:
+         return f"{len(data.encode()):x}\r\n{data}\r\n".encode()
+      for i in range(0, len(content), self.chunk_size):
+         writer.write(chunk("data: " + json.dumps({
+            "id":"mock", "object":"chat.completion.chunk", "created":int(time.time()), "model":request.get("model", "mock"),
+            "choices":[{ "index":0, "finish_reason":None, "delta":{ "content":content[i:i+self.chunk_size] } }],
+         }) + "\n\n"))
+         await writer.drain()
+      writer.write(chunk("data: [DONE]\n\n") + b"0\r\n\r\n")
+      await writer.drain()
+
+   async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+      try:
+         while True:
+            request_line = await reader.readline()
+            if not request_line:
+               break
+            method, path, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while (line := (await reader.readline()).decode().strip()):
+               key, value = line.split(":", 1)
+               headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", "0")))
+            if method == "POST" and path.endswith("/chat/completions"):
+               await self.completion(writer, json.loads(body))
+            elif method == "GET" and path.endswith("/models"):
+               await self.respond(writer, "200 OK", json.dumps({"object":"list", "data":[{"id":"mock", "object":"model"}]}).encode())
+            else:
+               await self.respond(writer, "404 Not Found", b"{}")
+      except (ConnectionError, asyncio.IncompleteReadError):
+         pass
+      finally:
+         writer.close()
+
+   async def serve(self, host:str="127.0.0.1", port:int=1234) -> asyncio.AbstractServer:
+      return await asyncio.start_server(self.handle, host, port)
+
+async def run_mock(host:str, port:int, mock:Mock_LLM) -> None:
+   server = await mock.serve(host, port)
+   logger.info(f"Mock LLM listening on http://{host}:{port}/v1 with {sum(len(v) for v in mock.script.values())} scripted outputs")
+   async with server:
+      await server.serve_forever()
+
+# point the game at it with LLM_BASE_URL=http://127.0.0.1:1234/v1
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--host', type=str, default="127.0.0.1")
+   parser.add_argument('--port', type=int, default=1234)
+   parser.add_argument('--latency-ms', type=float, default=50.0, help="median latency of a completion")
+   parser.add_argument('--latency-sigma', type=float, default=0.5, help="spread of the lognormal latency distribution")
+   parser.add_argument('--error-rate', type=float, default=0.0)
+   parser.add_argument('--hang-rate', type=float, default=0.0)
+   parser.add_argument('--hang-seconds', type=float, default=30.0)
+   parser.add_argument('--seed', type=int, default=0)
+   args = parser.parse_args()
+
+   mock = Mock_LLM(load_script(), args.latency_ms / 1000, args.latency_sigma, args.error_rate, args.hang_rate, args.hang_seconds, seed=args.seed)
+   asyncio.run(run_mock(args.host, args.port, mock))
@@ -0,0 +1,156 @@
+from common import State, logger
+import events as E
+from game import Game
+from completion import Completion_Failed, Deadline
+
+from typing import Dict, List, Optional, Callable, Awaitable, Tuple
+from bisect import bisect_left
+import asyncio, hashlib, heapq, json, os
+
+# rough count for llama style tokenizers on english text, good enough to keep sections under a budget
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text:str) -> int:
+   return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+DEFAULT_SECTION_BUDGETS = {
+   "OVERVIEW":     1500,
+   "CONVERSATION": 1000,
+}
+
+class Prompt_Budget:
+   summarize: Callable[...,Awaitable[str]]
+   section_budgets: Dict[str,int]
+   chunk_lines: int
+   summary_tokens: int
+   summaries: Dict[str,str]
+   summarize_calls: int
+   path: Optional[str]
+
+   # sections over budget keep their newest lines verbatim, older lines are folded chunk_lines at a time into a rolling summary
+   # summarize(section, previous_summary, lines) returns the new summary, each chunk is only ever summarized once
+   # when a turn has a deadline it is passed to summarize as the `deadline` keyword, and summaries are appended to `path` to survive restarts
+   def __init__(self, summarize:Callable[...,Awaitable[str]], section_budgets:Optional[Dict[str,int]]=None, chunk_lines:int=8, summary_tokens:int=256, path:Optional[str]=None):
+      self.summarize = summarize
+      self.section_budgets = DEFAULT_SECTION_BUDGETS.copy() if section_budgets is None else section_budgets
+      self.chunk_lines = chunk_lines
+      self.summary_tokens = summary_tokens
+      self.summaries = {}
+      self._pending: Dict[str,"asyncio.Future[str]"] = {}
+      self.summarize_calls = 0
+      self.path = None
+      if path is not None:
+         self.persist(path)
+
+   # loads the summaries already stored at path (one JSON line per summary) and appends new ones there
+   def persist(self, path:str) -> None:
+      if os.path.exists(path):
+         with open(path, "rb") as f:
+            for line in f:
+               try:
+                  entry = json.loads(line)
+                  self.summaries[entry["key"]] = entry["summary"]
+               except (ValueError, KeyError):
+                  logger.warning(f"Ignoring unreadable summary line in '{path}'")
+      self.path = path
+
+   def _store(self, key:str, summary:str) -> None:
+      self.summaries[key] = summary
+      if self.path is not None:
+         with open(self.path, "a") as f:
+            f.write(json.dumps({ "key":key, "summary":summary }) + "\n")
+
+   def find_cut(self, lines:List[str], budget:int) -> int:
+      keep_budget = max(0, budget - self.summary_tokens)
+      tail_tokens = [0] * (len(lines) + 1)
+      for i in range(len(lines) - 1, -1, -1):
+         tail_tokens[i] = tail_tokens[i+1] + estimate_tokens(lines[i])
+      cut = 0
+      while cut < len(lines) and tail_tokens[cut] > keep_budget:
+         cut += self.chunk_lines
+      return min(cut, len(lines))
+
+   async def _summarize(self, section:str, previous:str, chunk:str, deadline:Optional[Deadline]) -> str:
+      self.summarize_calls += 1
+      kwargs = {} if deadline is None else { "deadline":deadline }
+      return (await self.summarize(section, previous, chunk, **kwargs)).strip()
+
+   # `scope` keeps chains apart whose lines only make sense together, e.g. one town's own overview lines
+   async def rolling_summary(self, section:str, lines:List[str], cut:int, deadline:Optional[Deadline]=None, scope:str="") -> str:
+      summary = ""
+      for start in range(0, cut, self.chunk_lines):
+         chunk = "".join(lines[start:min(start + self.chunk_lines, cut)])
+         key = hashlib.sha256("\0".join((section, scope, summary, chunk)).encode()).hexdigest()
+         if key in self.summaries:
+            summary = self.summaries[key]
+            continue
+         pending = self._pending.get(key)
+         # a summary in flight on another event loop (e.g. a background speculation) cannot be awaited here
+         if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = self._pending[key] = asyncio.ensure_future(self._summarize(section, summary, chunk, deadline))
+         try:
+            summary = await pending
+            self._store(key, summary)
+         finally:
+            if self._pending.get(key) is pending:
+               del self._pending[key]
+      return summary
+
+   async def compact_section(self, section:str, text:str, deadline:Optional[Deadline]=None) -> Optional[str]:
+      budget = self.section_budgets.get(section)
+      if budget is None or estimate_tokens(text) <= budget:
+         return None
+      lines = text.splitlines(keepends=True)
+      cut = self.find_cut(lines, budget)
+      summary = await self.rolling_summary(section, lines, cut, deadline)
+      return f"Summary of everything before this point: {summary}\n" + "".join(lines[cut:])
+
+   # returns (shared lines to fold, town lines to fold), town lines older than the first kept shared line are folded in whole chunks
+   def find_overview_cut(self, shared:List[Tuple[int,str]], local:List[Tuple[int,str]], budget:int, end:int) -> Tuple[int,int]:
+      keep_budget = max(0, budget - 2 * self.summary_tokens)
+      shared_tokens = [0] * (len(shared) + 1)
+      for i in range(len(shared) - 1, -1, -1):
+         shared_tokens[i] = shared_tokens[i+1] + estimate_tokens(shared[i][1])
+      local_tokens = [0] * (len(local) + 1)
+      for i in range(len(local) - 1, -1, -1):
+         local_tokens[i] = local_tokens[i+1] + estimate_tokens(local[i][1])
+      local_positions = [position for position, _ in local]
+      cut = 0
+      while True:
+         cut = min(cut, len(shared))
+         first_kept = shared[cut][0] if cut < len(shared) else end
+         local_cut = bisect_left(local_positions, first_kept) // self.chunk_lines * self.chunk_lines
+         if cut == len(shared) or shared_tokens[cut] + local_tokens[local_cut] <= keep_budget:
+            return cut, local_cut
+         cut += self.chunk_lines
+
+   # the lines every town shares and each town's own lines are summarized as separate chains, so arriving somewhere new reuses the shared chain
+   async def compact_overview(self, game:Game, deadline:Optional[Deadline]=None) -> Optional[str]:
+      budget = self.section_budgets.get("OVERVIEW")
+      if budget is None or estimate_tokens(game.get_overview()) <= budget:
+         return None
+      town = game.get_current_town()
+      shared, local = game.get_overview_parts(town)
+      cut, local_cut = self.find_overview_cut(shared, local, budget, len(game.events))
+      text = f"Summary of everything before this point: {await self.rolling_summary('OVERVIEW', [line for _, line in shared], cut, deadline)}\n"
+      if local_cut > 0:
+         text += f"Summary of earlier events in {town}: {await self.rolling_summary('OVERVIEW', [line for _, line in local], local_cut, deadline, scope=town)}\n"
+      return text + "".join(line for _, line in heapq.merge(shared[cut:], local[local_cut:]))
+
+   # returns replacements for the template sections that are over budget, sections within budget are left untouched
+   # a section whose summary fails (e.g. the turn deadline ran out) is left uncompacted rather than failing the turn
+   async def compact(self, game:Game, deadline:Optional[Deadline]=None) -> Dict[str,str]:
+      compacted = {}
+      sections: List[Tuple[str,Callable[[],Awaitable[Optional[str]]]]] = [("OVERVIEW", lambda: self.compact_overview(game, deadline))]
+      if game.get_current_state() == State.TOWN_TALK:
+         conversation = game.get_conversation(game.get_last_event(E.Start_Conversation_Event).character_name)
+         sections.append(("CONVERSATION", lambda: self.compact_section("CONVERSATION", conversation, deadline)))
+      for section, compact_section in sections:
+         try:
+            replacement = await compact_section()
+         except Completion_Failed as ex:
+            logger.warning(f"Could not compact {section}, leaving it as is: {ex}")
+            continue
+         if replacement is not None:
+            compacted[section] = replacement
+      return compacted
@@ -1,15 +1,41 @@
 from common import State
-from typing import Dict, List
+from typing import Dict, List, Tuple
+from functools import lru_cache
 import re
 
+PATTERN = re.compile(r'%%([a-zA-Z_]+)%%')
+
+class Compiled_Template:
+   parts: List[str]
+   slots: Tuple[Tuple[int,str],...]
+
+   # literal text and %%KEY%% slots split once, PATTERN.split puts the slot names at the odd indices
+   def __init__(self, text:str):
+      self.parts = PATTERN.split(text)
+      self.slots = tuple((i, self.parts[i]) for i in range(1, len(self.parts), 2))
+
+   def render(self, mapping:Dict[str,str]) -> str:
+      parts = self.parts.copy()
+      for i, key in self.slots:
+         value = mapping.get(key, None)
+         if value is None:
+            raise ValueError(f"Failed to find key '{key}' in mapping, existing keys are {list(mapping.keys())}")
+         parts[i] = value
+      return "".join(parts)
+
+@lru_cache(maxsize=128)
+def compile_template(text:str) -> Compiled_Template:
+   return Compiled_Template(text)
+
 class Template:
-   PATTERN = re.compile(r'%%([a-zA-Z_]+)%%')
    chunks: List[str]
    mapping: Dict[str,str]
+   compiled: Compiled_Template
 
    def __init__(self, *chunks:str):
       self.chunks = list(chunks)
       self.mapping = {}
+      self.compiled = compile_template("\n\n".join(chunks))
    
    def __getitem__(self, key:str) -> str:
       return self.mapping[key]
@@ -18,14 +44,7 @@ class Template:
       self.mapping[key] = value
    
    def render(self) -> str:
-      text = "\n\n".join(self.chunks)
-      matches = Template.PATTERN.findall(text)
-      for match in matches:
-         value = self.mapping.get(match, None)
-         if value is None:
-            raise ValueError(f"Failed to find key '{match}' in mapping, existing keys are {list(self.mapping.keys())}")
-         text = text.replace(f"%%{match}%%", value)
-      return text
+      return self.compiled.render(self.mapping)
 
 
 SYSTEM_START    = "<|im_start|>system"
@@ -64,6 +83,16 @@ Only write something if there are immediate actions you want to perform that req
 <scratchpad>
 """.strip()
 
+ask_for_plan_and_call = f"""
+To start off, write a short action plan in plain English, 1 or more lines, describing your intended action(s).
+If you plan on calling multiple API functions before getting a player response write out ALL steps to your plan here.
+Make sure to ONLY include items for you. Do NOT include items for the player to perform. Do NOT include items that rely on player input. Do ONLY what you can this very instant with the information written above.
+Then, on the very last line, write the SINGLE function call for the first step of your plan with ALL of its parameters filled in.
+If you are waiting for player input to proceed, make that last line `get_player_input()`.{SYSTEM_END}
+{ASSISTANT_START}
+<scratchpad>
+""".strip()
+
 ask_for_function_call = f"""
 Please call the necessary function to progress the game state in a fun-but-in-the-guide-rails manner.
 Make sure to ONLY call only a SIGNLE function. Do NOT call multiple functions.
@@ -79,6 +108,21 @@ end_function_calling = f"""
 
 
 
+summarize_history = f"""
+{SYSTEM_START}
+You are helping a game master keep track of a long running video game. Below is a summary of what has happened so far, followed by the next part of the %%SECTION%% that needs to be folded into it.
+<summary>
+%%PREVIOUS%%
+</summary>
+<new-content>
+%%CONTENT%%</new-content>
+Rewrite the summary so it also covers the new content. Keep every name of a location, character and quest, and any detail that could matter later. Keep it SHORT, a single paragraph.{SYSTEM_END}
+{ASSISTANT_START}
+<summary>
+""".strip()
+
+
+
 limiter = "ONLY call functions that accomplish what the player is asking for, NOT more."
 instructions: Dict[State,str] = {
    State.TOWN_IDLE: f"Use the following player input to call the appropriate functions to progress the game state. {limiter}\n<player-input>\n%%PLAYER_INPUT%%</player-input>",
@@ -86,6 +130,8 @@ instructions: Dict[State,str] = {
    State.ON_THE_MOVE: f"Use the provied APIs to either construct a fun and unique encounter for the player to interact with, or have them arrive at their target location. Make your decisions based on the following travel goal you wrote yourself before leaving town.\n<travel-goal>\n%%TRAVEL_GOAL%%\n</travel-goal>",
 }
 
+# cached per State so Template() looks up the compiled intro by the same string object every turn
+@lru_cache(maxsize=None)
 def make_intro_prompt(state:State) -> str:
    extra_info = ""
    if state == State.TOWN_IDLE:
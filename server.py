@@ -0,0 +1,229 @@
+from common import logger, exc_loc_str
+import events as E
+from game import Game
+from journal import Journal, load_game
+from main import process_game_state_async, new_game, awaiting_player, input_prompt, add_player_input, make_summarizer
+from completion import Completion_Client
+from prompt_budget import Prompt_Budget
+
+from typing import Dict, List, Optional, Callable, Awaitable
+from collections import OrderedDict
+import asyncio, os, re, time, json, argparse
+
+SESSION_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{1,64}$')
+
+# every reply ends with this line, clients read until it before sending the next line
+PROMPT_MARKER = "> "
+TURN_FAILED_MESSAGE = "Something went wrong while taking your turn, please try again"
+
+# rough in-memory cost of one event (see test/bench_memory.py), used to size sessions against the budget
+EVENT_BYTES = 200
+
+class Session:
+   session_id: str
+   dirpath: str
+   game: Game
+   journal: Journal
+   decision_log: List[Dict]
+   lock: asyncio.Lock
+   prompt_budget: Optional[Prompt_Budget]
+   clients: int
+   last_used: float
+
+   def __init__(self, session_id:str, dirpath:str, game:Game, journal:Journal, prompt_budget:Optional[Prompt_Budget]=None):
+      self.session_id = session_id
+      self.dirpath = dirpath
+      self.game = game
+      self.journal = journal
+      self.prompt_budget = prompt_budget
+      self.decision_log = []
+      self.lock = asyncio.Lock()
+      self.clients = 0
+      self.last_used = time.monotonic()
+
+   def size(self) -> int:
+      return len(self.game.events) * EVENT_BYTES \
+         + sum(len(text) for _, text in self.game.overview.values()) \
+         + sum(len(lines) for lines in self.game.conversation_text.values()) * EVENT_BYTES \
+         + (0 if self.prompt_budget is None else sum(len(text) for text in self.prompt_budget.summaries.values()))
+
+   def flush(self) -> None:
+      self.journal.write(self.game)
+      if len(self.decision_log) > 0:
+         with open(os.path.join(self.dirpath, "decision_log.jsonl"), "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in self.decision_log))
+         self.decision_log = []
+
+   def close(self) -> None:
+      self.flush()
+      if self.journal.last_snapshot != self.journal.written:
+         self.journal.snapshot(self.game)
+      self.journal.close()
+
+class Session_Server:
+   root_dirpath: str
+   output_from_prompt: Callable[...,Awaitable[Optional[str]]]
+   memory_budget: int
+   idle_seconds: float
+   max_llm_turns: int
+   turn_budget: Optional[float]
+   summarize: Optional[Callable[...,Awaitable[str]]]
+   sessions: 'OrderedDict[str,Session]'
+   reaper: Optional[asyncio.Task]
+
+   # hot sessions are kept in LRU order, idle ones are spilled to their journal + snapshot and reloaded on demand
+   # when summarize is given each session gets a Prompt_Budget whose summaries are kept beside its journal
+   # turn_budget is the latency budget in seconds of each LLM turn, its Deadline is passed to output_from_prompt
+   def __init__(self, root_dirpath:str, output_from_prompt:Callable[...,Awaitable[Optional[str]]], memory_budget:int=256*2**20, idle_seconds:float=600.0, max_llm_turns:int=3,
+                summarize:Optional[Callable[...,Awaitable[str]]]=None, turn_budget:Optional[float]=300.0):
+      self.root_dirpath = root_dirpath
+      self.output_from_prompt = output_from_prompt
+      self.memory_budget = memory_budget
+      self.idle_seconds = idle_seconds
+      self.max_llm_turns = max_llm_turns
+      self.summarize = summarize
+      self.turn_budget = turn_budget
+      self.sessions = OrderedDict()
+      self.reaper = None
+
+   def acquire(self, session_id:str) -> Session:
+      session = self.sessions.get(session_id, None)
+      if session is not None:
+         self.sessions.move_to_end(session_id)
+         session.clients += 1
+         return session
+      dirpath = os.path.join(self.root_dirpath, session_id)
+      journal_path = os.path.join(dirpath, "game.jsonl")
+      if os.path.exists(journal_path):
+         game = load_game(journal_path)
+         journal = Journal(journal_path, written=len(game.events), snapshot_every=1000)
+         logger.info(f"Resumed session '{session_id}' with {len(game.events)} events")
+      else:
+         os.makedirs(dirpath, exist_ok=True)
+         game = new_game()
+         journal = Journal(journal_path, snapshot_every=1000)
+         journal.write(game)
+         logger.info(f"Created session '{session_id}'")
+      prompt_budget = None if self.summarize is None else Prompt_Budget(self.summarize, path=os.path.join(dirpath, "summaries.jsonl"))
+      session = Session(session_id, dirpath, game, journal, prompt_budget)
+      session.clients += 1
+      self.sessions[session_id] = session
+      self.evict()
+      return session
+
+   def release(self, session:Session) -> None:
+      session.clients -= 1
+      session.last_used = time.monotonic()
+      self.sessions.move_to_end(session.session_id)
+      self.evict()
+
+   def spill(self, session:Session) -> None:
+      session.close()
+      del self.sessions[session.session_id]
+      logger.info(f"Spilled session '{session.session_id}' to disk")
+
+   def evict(self, now:Optional[float]=None) -> None:
+      idle = [s for s in self.sessions.values() if s.clients == 0 and not s.lock.locked()]
+      total = sum(s.size() for s in self.sessions.values())
+      for session in idle:
+         if total <= self.memory_budget and (now is None or now - session.last_used < self.idle_seconds):
+            continue
+         total -= session.size()
+         self.spill(session)
+
+   # a turn that raises is logged like the harness does and reported to the client, whatever was committed before it is kept
+   async def take_turn(self, session:Session, text:str) -> List[str]:
+      async with session.lock:
+         game = session.game
+         start = len(game.events)
+         error = []
+         try:
+            add_player_input(game, text, session.decision_log)
+            for _ in range(self.max_llm_turns):
+               if awaiting_player(game):
+                  break
+               session.decision_log.append({"event":f"Processing {game.get_current_state().value} State", "message":"Requesting LLM completion"})
+               delta_game = await process_game_state_async(game, self.output_from_prompt, session.decision_log, budget=self.turn_budget, prompt_budget=session.prompt_budget)
+               if delta_game is not None:
+                  delta_game.commit()
+         except Exception as ex:
+            logger.error(f"Turn failed in session '{session.session_id}': {ex}")
+            session.decision_log.append({"event":"ERROR: Unhandled Exception", "error":f"{ex} ({exc_loc_str()})"})
+            error = [TURN_FAILED_MESSAGE]
+         finally:
+            session.flush()
+            session.last_used = time.monotonic()
+         return [e.player() for e in game.events.tail(start)] + error
+
+   async def handle_client(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+      async def send(lines:List[str]) -> None:
+         writer.write("".join(line.replace("\n", " ") + "\n" for line in lines + [PROMPT_MARKER]).encode())
+         await writer.drain()
+
+      try:
+         await send(["session?"])
+         session_id = (await reader.readline()).decode().strip()
+         if not SESSION_ID_PATTERN.match(session_id):
+            await send([f"invalid session name '{session_id}', use 1 to 64 letters, digits, '_' or '-'"])
+            return
+         session = self.acquire(session_id)
+         try:
+            await send([e.player() for e in session.game.events] + [input_prompt(session.game).strip()])
+            while True:
+               line = await reader.readline()
+               if not line:
+                  break
+               text = line.decode().strip()
+               if text == "/quit":
+                  break
+               if text:
+                  await send(await self.take_turn(session, text) + [input_prompt(session.game).strip()])
+         finally:
+            self.release(session)
+      except ConnectionError as ex:
+         logger.warning(f"Client connection dropped: {ex}")
+      finally:
+         writer.close()
+
+   async def reap_idle(self) -> None:
+      while True:
+         await asyncio.sleep(max(1.0, self.idle_seconds / 4))
+         self.evict(time.monotonic())
+
+   async def serve(self, host:str="127.0.0.1", port:int=7777) -> asyncio.AbstractServer:
+      server = await asyncio.start_server(self.handle_client, host, port)
+      self.reaper = asyncio.create_task(self.reap_idle())
+      return server
+
+   def close(self) -> None:
+      if self.reaper is not None:
+         self.reaper.cancel()
+         self.reaper = None
+      for session in list(self.sessions.values()):
+         self.spill(session)
+
+async def run_server(root_dirpath:str, host:str, port:int, memory_budget:int, idle_seconds:float, max_concurrency:int, turn_budget:Optional[float]=300.0) -> None:
+   client = Completion_Client(max_connections=max_concurrency, max_concurrency=max_concurrency)
+   game_server = Session_Server(root_dirpath, client.complete, memory_budget=memory_budget, idle_seconds=idle_seconds, summarize=make_summarizer(client.complete), turn_budget=turn_budget)
+   server = await game_server.serve(host, port)
+   logger.info(f"Serving sessions from '{root_dirpath}' on {host}:{port}")
+   try:
+      async with server:
+         await server.serve_forever()
+   finally:
+      game_server.close()
+      await client.close()
+
+# connect with any line based client, e.g. `nc 127.0.0.1 7777`
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--host', type=str, default="127.0.0.1")
+   parser.add_argument('--port', type=int, default=7777)
+   parser.add_argument('--dir', type=str, default="logs/sessions")
+   parser.add_argument('--memory-mb', type=int, default=256)
+   parser.add_argument('--idle-seconds', type=float, default=600.0)
+   parser.add_argument('--llm-concurrency', type=int, default=8)
+   parser.add_argument('--turn-budget', type=float, default=300.0)
+   args = parser.parse_args()
+
+   asyncio.run(run_server(args.dir, args.host, args.port, args.memory_mb * 2**20, args.idle_seconds, args.llm_concurrency, args.turn_budget))
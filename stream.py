@@ -0,0 +1,67 @@
+from common import Event
+from game import Game
+
+from typing import Iterator, Any, Dict
+import json
+
+WHITESPACE = " \t\n\r"
+
+def iter_json_array(path:str, chunk_size:int=1<<16) -> Iterator[Any]:
+   decoder = json.JSONDecoder()
+   with open(path, "r") as f:
+      buffer = ""
+      pos = 0
+      eof = False
+
+      def next_char() -> str:
+         nonlocal buffer, pos, eof
+         while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+               pos += 1
+            if pos < len(buffer) or eof:
+               return buffer[pos] if pos < len(buffer) else ""
+            chunk = f.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer, pos = buffer[pos:] + chunk, 0
+
+      if next_char() != "[":
+         raise ValueError(f"expected '{path}' to contain a JSON array")
+      pos += 1
+      if next_char() == "]":
+         return
+      while True:
+         next_char()
+         while True:
+            try:
+               value, end = decoder.raw_decode(buffer, pos)
+               # a value cut off by the chunk boundary can still decode (e.g. "-0" of "-0.5"), so only
+               # accept it once the delimiter that follows it has been read
+               delimiter = end
+               while delimiter < len(buffer) and buffer[delimiter] in WHITESPACE:
+                  delimiter += 1
+               if eof or (delimiter < len(buffer) and buffer[delimiter] in ",]"):
+                  break
+            except json.JSONDecodeError:
+               if eof:
+                  raise
+            chunk = f.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer, pos = buffer[pos:] + chunk, 0
+         pos = end
+         yield value
+         char = next_char()
+         pos += 1
+         if char == "]":
+            return
+         if char != ",":
+            raise ValueError(f"expected ',' or ']' between array entries in '{path}', found {char!r}")
+
+def read_events(path:str, chunk_size:int=1<<16) -> Iterator[Event]:
+   for event_data in iter_json_array(path, chunk_size):
+      yield Game.event_from_json(event_data)
+
+def read_decision_log(path:str, chunk_size:int=1<<16) -> Iterator[Dict[str,Any]]:
+   yield from iter_json_array(path, chunk_size)
+
+def load_json_game(path:str) -> Game:
+   return Game(read_events(path))
@@ -0,0 +1,65 @@
+import events as E
+from game import Game
+from codec import encode_game, decode_game
+
+from typing import List
+import json, time, random, argparse
+
+TOWNS = ["Whisperwind Village", "Stonehaven", "Emberfall", "Mistral Keep", "Duskwater"]
+NAMES = ["Gilda", "Bob", "Thorne", "Lysandra", "Korrin", "Mabel", "Edric", "Saffi"]
+
+def make_session(count:int, seed:int=0) -> Game:
+   rng = random.Random(seed)
+   game = Game()
+   town = TOWNS[0]
+   for name in TOWNS:
+      game.add_event(E.Create_New_Town_Event(name, f"a town known as {name}, full of winding streets and odd folk", "cobblestone streets, timber houses, lanterns"))
+   game.add_event(E.Arrive_At_Town_Event(town))
+   while len(game.events) < count:
+      roll = rng.random()
+      if roll < 0.05:
+         town = rng.choice(TOWNS)
+         game.add_event(E.Arrive_At_Town_Event(town))
+      elif roll < 0.10:
+         game.add_event(E.Create_Character_Event(rng.choice(NAMES), town, "a local who knows everyone's business", "tall, weathered face, green cloak"))
+      elif roll < 0.20:
+         game.add_event(E.Describe_Environment_Event(f"The square is busy, {rng.randint(2, 40)} people mill about the stalls", town))
+      elif roll < 0.25:
+         game.add_event(E.Quest_Start(f"quest {rng.randint(0, 500)}", "retrieve the lost heirloom from the old mill"))
+      elif roll < 0.30:
+         game.add_event(E.Player_Input_Event(f"I look around for {rng.choice(NAMES)}"))
+      else:
+         game.add_event(E.Speak_Event(rng.choice(NAMES), rng.random() < 0.5, f"Line {rng.randint(0, 10**6)} of a long conversation about the weather and the roads"))
+   return game
+
+def bench(count:int, repeats:int) -> List[str]:
+   game = make_session(count)
+
+   def timed(fnx):
+      best = float("inf")
+      for _ in range(repeats):
+         start = time.perf_counter()
+         out = fnx()
+         best = min(best, time.perf_counter() - start)
+      return out, best
+
+   json_data, json_enc = timed(lambda: json.dumps(game.to_json()).encode())
+   json_game, json_dec = timed(lambda: Game.from_json(json.loads(json_data)))
+   bin_data,  bin_enc  = timed(lambda: encode_game(game))
+   bin_game,  bin_dec  = timed(lambda: decode_game(bin_data))
+   assert json_game.to_json() == game.to_json() and bin_game.to_json() == game.to_json()
+
+   return [
+      f"{count:>7} events | json   {len(json_data):>11,} bytes | encode {json_enc*1000:8.1f} ms | decode {json_dec*1000:8.1f} ms",
+      f"{count:>7} events | binary {len(bin_data):>11,} bytes | encode {bin_enc*1000:8.1f} ms | decode {bin_dec*1000:8.1f} ms ({len(bin_data)/len(json_data):.1%} of json size)",
+   ]
+
+# run from the repo root: PYTHONPATH=. python test/bench_codec.py
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('-r', '--repeats', type=int, default=3)
+   parser.add_argument('-c', '--counts', type=int, nargs="+", default=[1_000, 10_000, 100_000])
+   args = parser.parse_args()
+
+   for count in args.counts:
+      print("\n".join(bench(count, args.repeats)))
@@ -0,0 +1,21 @@
+from bench_codec import make_session
+
+import tracemalloc, gc, argparse
+
+def report(count:int) -> str:
+   gc.collect()
+   tracemalloc.start()
+   game = make_session(count)
+   gc.collect()
+   current, peak = tracemalloc.get_traced_memory()
+   tracemalloc.stop()
+   has_dict = hasattr(game.events[0], "__dict__")
+   return f"{len(game.events):>7} events | current {current/2**20:7.2f} MiB | peak {peak/2**20:7.2f} MiB | {current/len(game.events):6.1f} bytes/event | __dict__ per event: {has_dict}"
+
+# run from the repo root: PYTHONPATH=. python test/bench_memory.py
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('-c', '--count', type=int, default=100_000)
+   args = parser.parse_args()
+
+   print(report(args.count))
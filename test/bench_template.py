@@ -0,0 +1,52 @@
+from bench_codec import make_session
+from prompts import Template, make_intro_prompt, PATTERN
+import main
+
+from typing import Dict, List
+import time, argparse
+
+# the render from before templates were compiled, kept to compare against
+def legacy_render(chunks:List[str], mapping:Dict[str,str]) -> str:
+   text = "\n\n".join(chunks)
+   for match in PATTERN.findall(text):
+      text = text.replace(f"%%{match}%%", mapping[match])
+   return text
+
+def bench(count:int, repeats:int, renders:int) -> List[str]:
+   game = make_session(count)
+   state = game.get_current_state()
+   overview = game.get_overview()
+   template = Template(make_intro_prompt(state))
+   template["OVERVIEW"] = overview
+   template["QUESTS"] = "".join(f'"{e.quest_name}": {e.quest_description}\n' for e in game.get_active_quests())
+   template["PLAYER_INPUT"] = "I look around the square\n"
+   template["CHARACTERS"] = "".join(f"'{e.character_name}': {e.background}\n" for e in game.get_characters())
+   template["TRAVEL_GOAL"] = "reach the next town"
+   assert legacy_render(template.chunks, template.mapping) == template.render()
+
+   def timed(fnx) -> float:
+      best = float("inf")
+      for _ in range(repeats):
+         start = time.perf_counter()
+         for _ in range(renders):
+            fnx()
+         best = min(best, (time.perf_counter() - start) / renders)
+      return best
+
+   legacy   = timed(lambda: legacy_render([make_intro_prompt(state)], template.mapping))
+   compiled = timed(lambda: Template(make_intro_prompt(state)).compiled.render(template.mapping))
+   full     = timed(lambda: main.get_prompt_from_game_state(game))
+   return [
+      f"{count:>7} events | overview {len(overview):>9,} chars | legacy render {legacy*1e6:8.1f} us | compiled render {compiled*1e6:8.1f} us ({legacy/compiled:.1f}x) | full intro prompt {full*1e6:8.1f} us",
+   ]
+
+# run from the repo root: PYTHONPATH=. python test/bench_template.py
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('-r', '--repeats', type=int, default=5)
+   parser.add_argument('-n', '--renders', type=int, default=200)
+   parser.add_argument('-c', '--counts', type=int, nargs="+", default=[100, 1_000, 10_000])
+   args = parser.parse_args()
+
+   for count in args.counts:
+      print("\n".join(bench(count, args.repeats, args.renders)))
@@ -0,0 +1,139 @@
+from common import logger, exc_loc_str
+from main import process_game_state_async, client
+from completion import Deadline, run_sync
+from stream import load_json_game
+from game import Game
+from grammar import Grammar
+
+from typing import List, Dict, Optional, Callable, Awaitable
+from dataclasses import dataclass, field
+import json, os, time, asyncio
+
+@dataclass
+class Job:
+   scenario: str
+   key: str
+   output_from_prompt: Callable[[str],Awaitable[Optional[str]]]
+   remaining: Callable[[],Optional[str]] = (lambda: None)
+   fused: bool = False
+   use_grammar: bool = False
+   budget: Optional[float] = None
+
+@dataclass
+class Run_Result:
+   scenario: str
+   key: str
+   decision_log: List[Dict]
+   ok: bool
+   start: float
+   end: float
+
+@dataclass
+class Run_Stats:
+   ok: bool = False
+   loops: int = 0
+   completions: int = 0
+   errors: Dict[str,int] = field(default_factory=dict)
+
+def summarize_decisions(decision_log:List[Dict], ok:bool) -> Run_Stats:
+   stats = Run_Stats(ok=ok)
+   micro_state = "?"
+   for entry in decision_log:
+      event = entry.get("event", "")
+      if "micro_state" in entry and event == "Got Extension":
+         micro_state = entry["micro_state"]
+         stats.completions += 1
+      elif event == "Looping Evolver":
+         stats.loops += 1
+      elif event.startswith("ERROR: Got Back Not-OK") or event == "ERROR: Completion Failed":
+         stats.errors[micro_state] = stats.errors.get(micro_state, 0) + 1
+   return stats
+
+def summarize(results:List[Run_Result]) -> Dict:
+   scenarios: Dict[str,Dict] = {}
+   for result in results:
+      stats = summarize_decisions(result.decision_log, result.ok)
+      summary = scenarios.setdefault(result.scenario, { "runs":0, "successes":0, "errors":{}, "loops":0, "completions":0, "run_time":0.0, "start":result.start, "end":result.end })
+      summary["runs"] += 1
+      summary["successes"] += int(stats.ok)
+      summary["loops"] += stats.loops
+      summary["completions"] += stats.completions
+      for micro_state, count in stats.errors.items():
+         summary["errors"][micro_state] = summary["errors"].get(micro_state, 0) + count
+      summary["run_time"] += result.end - result.start
+      summary["start"] = min(summary["start"], result.start)
+      summary["end"]   = max(summary["end"],   result.end)
+
+   for summary in scenarios.values():
+      summary["success_rate"] = summary["successes"] / summary["runs"]
+      summary["mean_loops"] = summary["loops"] / summary["runs"]
+      summary["mean_completions"] = summary["completions"] / summary["runs"]
+      summary["mean_run_time"] = summary.pop("run_time") / summary["runs"]
+      summary["wall_time"] = summary.pop("end") - summary.pop("start")
+   return scenarios
+
+async def run_job(game:Game, job:Job, semaphore:asyncio.Semaphore) -> Run_Result:
+   decision_log: List[Dict] = [{"break":"="*120, "event":"Starting New Session", "name":job.key}]
+   ok = False
+   async with semaphore:
+      start = time.perf_counter()
+      try:
+         ok = (await process_game_state_async(game, job.output_from_prompt, decision_log, fused=job.fused, use_grammar=job.use_grammar, budget=job.budget)) is not None
+         output = job.remaining()
+         if output is not None:
+            logger.error("Still had output after processing game state")
+            decision_log.append({"event":"ERROR: Unhandled Output Remaining", "output":output})
+            ok = False
+      except Exception as ex:
+         logger.error(str(ex))
+         decision_log.append({"event":"ERROR: Unhandled Exception", "error":f"{ex} ({exc_loc_str()})"})
+      end = time.perf_counter()
+   return Run_Result(job.scenario, job.key, decision_log, ok, start, end)
+
+# results come back in job order no matter which run finishes first, so merged logs are deterministic
+async def run_jobs(games:Dict[str,Game], jobs:List[Job], concurrency:int) -> List[Run_Result]:
+   semaphore = asyncio.Semaphore(concurrency)
+   return list(await asyncio.gather(*(run_job(games[job.scenario], job, semaphore) for job in jobs)))
+
+def prompt_jobs(names:List[str], iterations:int, fused:bool=False, budget:Optional[float]=None) -> List[Job]:
+   jobs = []
+   for name in names:
+      for i in range(iterations):
+         async def output_from_prompt(prompt:str, i=i, grammar:Optional[Grammar]=None, deadline:Optional[Deadline]=None) -> Optional[str]:
+            return await client.complete(prompt, variant=i, grammar=grammar, deadline=deadline)
+         jobs.append(Job(name, f"Iteration_{i+1}", output_from_prompt, fused=fused, use_grammar=client.grammar_format is not None, budget=budget))
+   return jobs
+
+def inject_jobs(names:List[str], fused:bool=False) -> List[Job]:
+   jobs = []
+   for name in names:
+      with open(f"test/inputs/{name}{'_fused' if fused else ''}_injects.json", "r") as f:
+         injects: Dict[str,List[str]] = json.load(f)
+      for key, outputs in injects.items():
+         def remaining(outputs=outputs) -> Optional[str]:
+            return outputs.pop(0) if len(outputs) > 0 else None
+         async def output_from_prompt(_, remaining=remaining) -> Optional[str]:
+            return remaining()
+         jobs.append(Job(name, key, output_from_prompt, remaining, fused))
+   return jobs
+
+def run_scenarios(names:List[str], jobs:List[Job], concurrency:int) -> List[Run_Result]:
+   games = { name: load_json_game(f"test/inputs/{name}_events.json") for name in names }
+   if client._client is None:
+      client.max_concurrency = concurrency
+      client.max_connections = max(client.max_connections, concurrency)
+   return run_sync(run_jobs(games, jobs, concurrency))
+
+def write_results(results:List[Run_Result], folder_dirpath:str, suffix:str) -> None:
+   merged: Dict[str,List[Dict]] = {}
+   for result in results:
+      merged.setdefault(result.scenario, []).extend(result.decision_log)
+   for name, decision_log in merged.items():
+      with open(os.path.join(folder_dirpath, f"{name}_{suffix}.json"), "w") as f:
+         json.dump(decision_log, f, indent="\t")
+
+def print_summary(summary:Dict, wall_time:float) -> None:
+   for name, s in summary.items():
+      errors = ", ".join(f"{k}={v}" for k, v in sorted(s["errors"].items())) or "none"
+      print(f"{name}: {s['successes']}/{s['runs']} ok ({100*s['success_rate']:.0f}%), errors: {errors}, mean loops {s['mean_loops']:.2f}, mean completions {s['mean_completions']:.2f}, wall {s['wall_time']:.2f}s, mean run {s['mean_run_time']:.2f}s")
+   print(f"total wall time {wall_time:.2f}s")
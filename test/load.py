@@ -0,0 +1,117 @@
+from common import logger
+from mock_llm import Mock_LLM, load_script
+from server import Session_Server, PROMPT_MARKER
+from completion import Completion_Client
+
+from typing import List, Dict, Optional
+from dataclasses import dataclass, field
+import asyncio, tempfile, time, json, argparse, logging
+
+PLAYER_INPUTS = ["look around", "what is in the square?", "describe the inn", "anything interesting here?"]
+
+@dataclass
+class Load_Report:
+   players: int
+   turns: int
+   failed_turns: int
+   wall_time: float
+   completions: int
+   llm_errors: int
+   unscripted: int
+   latencies: List[float] = field(default_factory=list)
+
+   def percentile(self, p:float) -> float:
+      if len(self.latencies) == 0:
+         return 0.0
+      latencies = sorted(self.latencies)
+      return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+   def summary(self) -> Dict:
+      return {
+         "players": self.players,
+         "turns": self.turns,
+         "failed_turns": self.failed_turns,
+         "wall_time": self.wall_time,
+         "turns_per_second": self.turns / self.wall_time if self.wall_time > 0 else 0.0,
+         "completions_per_second": self.completions / self.wall_time if self.wall_time > 0 else 0.0,
+         "llm_errors": self.llm_errors,
+         "unscripted_prompts": self.unscripted,
+         "p50": self.percentile(0.50),
+         "p90": self.percentile(0.90),
+         "p99": self.percentile(0.99),
+         "max": max(self.latencies, default=0.0),
+      }
+
+# returns the lines of one reply without the prompt marker, a closed connection ends the reply with ""
+async def read_until_prompt(reader:asyncio.StreamReader) -> List[str]:
+   lines = []
+   while True:
+      data = await reader.readline()
+      if not data:
+         return lines + [""]
+      line = data.decode().rstrip("\n")
+      if line == PROMPT_MARKER:
+         return lines
+      lines.append(line)
+
+# one player connects to its own session and plays `turns` turns, returning the latency of each
+async def play(port:int, session_id:str, turns:int, think_time:float) -> List[Optional[float]]:
+   reader, writer = await asyncio.open_connection("127.0.0.1", port)
+   latencies: List[Optional[float]] = []
+   try:
+      await read_until_prompt(reader)
+      writer.write(f"{session_id}\n".encode())
+      await read_until_prompt(reader)
+      for i in range(turns):
+         await asyncio.sleep(think_time)
+         start = time.perf_counter()
+         writer.write(f"{PLAYER_INPUTS[i % len(PLAYER_INPUTS)]}\n".encode())
+         lines = await read_until_prompt(reader)
+         latencies.append(time.perf_counter() - start if lines[-1] != "" else None)
+      writer.write(b"/quit\n")
+      await writer.drain()
+      await reader.read()
+   finally:
+      writer.close()
+   return latencies
+
+async def run_load(players:int, turns:int, mock:Mock_LLM, llm_concurrency:int=8, think_time:float=0.0, root_dirpath:Optional[str]=None) -> Load_Report:
+   llm_server = await mock.serve("127.0.0.1", 0)
+   llm_port = llm_server.sockets[0].getsockname()[1]
+   client = Completion_Client(base_url=f"http://127.0.0.1:{llm_port}/v1", max_connections=llm_concurrency, max_concurrency=llm_concurrency, backoff=0.05)
+   with tempfile.TemporaryDirectory() as tmpdir:
+      game_server = Session_Server(root_dirpath or tmpdir, client.complete)
+      server = await game_server.serve("127.0.0.1", 0)
+      port = server.sockets[0].getsockname()[1]
+      try:
+         start = time.perf_counter()
+         results = await asyncio.gather(*(play(port, f"player_{i}", turns, think_time) for i in range(players)))
+         wall_time = time.perf_counter() - start
+      finally:
+         server.close()
+         await server.wait_closed()
+         game_server.close()
+         await client.close()
+         llm_server.close()
+         await llm_server.wait_closed()
+
+   latencies = [l for result in results for l in result if l is not None]
+   failed = sum(1 for result in results for l in result if l is None)
+   return Load_Report(players, len(latencies), failed, wall_time, mock.requests, mock.errors, mock.unscripted, latencies)
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('-n', '--players', type=int, default=16)
+   parser.add_argument('-t', '--turns', type=int, default=5)
+   parser.add_argument('-j', '--llm-concurrency', type=int, default=8)
+   parser.add_argument('--think-ms', type=float, default=0.0, help="pause before each player input")
+   parser.add_argument('--latency-ms', type=float, default=50.0)
+   parser.add_argument('--latency-sigma', type=float, default=0.5)
+   parser.add_argument('--error-rate', type=float, default=0.0)
+   parser.add_argument('--seed', type=int, default=0)
+   args = parser.parse_args()
+
+   logger.setLevel(logging.WARNING)
+   mock = Mock_LLM(load_script(), args.latency_ms / 1000, args.latency_sigma, args.error_rate, seed=args.seed)
+   report = asyncio.run(run_load(args.players, args.turns, mock, args.llm_concurrency, args.think_ms / 1000))
+   print(json.dumps(report.summary(), indent="\t"))
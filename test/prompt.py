@@ -1,41 +1,48 @@
-from common import logger, exc_loc_str
-from main import process_game_state, make_completion
-from game import Game
+from harness import prompt_jobs, run_scenarios, write_results, summarize, print_summary
+from cache import Completion_Cache, CACHE_MODES
+from grammar import GRAMMAR_FORMATS
 
-import json, os, datetime, argparse
+from typing import Optional
+import json, os, time, datetime, argparse
 
-def prompt(iterations:int, folder_dirpath:str):
+def prompt(iterations:int, folder_dirpath:str, concurrency:int=8, fused:bool=False, budget:Optional[float]=None):
 
    # names_to_test = ["town_talk", "town_idle", "on_the_move"]
    names_to_test = ["town_talk"]
 
-   for test_name in names_to_test:
-      with open(f"test/inputs/{test_name}_events.json", "r") as f:
-         data = json.load(f)
-      game = Game.from_json(data)
+   start = time.perf_counter()
+   results = run_scenarios(names_to_test, prompt_jobs(names_to_test, iterations, fused, budget), concurrency)
+   wall_time = time.perf_counter() - start
+   write_results(results, folder_dirpath, "log")
 
-      event_log = []
-      for i in range(iterations):
-         key = f"Iteration_{i+1}"
-         try:
-            event_log.append({"break":"="*120, "event":"Starting New Session", "name":key})
-            process_game_state(game, make_completion, event_log)
-         except Exception as ex:
-            logger.error(str(ex))
-            event_log.append({"event":"ERROR: Unhandled Exception", "error":f"{ex} ({exc_loc_str()})"})
-
-      with open(os.path.join(folder_dirpath, f"{test_name}_log.json"), "w") as f:
-         json.dump(event_log, f, indent="\t")
+   summary = summarize(results)
+   with open(os.path.join(folder_dirpath, "summary.json"), "w") as f:
+      json.dump({ "wall_time":wall_time, "scenarios":summary }, f, indent="\t")
+   print_summary(summary, wall_time)
 
 if __name__ == "__main__":
    parser = argparse.ArgumentParser()
    parser.add_argument('-i', '--iterations', type=int, default=5)
+   parser.add_argument('-j', '--concurrency', type=int, default=8, help="maximum number of requests in flight against the LLM endpoint")
+   parser.add_argument('--fused', action='store_true', help="ask for the scratchpad and filled in function call in a single completion")
+   parser.add_argument('--grammar', type=str, default=None, choices=GRAMMAR_FORMATS, help="send a constrained decoding grammar in the format the backend supports")
+   parser.add_argument('--budget', type=float, default=None, help="latency budget in seconds for each run")
+   parser.add_argument('--hedge', type=float, default=None, help="send a duplicate request once an attempt passes this percentile of recent latencies (e.g. 0.95)")
+   parser.add_argument('--cache', type=str, default=None, help="directory of the completion cache, disabled if not set")
+   parser.add_argument('--cache-mode', type=str, default="record", choices=CACHE_MODES)
+   parser.add_argument('--cache-mb', type=int, default=256)
    args = parser.parse_args()
 
    FOLDER_DIR = datetime.datetime.now().strftime("logs/prompt/%m-%d-%Y_%H-%M-%S")
    if not os.path.exists(FOLDER_DIR):
       os.makedirs(FOLDER_DIR)
+   import completion
+   from completion_log import Completion_Log
+   completion.json_log = Completion_Log(os.path.join(FOLDER_DIR, "completions.jsonl"))
    import main
-   main.json_log = os.path.join(FOLDER_DIR, "completions.json")
+   main.client.grammar_format = args.grammar
+   main.client.hedge_percentile = args.hedge
+   if args.cache is not None:
+      main.client.cache = Completion_Cache(args.cache, args.cache_mode, args.cache_mb * 2**20)
 
-   prompt(args.iterations, FOLDER_DIR)
+   prompt(args.iterations, FOLDER_DIR, args.concurrency, args.fused, args.budget)
@@ -1,7 +1,26 @@
-from functions import parse_function
+from functions import parse_function, Quoted_Text_Stream, Function_Map, Function
+from common import State, Event
+import events as E
+from game import Game
+from codec import encode_events, decode_events, encode_game, decode_game, event_fields
+from stream import iter_json_array, read_events, read_decision_log, load_json_game
+from completion import Completion_Client, Completion_Failed, Budget_Exceeded, Deadline, run_sync
+from cache import Completion_Cache, Cache_Miss
+from completion_log import Completion_Log, convert, read_completion_log
+from journal import Journal, load_journal, load_game as load_journal_game, list_snapshots, Journal_Prefix
+import main
+from harness import Job, run_jobs, summarize, summarize_decisions, inject_jobs
+from evolver import Prompt_Evolver, Micro_State, extension_prefixes, CHOOSE_FUNCTION_TAIL
+from grammar import Grammar, fill_function_grammar
+from prompt_budget import Prompt_Budget, estimate_tokens
+from mock_llm import Mock_LLM, load_script
+from load import run_load, read_until_prompt
+from images import Image_Queue, Image_Cache
+from prompts import Template, make_intro_prompt
 
-from typing import List, Dict
-import unittest
+from typing import List, Dict, Optional
+import unittest, json, tempfile, os, asyncio, threading, time, re, sys, hashlib, struct, zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # add_text = Function(lambda a, b: a + b, "add_text", "", Parameter("a",str), Parameter("b",str))
 
@@ -59,6 +78,1584 @@ class Test_Parse_Function(unittest.TestCase):
       self.__sad('add_text(first="Hello,", " sailor!")')
 
 
+def load_game(test_name:str) -> Game:
+   with open(f"test/inputs/{test_name}_events.json", "r") as f:
+      return Game.from_json(json.load(f))
+
+class Test_Game_Projection(unittest.TestCase):
+
+   def test_current_state(self):
+      self.assertEqual(load_game("town_talk").get_current_state(), State.TOWN_TALK)
+      self.assertEqual(load_game("town_idle").get_current_state(), State.TOWN_IDLE)
+      self.assertEqual(Game().get_current_state(), State.ON_THE_MOVE)
+   def test_state_follows_add_event(self):
+      game = load_game("town_talk")
+      game.add_event(E.End_Converstation_Event())
+      self.assertEqual(game.get_current_state(), State.TOWN_IDLE)
+      game.add_event(E.Begin_Traveling_Event("go somewhere"))
+      self.assertEqual(game.get_current_state(), State.ON_THE_MOVE)
+
+   def test_current_town(self):
+      game = load_game("town_idle")
+      self.assertEqual(game.get_current_town(), "Whisperwind Village")
+      game.add_event(E.Create_New_Town_Event("stonehaven", "a mining town", ""))
+      game.add_event(E.Arrive_At_Town_Event("stonehaven"))
+      self.assertEqual(game.get_current_town(), "Stonehaven")
+   def test_no_town(self):
+      with self.assertRaises(RuntimeError):
+         Game().get_current_town()
+
+   def test_characters_per_town(self):
+      game = load_game("town_talk")
+      self.assertEqual([c.character_name for c in game.get_characters()], ["Gilda"])
+      game.add_event(E.Create_Character_Event("bob", "Whisperwind Village", "a farmer", ""))
+      self.assertEqual([c.character_name for c in game.get_characters()], ["Bob", "Gilda"])
+      game.add_event(E.Arrive_At_Town_Event("Stonehaven"))
+      self.assertEqual(game.get_characters(), [])
+
+   def test_active_quests(self):
+      game = Game()
+      game.add_event(E.Quest_Start("orc extermination", "kill the orcs"))
+      game.add_event(E.Quest_Start("lost ring", "find the ring"))
+      self.assertEqual([q.quest_name for q in game.get_active_quests()], ["Lost Ring", "Orc Extermination"])
+      game.add_event(E.Quest_Complete("Orc Extermination"))
+      self.assertEqual([q.quest_name for q in game.get_active_quests()], ["Lost Ring"])
+      game.add_event(E.Quest_Start("orc extermination", "the orcs came back"))
+      self.assertEqual([q.quest_description for q in game.get_active_quests()], ["the orcs came back", "find the ring"])
+
+   def test_replay_matches_incremental(self):
+      game = load_game("town_talk")
+      replayed = Game.from_json(game.to_json())
+      self.assertEqual(replayed.state, game.state)
+      self.assertEqual(replayed.town, game.town)
+      self.assertEqual(replayed.quests, game.quests)
+      self.assertEqual(replayed.characters, game.characters)
+
+class Test_Game_Index(unittest.TestCase):
+
+   def test_get_events_single_type(self):
+      game = load_game("town_talk")
+      self.assertEqual([e.text[:5] for e in game.get_events(E.Speak_Event)], ["Hello", "I am "])
+      self.assertEqual([e.text[:5] for e in game.get_events(E.Speak_Event, reverse=True)], ["I am ", "Hello"])
+   def test_get_events_merged_order(self):
+      game = load_game("town_talk")
+      events = list(game.get_events(E.Arrive_At_Town_Event, E.Speak_Event, E.Create_New_Town_Event))
+      self.assertEqual([type(e) for e in events], [E.Create_New_Town_Event, E.Arrive_At_Town_Event, E.Speak_Event, E.Speak_Event])
+      self.assertEqual(list(game.get_events(E.Arrive_At_Town_Event, E.Speak_Event, E.Create_New_Town_Event, reverse=True)), events[::-1])
+   def test_get_events_base_class(self):
+      game = load_game("town_talk")
+      self.assertEqual(list(game.get_events(Event)), list(game.events))
+
+   def test_get_last_event(self):
+      game = load_game("town_talk")
+      self.assertTrue(game.get_last_event(E.Speak_Event).is_player_speaking)
+      self.assertFalse(game.get_last_event(E.Speak_Event, limit_fnx=(lambda e: not e.is_player_speaking)).is_player_speaking)
+      with self.assertRaises(RuntimeError):
+         game.get_last_event(E.Quest_Start)
+
+   def test_keyed_lookups(self):
+      game = load_game("town_talk")
+      self.assertEqual(game.get_character("Gilda").town_name, "Whisperwind Village")
+      with self.assertRaises(RuntimeError):
+         game.get_character("Bob")
+      town = game.get_town("whisperwind village")
+      assert town is not None
+      self.assertEqual(town.name, "Whisperwind Village")
+      self.assertIsNone(game.get_town("Stonehaven"))
+
+   def test_conversation_history(self):
+      game = load_game("town_talk")
+      self.assertEqual(len(game.get_conversation_history("Gilda")), 2)
+      self.assertEqual(game.get_conversation_history("Bob"), [])
+
+class Test_Game_Fork(unittest.TestCase):
+
+   def test_fork_is_isolated(self):
+      game = load_game("town_idle")
+      fork = game.copy()
+      fork.add_event(E.Create_Character_Event("bob", "Whisperwind Village", "a farmer", ""))
+      fork.add_event(E.Quest_Start("lost ring", "find the ring"))
+      self.assertEqual(len(fork.events), len(game.events) + 2)
+      self.assertEqual(len(fork.get_characters()), len(game.get_characters()) + 1)
+      self.assertEqual(len(fork.get_active_quests()), 1)
+      self.assertEqual(game.get_active_quests(), [])
+      self.assertNotIn("Bob", game.named_characters)
+      self.assertEqual(list(game.get_events(E.Create_Character_Event)), list(fork.get_events(E.Create_Character_Event))[:-1])
+
+   def test_parent_appends_hidden_from_fork(self):
+      game = load_game("town_idle")
+      fork = game.copy()
+      game.add_event(E.Player_Input_Event("hello"))
+      self.assertEqual(len(fork.events), len(game.events) - 1)
+      self.assertEqual(list(fork.events), list(game.events)[:-1])
+      self.assertEqual(list(reversed(fork.events)), list(reversed(game.events))[1:])
+      self.assertNotEqual(fork.get_last_event(E.Player_Input_Event).text, "hello")
+      with self.assertRaises(IndexError):
+         fork.events[len(fork.events)]
+
+   def test_commit(self):
+      game = load_game("town_idle")
+      fork = game.copy()
+      fork.add_event(E.Create_Character_Event("bob", "Whisperwind Village", "a farmer", ""))
+      fork.add_event(E.Start_Conversation_Event("Bob"))
+      fork.commit()
+      self.assertEqual(game.get_current_state(), State.TOWN_TALK)
+      self.assertEqual(game.get_character("Bob").background, "a farmer")
+      self.assertEqual(game.events.entries[-1], fork.events[-1])
+      self.assertEqual(game.to_json(), fork.to_json())
+      self.assertEqual(len(fork.events.entries), 0)
+
+   def test_commit_conflict(self):
+      game = load_game("town_idle")
+      fork = game.copy()
+      fork.add_event(E.Player_Input_Event("from fork"))
+      game.add_event(E.Player_Input_Event("from parent"))
+      with self.assertRaises(RuntimeError):
+         fork.commit()
+
+   def test_discard(self):
+      game = load_game("town_idle")
+      fork = game.copy()
+      fork.add_event(E.Arrive_At_Town_Event("Stonehaven"))
+      fork.discard()
+      self.assertEqual(fork.get_current_town(), game.get_current_town())
+      self.assertEqual(len(fork.events), len(game.events))
+
+   def test_parent_list_appends_hidden_from_fork(self):
+      game = load_game("town_talk")
+      fork = game.copy()
+      conversation = fork.get_conversation("Gilda")
+      game.add_event(E.Speak_Event("Gilda", True, "said after the fork"))
+      game.add_event(E.Quest_Start("lost ring", "find the ring"))
+      self.assertEqual(fork.get_conversation("Gilda"), conversation)
+      self.assertEqual(fork.get_active_quests(), [])
+      fork.add_event(E.Speak_Event("Gilda", True, "said in the fork"))
+      self.assertEqual(fork.get_conversation("Gilda"), conversation + 'speak_player_to_npc("said in the fork")\n')
+      self.assertTrue(game.get_conversation("Gilda").endswith('speak_player_to_npc("said after the fork")\n'))
+      self.assertEqual(len(game.get_conversation_history("Gilda")), len(fork.get_conversation_history("Gilda")))
+
+   def test_lists_appended_in_place(self):
+      game = Game()
+      game.add_event(E.Speak_Event("Gilda", True, "first"))
+      positions = game.conversations["Gilda"].items
+      lines = game.conversation_text["Gilda"].items
+      for i in range(1000):
+         game.add_event(E.Speak_Event("Gilda", i % 2 == 0, f"line {i}"))
+      self.assertIs(game.conversations["Gilda"].items, positions)
+      self.assertIs(game.conversation_text["Gilda"].items, lines)
+      fork = game.copy()
+      fork.add_event(E.Speak_Event("Gilda", True, "from the fork"))
+      fork.commit()
+      self.assertIs(game.conversations["Gilda"].items, positions)
+      self.assertIs(game.conversation_text["Gilda"].items, lines)
+      self.assertEqual(len(lines), 1002)
+      self.assertTrue(game.get_conversation("Gilda").endswith('speak_player_to_npc("from the fork")\n'))
+
+   def test_fork_does_not_copy_history(self):
+      game = Game([E.Player_Input_Event(str(i)) for i in range(1000)])
+      fork = game.copy()
+      self.assertIs(fork.events.parent, game.events)
+      self.assertEqual(fork.events.entries, [])
+
+class Test_Journal(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.TemporaryDirectory()
+      self.path = os.path.join(self.tmpdir.name, "game.jsonl")
+   def tearDown(self):
+      self.tmpdir.cleanup()
+
+   def test_round_trip(self):
+      game = load_game("town_talk")
+      with Journal(self.path, fsync="always") as journal:
+         self.assertEqual(journal.write(game), len(game.events))
+      self.assertEqual(load_journal(self.path).to_json(), game.to_json())
+
+   def test_only_appends_new_events(self):
+      game = load_game("town_idle")
+      with Journal(self.path, fsync="never") as journal:
+         journal.write(game)
+         size = os.path.getsize(self.path)
+         self.assertEqual(journal.write(game), 0)
+         game.add_event(E.Player_Input_Event("hello"))
+         self.assertEqual(journal.write(game), 1)
+      with open(self.path, "rb") as f:
+         f.seek(size)
+         self.assertEqual(json.loads(f.read()), {"cls":"Player_Input_Event", "text":"hello"})
+      self.assertEqual(load_journal(self.path).to_json(), game.to_json())
+
+   def test_torn_final_line(self):
+      game = load_game("town_talk")
+      with Journal(self.path) as journal:
+         journal.write(game)
+      with open(self.path, "ab") as f:
+         f.write(b'{"cls": "Player_Input_Event", "te')
+      self.assertEqual(load_journal(self.path).to_json(), game.to_json())
+
+      resumed = load_journal(self.path)
+      resumed.add_event(E.Player_Input_Event("after crash"))
+      with Journal(self.path, written=len(game.events)) as journal:
+         journal.write(resumed)
+      self.assertEqual(load_journal(self.path).to_json(), resumed.to_json())
+
+   def test_corrupt_middle_line(self):
+      with open(self.path, "wb") as f:
+         f.write(b'{"cls": "Player_Input_Event", "te\n{"cls": "Player_Input_Event", "text": "hi"}\n')
+      with self.assertRaises(ValueError):
+         load_journal(self.path)
+
+class Test_Snapshot(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.TemporaryDirectory()
+      self.path = os.path.join(self.tmpdir.name, "game.jsonl")
+      self.game = load_game("town_idle")
+      for i in range(10):
+         self.game.add_event(E.Create_Character_Event(f"npc {i}", "Whisperwind Village", "a villager", ""))
+         self.game.add_event(E.Quest_Start(f"quest {i}", "do a thing"))
+   def tearDown(self):
+      self.tmpdir.cleanup()
+
+   def write_with_snapshot(self) -> int:
+      with Journal(self.path) as journal:
+         journal.write(self.game)
+         journal.snapshot(self.game)
+         offset = len(self.game.events)
+         self.game.add_event(E.Quest_Complete("Quest 3"))
+         self.game.add_event(E.Start_Conversation_Event("Npc 4"))
+         journal.write(self.game)
+      return offset
+
+   def test_tail_replay_matches_full(self):
+      offset = self.write_with_snapshot()
+      game = load_journal_game(self.path, verify=True)
+      self.assertIsInstance(game.events.entries, Journal_Prefix)
+      self.assertEqual(game.events.entries.count, offset)
+      self.assertEqual(game.get_projection(), self.game.get_projection())
+      self.assertEqual(game.to_json(), self.game.to_json())
+
+   def test_prefix_is_lazy(self):
+      self.write_with_snapshot()
+      game = load_journal_game(self.path)
+      prefix = game.events.entries
+      decoded = sum(e is not None for e in prefix.cache)
+      self.assertLess(decoded, prefix.count)
+      self.assertEqual(game.get_character("Npc 4").character_name, "Npc 4")
+      self.assertEqual(sum(e is not None for e in prefix.cache), decoded + 1)
+
+   def test_prefix_read_sequentially(self):
+      self.write_with_snapshot()
+      game = load_journal_game(self.path)
+      prefix = game.events.entries
+      opened: List[str] = []
+      def counting_open(*args, **kwargs):
+         opened.append(args[0])
+         return open(*args, **kwargs)
+      journal_module = sys.modules[Journal.__module__]
+      journal_module.open = counting_open # type: ignore
+      try:
+         self.assertEqual([Game.event_to_json(e) for e in game.events.tail(3)], [Game.event_to_json(e) for e in self.game.events.tail(3)])
+      finally:
+         del journal_module.open # type: ignore
+      self.assertLessEqual(len(opened), 2)
+      self.assertTrue(all(e is not None for e in prefix.cache[3:]))
+      self.assertEqual([Game.event_to_json(e) for e in game.events], [Game.event_to_json(e) for e in self.game.events])
+
+   def test_keeps_latest_snapshots(self):
+      with Journal(self.path, snapshot_every=2) as journal:
+         for i in range(7):
+            self.game.add_event(E.Player_Input_Event(str(i)))
+            journal.write(self.game)
+      self.assertEqual([o for o,_ in list_snapshots(self.path)], [len(self.game.events), len(self.game.events) - 2])
+      self.assertEqual(load_journal_game(self.path, verify=True).to_json(), self.game.to_json())
+
+   def test_invalid_snapshot_skipped(self):
+      self.write_with_snapshot()
+      _, snapshot = list_snapshots(self.path)[0]
+      with open(snapshot, "w") as f:
+         f.write("{ not json")
+      game = load_journal_game(self.path)
+      self.assertIsInstance(game.events.entries, list)
+      self.assertEqual(game.to_json(), self.game.to_json())
+
+   def test_mismatched_journal_snapshot_skipped(self):
+      self.write_with_snapshot()
+      with open(self.path, "r+b") as f:
+         f.truncate(os.path.getsize(self.path) // 2)
+      game = load_journal_game(self.path)
+      self.assertIsInstance(game.events.entries, list)
+      self.assertLess(len(game.events), len(self.game.events))
+
+class Test_Codec(unittest.TestCase):
+
+   def sample_event(self, cls, seed:int) -> Event:
+      samples = { 0: (lambda n: f"{cls.__name__} {n} caf\u00e9 \"quoted\""), 1: (lambda n: n % 2 == 0), 2: (lambda n: n * 1000 - 3) }
+      return cls(*[samples[code](seed) for _, code in event_fields(cls)])
+
+   def test_round_trip_every_event(self):
+      events = [self.sample_event(cls, i) for i, cls in enumerate(E.event_dictionary.values())]
+      events += [self.sample_event(cls, -i) for i, cls in enumerate(E.event_dictionary.values())]
+      decoded = decode_events(encode_events(events))
+      self.assertEqual([type(e) for e in decoded], [type(e) for e in events])
+      self.assertEqual(decoded, events)
+
+   def test_round_trip_game(self):
+      game = load_game("town_talk")
+      self.assertEqual(decode_game(encode_game(game)).to_json(), game.to_json())
+      self.assertEqual(decode_events(encode_events([])), [])
+
+   def test_repeated_strings_stored_once(self):
+      one = encode_events([E.Arrive_At_Town_Event("Whisperwind Village")])
+      many = encode_events([E.Arrive_At_Town_Event("Whisperwind Village")] * 100)
+      self.assertEqual(one.count(b"Whisperwind Village"), 1)
+      self.assertEqual(many.count(b"Whisperwind Village"), 1)
+
+   def test_bad_data(self):
+      data = encode_game(load_game("town_talk"))
+      with self.assertRaises(ValueError):
+         decode_events(b"JUNK" + data[4:])
+      with self.assertRaises(ValueError):
+         decode_events(data + b"\x00")
+
+class Test_Event_Memory(unittest.TestCase):
+
+   def test_events_are_slotted(self):
+      for cls in E.event_dictionary.values():
+         self.assertEqual(cls.__dictoffset__, 0, f"{cls.__name__} instances have a __dict__")
+      event = E.Arrive_At_Town_Event("Stonehaven")
+      with self.assertRaises(AttributeError):
+         event.not_a_field = 1 # type: ignore
+
+   def test_clean_interns_names(self):
+      game = Game()
+      game.add_event(E.Arrive_At_Town_Event("".join(["stone", "haven"])))
+      game.add_event(E.Create_Character_Event("".join(["gil", "da"]), game.get_current_town(), "an innkeeper", ""))
+      game.add_event(E.Start_Conversation_Event("".join(["Gil", "da"])))
+      game.add_event(E.Speak_Event("".join(["Gil", "da"]), True, "hello"))
+      self.assertIs(game.events[1].character_name, game.events[2].character_name)
+      self.assertIs(game.events[2].character_name, game.events[3].with_character)
+      self.assertIs(game.events[0].town_name, game.events[1].town_name)
+
+   def test_json_compatible(self):
+      game = load_game("town_talk")
+      self.assertEqual(Game.from_json(json.loads(json.dumps(game.to_json()))).to_json(), game.to_json())
+      self.assertIn("Speak_Event", E.event_dictionary)
+
+class Test_Overview_Cache(unittest.TestCase):
+
+   def naive_overview(self, game:Game) -> str:
+      town = game.get_current_town()
+      return "".join(t+"\n" for t in (e.system(town) for e in game.events) if t is not None)
+
+   def test_matches_full_render(self):
+      game = load_game("town_talk")
+      self.assertEqual(game.get_overview(), self.naive_overview(game))
+      game.add_event(E.Describe_Environment_Event("a quiet square", game.get_current_town()))
+      self.assertEqual(game.get_overview(), self.naive_overview(game))
+      game.add_event(E.Create_New_Town_Event("stonehaven", "a mining town", ""))
+      game.add_event(E.Arrive_At_Town_Event("Stonehaven"))
+      game.add_event(E.Describe_Environment_Event("a dusty road", "Stonehaven"))
+      self.assertEqual(game.get_overview(), self.naive_overview(game))
+      self.assertNotIn("a quiet square", game.get_overview())
+      game.add_event(E.Arrive_At_Town_Event("Whisperwind Village"))
+      self.assertEqual(game.get_overview(), self.naive_overview(game))
+      self.assertIn("a quiet square", game.get_overview())
+
+   def test_only_new_events_rendered(self):
+      game = load_game("town_talk")
+      game.get_overview()
+      covered, _ = game.overview[game.get_current_town()]
+      self.assertEqual(covered, len(game.events))
+      game.add_event(E.Player_Input_Event("hello"))
+      game.get_overview()
+      self.assertEqual(game.overview[game.get_current_town()][0], len(game.events))
+
+   def test_fork_commit_keeps_cache(self):
+      game = load_game("town_talk")
+      game.get_overview()
+      fork = game.copy()
+      fork.add_event(E.Describe_Environment_Event("a quiet square", fork.get_current_town()))
+      self.assertIn("a quiet square", fork.get_overview())
+      self.assertNotIn("a quiet square", game.get_overview())
+      fork.commit()
+      self.assertEqual(game.overview[game.get_current_town()][0], len(game.events))
+      self.assertEqual(game.get_overview(), self.naive_overview(game))
+
+   def test_shared_lines_spliced_per_town(self):
+      game = load_game("town_talk")
+      towns = [game.get_current_town(), "Stonehaven", "Emberfall"]
+      for town in towns[1:]:
+         game.add_event(E.Create_New_Town_Event(town, f"a town called {town}", ""))
+      for i in range(30):
+         town = towns[i % 3]
+         game.add_event(E.Arrive_At_Town_Event(town))
+         game.add_event(E.Describe_Environment_Event(f"view {i}", town))
+         game.add_event(E.Create_Character_Event(f"npc {i}", town, "a local", "tall"))
+         game.add_event(E.Player_Input_Event(f"input {i}"))
+         if i % 7 == 0:
+            self.assertEqual(game.get_overview(towns[(i + 1) % 3]), "".join(t+"\n" for t in (e.system(towns[(i + 1) % 3]) for e in game.events) if t is not None))
+      for town in towns:
+         self.assertEqual(game.get_overview(town), "".join(t+"\n" for t in (e.system(town) for e in game.events) if t is not None))
+      self.assertEqual(game.overview_shared[0], len(game.events))
+      self.assertEqual(len(game.overview_local["Stonehaven"]), 20)
+
+   def test_local_positions_appended_in_place(self):
+      game = main.new_game()
+      town = game.get_current_town()
+      game.add_event(E.Describe_Environment_Event("view 0", town))
+      positions = game.overview_local[town].items
+      fork = game.copy()
+      for i in range(1, 100):
+         fork.add_event(E.Describe_Environment_Event(f"view {i}", town))
+      self.assertEqual(len(game.overview_local[town]), 1)
+      fork.commit()
+      self.assertIs(game.overview_local[town].items, positions)
+      self.assertEqual(len(positions), 100)
+      self.assertEqual(game.get_overview(), "".join(t+"\n" for t in (e.system(town) for e in game.events) if t is not None))
+
+class Test_Conversation_Store(unittest.TestCase):
+
+   def test_rendered_conversation(self):
+      game = load_game("town_talk")
+      expected = "".join(e.render()+"\n" for e in game.get_events(E.Speak_Event) if e.with_character == "Gilda")
+      self.assertEqual(game.get_conversation("Gilda"), expected)
+      self.assertEqual(game.get_conversation("Bob"), "")
+
+   def test_appends_per_character(self):
+      game = load_game("town_talk")
+      before = game.get_conversation("Gilda")
+      game.add_event(E.Speak_Event("Bob", True, "hi bob"))
+      game.add_event(E.Speak_Event("Gilda", False, 'she says "hello"'))
+      self.assertEqual(game.get_conversation("Gilda"), before + "speak_npc_to_player(\"she says 'hello'\")\n")
+      self.assertEqual(game.get_conversation("Bob"), "speak_player_to_npc(\"hi bob\")\n")
+      last = game.get_last_speech("Gilda")
+      assert last is not None
+      self.assertFalse(last.is_player_speaking)
+      self.assertIsNone(game.get_last_speech("Thorne"))
+      self.assertEqual(len(game.get_conversation_history("Gilda")), 3)
+
+   def test_fork_isolated(self):
+      game = load_game("town_talk")
+      fork = game.copy()
+      fork.add_event(E.Speak_Event("Gilda", False, "only in the fork"))
+      self.assertNotIn("only in the fork", game.get_conversation("Gilda"))
+      self.assertEqual(len(game.get_conversation_history("Gilda")), 2)
+      self.assertEqual(len(fork.get_conversation_history("Gilda")), 3)
+
+class Test_Stream(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.TemporaryDirectory()
+      self.path = os.path.join(self.tmpdir.name, "data.json")
+   def tearDown(self):
+      self.tmpdir.cleanup()
+
+   def write(self, text:str) -> str:
+      with open(self.path, "w") as f:
+         f.write(text)
+      return self.path
+
+   def test_matches_json_load(self):
+      data = [{"a": "x, ] } [ { \" y"}, 12345, -0.5, "tail", [1, [2, 3]], None, True, {"nested": {"k": [1, 2]}}]
+      for indent in (None, "\t"):
+         path = self.write(json.dumps(data, indent=indent))
+         for chunk_size in (1, 3, 7, 64, 1<<16):
+            self.assertEqual(list(iter_json_array(path, chunk_size)), data, f"chunk_size={chunk_size} indent={indent!r}")
+
+   def test_empty_and_bad_input(self):
+      self.assertEqual(list(iter_json_array(self.write("  [ \n ] "), 2)), [])
+      with self.assertRaises(ValueError):
+         list(iter_json_array(self.write('{"a": 1}')))
+      with self.assertRaises(ValueError):
+         list(iter_json_array(self.write('[{"a": 1} {"b": 2}]')))
+      with self.assertRaises(ValueError):
+         list(iter_json_array(self.write('[{"a": 1}, {"b": ')))
+
+   def test_is_lazy(self):
+      path = self.write('[{"a": 1}, {"b": 2}, not json')
+      entries = iter_json_array(path, 4)
+      self.assertEqual(next(entries), {"a": 1})
+      self.assertEqual(next(entries), {"b": 2})
+      with self.assertRaises(ValueError):
+         next(entries)
+
+   def test_events_and_decision_log(self):
+      game = load_json_game("test/inputs/town_talk_events.json")
+      self.assertEqual(game.to_json(), load_game("town_talk").to_json())
+      self.assertEqual([type(e) for e in read_events("test/inputs/town_idle_events.json", 5)], [type(e) for e in load_game("town_idle").events])
+      with open("test/outputs/town_talk_decisions.json") as f:
+         self.assertEqual(list(read_decision_log("test/outputs/town_talk_decisions.json", 100)), json.load(f))
+
+class Fake_LLM_Handler(BaseHTTPRequestHandler):
+   delay = 0.0
+   chunk_delay = 0.0
+   chunk_size = 4
+   reply = "ok"
+   failures = 0
+   failure_status = 500
+   delays: List[float] = []
+   candidates: List[str] = []
+   grammars: List[Dict] = []
+   bodies: List[Dict] = []
+   in_flight = 0
+   max_in_flight = 0
+   requests = 0
+   lock = threading.Lock()
+
+   def do_POST(self):
+      cls = type(self)
+      with cls.lock:
+         cls.requests += 1
+         cls.in_flight += 1
+         cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+      try:
+         request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+         with cls.lock:
+            index = cls.requests - 1
+            cls.bodies.append(request)
+         if index < cls.failures:
+            self.send_error(cls.failure_status)
+            return
+         if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            reply = self.choose_reply(request)
+            for i in range(0, len(reply), cls.chunk_size):
+               time.sleep(cls.chunk_delay)
+               chunk = json.dumps({
+                  "id": "fake", "object": "chat.completion.chunk", "created": 0, "model": "fake",
+                  "choices": [{"index": 0, "finish_reason": None, "delta": {"content": reply[i:i+cls.chunk_size]}}],
+               })
+               self.wfile.write(f"data: {chunk}\n\n".encode())
+               self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            return
+         time.sleep(cls.delays[index] if index < len(cls.delays) else cls.delay)
+         body = json.dumps({
+            "id": "fake", "object": "chat.completion", "created": 0, "model": "fake",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": self.choose_reply(request)}}],
+         }).encode()
+         self.send_response(200)
+         self.send_header("Content-Type", "application/json")
+         self.send_header("Content-Length", str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+      except (BrokenPipeError, ConnectionResetError):
+         pass
+      finally:
+         with cls.lock:
+            cls.in_flight -= 1
+   # stands in for constrained decoding by replying with the first candidate the requested grammar accepts
+   def choose_reply(self, request:Dict) -> str:
+      cls = type(self)
+      if len(cls.candidates) == 0:
+         return cls.reply
+      if "grammar" in request:
+         pattern = gbnf_to_regex(request["grammar"])
+      elif "guided_regex" in request:
+         pattern = request["guided_regex"]
+      else:
+         return cls.candidates[0]
+      cls.grammars.append(request)
+      return next(c for c in cls.candidates if re.fullmatch(pattern, c))
+   def log_message(self, *_):
+      pass
+
+GBNF_TOKEN = re.compile(r'\s*("(?:[^"\\]|\\.)*"|\[(?:[^\]\\]|\\.)*\]|[a-z][a-z0-9-]*|[()|*+?])')
+def gbnf_to_regex(grammar:str, rule:str="root") -> str:
+   rules = dict(line.split(" ::= ", 1) for line in grammar.strip().split("\n"))
+   regex = ""
+   for token in GBNF_TOKEN.findall(rules[rule]):
+      if token.startswith('"'):
+         regex += re.escape(json.loads(token))
+      elif token.startswith("["):
+         regex += token
+      elif token == "(":
+         regex += "(?:"
+      elif token[0].isalpha():
+         regex += "(?:" + gbnf_to_regex(grammar, token) + ")"
+      else:
+         regex += token
+   return regex
+
+def start_fake_llm(handler_cls) -> ThreadingHTTPServer:
+   httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_cls)
+   httpd.daemon_threads = True
+   threading.Thread(target=httpd.serve_forever, daemon=True).start()
+   return httpd
+
+class Fake_LLM_Test_Case(unittest.TestCase):
+   handler_base = Fake_LLM_Handler
+
+   def setUp(self):
+      self.handler = type("Handler", (self.handler_base,), {"in_flight": 0, "max_in_flight": 0, "requests": 0, "lock": threading.Lock(), "grammars": [], "bodies": []})
+      self.httpd = start_fake_llm(self.handler)
+      self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+   def tearDown(self):
+      self.httpd.shutdown()
+      self.httpd.server_close()
+
+class Test_Completion_Client(Fake_LLM_Test_Case):
+
+   def test_complete(self):
+      self.handler.reply = " the reply <|im_end|>"
+      async def main():
+         client = Completion_Client(base_url=self.base_url)
+         try:
+            return await client.complete("prompt")
+         finally:
+            await client.close()
+      self.assertEqual(asyncio.run(main()), "the reply")
+
+   def test_concurrency_limit(self):
+      self.handler.delay = 0.05
+      async def main():
+         client = Completion_Client(base_url=self.base_url, max_concurrency=2)
+         try:
+            return await asyncio.gather(*(client.complete(f"prompt {i}") for i in range(6)))
+         finally:
+            await client.close()
+      self.assertEqual(asyncio.run(main()), ["ok"] * 6)
+      self.assertEqual(self.handler.max_in_flight, 2)
+
+   def test_timeout(self):
+      self.handler.delay = 1.0
+      async def main():
+         client = Completion_Client(base_url=self.base_url, backoff=0.01)
+         try:
+            await client.complete("prompt", timeout=0.1)
+         finally:
+            await client.close()
+      with self.assertRaises(Completion_Failed) as ctx:
+         asyncio.run(main())
+      self.assertIsInstance(ctx.exception.__cause__, asyncio.TimeoutError)
+
+   def test_sync_wrapper(self):
+      client = Completion_Client(base_url=self.base_url)
+      self.assertEqual([run_sync(client.complete("prompt")) for _ in range(3)], ["ok"] * 3)
+
+class Test_Latency_Budget(Fake_LLM_Test_Case):
+
+   def run_client(self, fnx, **kwargs):
+      async def main():
+         client = Completion_Client(base_url=self.base_url, backoff=0.01, **kwargs)
+         try:
+            return await fnx(client)
+         finally:
+            await client.close()
+      return asyncio.run(main())
+
+   def test_retry_server_errors(self):
+      self.handler.failures = 2
+      self.assertEqual(self.run_client(lambda client: client.complete("prompt")), "ok")
+      self.assertEqual(self.handler.requests, 3)
+
+   def test_retries_exhausted(self):
+      self.handler.failures = 5
+      with self.assertRaises(Completion_Failed):
+         self.run_client(lambda client: client.complete("prompt"), retries=1)
+      self.assertEqual(self.handler.requests, 2)
+
+   def test_client_errors_not_retried(self):
+      self.handler.failures = 5
+      for status in (400, 401):
+         self.handler.requests = 0
+         self.handler.failure_status = status
+         with self.assertRaises(Completion_Failed):
+            self.run_client(lambda client: client.complete("prompt"), retries=3)
+         self.assertEqual(self.handler.requests, 1)
+
+   def test_hung_server_within_budget(self):
+      self.handler.delay = 5.0
+      start = time.perf_counter()
+      with self.assertRaises(Budget_Exceeded):
+         self.run_client(lambda client: client.complete("prompt", deadline=Deadline(0.3)), retries=5)
+      self.assertLess(time.perf_counter() - start, 1.0)
+
+   def test_hedged_request(self):
+      self.handler.delays = [0.0, 2.0]
+      async def fnx(client:Completion_Client):
+         await client.complete("warm up")
+         start = time.perf_counter()
+         resp = await client.complete("prompt")
+         return resp, time.perf_counter() - start, client.hedged
+      resp, elapsed, hedged = self.run_client(fnx, hedge_percentile=0.9, hedge_min_samples=1)
+      self.assertEqual((resp, hedged), ("ok", 1))
+      self.assertLess(elapsed, 1.0)
+      self.assertEqual(self.handler.requests, 3)
+
+   def test_turn_fails_cleanly(self):
+      self.handler.delay = 5.0
+      game = main.new_game()
+      game.add_event(E.Player_Input_Event("look around"))
+      decision_log: List[Dict] = []
+      async def run():
+         client = Completion_Client(base_url=self.base_url, backoff=0.01)
+         try:
+            return await main.process_game_state_async(game, client.complete, decision_log, budget=0.3)
+         finally:
+            await client.close()
+      start = time.perf_counter()
+      self.assertIsNone(asyncio.run(run()))
+      self.assertLess(time.perf_counter() - start, 1.0)
+      events = [e["event"] for e in decision_log]
+      self.assertIn("ERROR: Completion Failed", events)
+      self.assertEqual(events[-1], "Reached Latency Budget (0.3s), Exiting")
+
+   def test_bad_request_fails_turn(self):
+      self.handler.failures = 100
+      self.handler.failure_status = 400
+      game = main.new_game()
+      game.add_event(E.Player_Input_Event("look around"))
+      decision_log: List[Dict] = []
+      async def run():
+         client = Completion_Client(base_url=self.base_url, backoff=0.01)
+         try:
+            return await main.process_game_state_async(game, client.complete, decision_log, max_errors=2)
+         finally:
+            await client.close()
+      self.assertIsNone(asyncio.run(run()))
+      events = [e["event"] for e in decision_log]
+      self.assertEqual(events.count("ERROR: Completion Failed"), 2)
+      self.assertEqual(events[-1], "Reached Max Errors (2), Exiting")
+
+class Test_Prompt_Budget(unittest.TestCase):
+
+   def setUp(self):
+      self.calls: List[str] = []
+      async def summarize(section:str, previous:str, content:str) -> str:
+         self.calls.append(content)
+         return f"{section} summary {len(self.calls)}"
+      self.prompt_budget = Prompt_Budget(summarize, { "OVERVIEW":400, "CONVERSATION":300 }, chunk_lines=4, summary_tokens=20)
+
+   def talk(self, game:Game, count:int) -> None:
+      for i in range(count):
+         game.add_event(E.Speak_Event("Gilda", i % 2 == 0, f"This is line number {i} of a conversation that keeps on going"))
+
+   def test_within_budget(self):
+      game = load_game("town_talk")
+      self.assertEqual(asyncio.run(self.prompt_budget.compact(game)), {})
+      self.assertEqual(asyncio.run(main.get_budgeted_prompt(game, self.prompt_budget)), main.get_prompt_from_game_state(game))
+
+   def test_prompt_size_stays_constant(self):
+      game = load_game("town_talk")
+      sizes = []
+      for _ in range(20):
+         self.talk(game, 20)
+         prompt, _ = asyncio.run(main.get_budgeted_prompt(game, self.prompt_budget))
+         sizes.append(estimate_tokens(prompt))
+      self.assertLess(max(sizes[2:]) - min(sizes[2:]), 60)
+      self.assertLess(max(sizes), estimate_tokens(main.get_prompt_from_game_state(game)[0]) / 5)
+
+   def test_summaries_reused(self):
+      game = load_game("town_talk")
+      self.talk(game, 100)
+      compacted = asyncio.run(self.prompt_budget.compact(game))
+      self.assertEqual(list(compacted.keys()), ["CONVERSATION"])
+      self.assertTrue(compacted["CONVERSATION"].startswith(f"Summary of everything before this point: CONVERSATION summary {len(self.calls)}\n"))
+      calls = len(self.calls)
+      self.assertEqual(asyncio.run(self.prompt_budget.compact(game)), compacted)
+      self.assertEqual(len(self.calls), calls)
+      self.talk(game, 4)
+      asyncio.run(self.prompt_budget.compact(game))
+      self.assertLessEqual(len(self.calls) - calls, 2)
+      self.assertEqual(len(self.calls), len(set(self.calls)))
+
+   def test_process_game_state(self):
+      game = load_game("town_talk")
+      self.talk(game, 100)
+      decision_log: List[Dict] = []
+      async def outputs(prompt:str) -> str:
+         return ""
+      asyncio.run(main.process_game_state_async(game, outputs, decision_log, max_errors=1, prompt_budget=self.prompt_budget))
+      self.assertIn("Summary of everything before this point: CONVERSATION summary", "\n".join(decision_log[0]["prompt"]))
+
+   def explore(self, game:Game, count:int) -> None:
+      for i in range(count):
+         game.add_event(E.Create_New_Town_Event(f"Town {i}", f"a town that was heard about on the road for the {i}th time", ""))
+         game.add_event(E.Describe_Environment_Event(f"The street of {game.get_current_town()} is busy for the {i}th time today", game.get_current_town()))
+
+   def test_town_change_reuses_shared_summary(self):
+      game = main.new_game()
+      self.explore(game, 60)
+      compacted = asyncio.run(self.prompt_budget.compact(game))
+      self.assertTrue(compacted["OVERVIEW"].startswith("Summary of everything before this point: OVERVIEW summary"))
+      self.assertLessEqual(estimate_tokens(compacted["OVERVIEW"]), 400)
+      calls = len(self.calls)
+      game.add_event(E.Arrive_At_Town_Event("Town 3"))
+      self.explore(game, 2)
+      compacted = asyncio.run(self.prompt_budget.compact(game))
+      self.assertLessEqual(len(self.calls) - calls, 2)
+      self.assertIn("The street of Town 3 is busy for the 1th time today", compacted["OVERVIEW"])
+      self.assertNotIn("Whisperwind Village is busy", compacted["OVERVIEW"])
+
+   def test_summaries_persisted(self):
+      game = main.new_game()
+      self.explore(game, 60)
+      with tempfile.TemporaryDirectory() as dirpath:
+         path = os.path.join(dirpath, "summaries.jsonl")
+         prompt_budget = Prompt_Budget(self.prompt_budget.summarize, self.prompt_budget.section_budgets, chunk_lines=4, summary_tokens=20, path=path)
+         compacted = asyncio.run(prompt_budget.compact(game))
+         self.assertGreater(prompt_budget.summarize_calls, 0)
+         with open(path, "a") as f:
+            f.write('{"key": "torn')
+         reloaded = Prompt_Budget(self.prompt_budget.summarize, self.prompt_budget.section_budgets, chunk_lines=4, summary_tokens=20, path=path)
+         self.assertEqual(asyncio.run(reloaded.compact(game)), compacted)
+         self.assertEqual(reloaded.summarize_calls, 0)
+
+   def test_deadline_passed_to_summarize(self):
+      deadlines = []
+      async def summarize(section:str, previous:str, content:str, **kwargs) -> str:
+         deadlines.append(kwargs.get("deadline"))
+         if kwargs["deadline"].expired():
+            raise Completion_Failed("deadline expired")
+         return "summary"
+      game = load_game("town_talk")
+      self.talk(game, 100)
+      prompt_budget = Prompt_Budget(summarize, { "CONVERSATION":300 }, chunk_lines=4, summary_tokens=20)
+      deadline = Deadline(60.0)
+      self.assertIn("CONVERSATION", asyncio.run(prompt_budget.compact(game, deadline)))
+      self.assertTrue(all(d is deadline for d in deadlines))
+      self.talk(game, 8)
+      self.assertEqual(asyncio.run(prompt_budget.compact(game, Deadline(0.0))), {})
+
+class Test_Mock_LLM(unittest.TestCase):
+
+   def run_mock(self, mock:Mock_LLM, fnx):
+      async def run():
+         server = await mock.serve("127.0.0.1", 0)
+         client = Completion_Client(base_url=f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1", backoff=0.01)
+         try:
+            return await fnx(client)
+         finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+      return asyncio.run(run())
+
+   def test_script_from_injects(self):
+      script = load_script()
+      self.assertIn('"There are many flowers blooming bright and colorful, but no manager to be seen.")', script[("TOWN_IDLE", "FILL_FUNCTION", "describe_surroundings")])
+      self.assertIn("add_quest()", script[("TOWN_TALK", "CHOOSE_FUNCTION", "")])
+      self.assertIn("", script[("TOWN_TALK", "UPDATE_SCRATCHPAD", "")])
+
+   def test_turn_against_mock(self):
+      game = main.new_game()
+      game.add_event(E.Player_Input_Event("look around"))
+      mock = Mock_LLM(load_script(["town_idle"]), latency=0.001)
+      async def fnx(client:Completion_Client):
+         shown: List[str] = []
+         new_game = await main.process_game_state_async(game, client.complete, [], stream_from_prompt=client.stream, on_player_text=shown.append)
+         return new_game, "".join(shown)
+      new_game, shown = self.run_mock(mock, fnx)
+      assert new_game is not None
+      self.assertEqual(new_game.get_last_event(E.Describe_Environment_Event).description, "There are many flowers blooming bright and colorful, but no manager to be seen")
+      self.assertEqual(shown, "There are many flowers blooming bright and colorful, but no manager to be seen.\n")
+      self.assertEqual((mock.requests, mock.unscripted), (4, 0))
+
+   def test_errors(self):
+      mock = Mock_LLM(load_script(), latency=0.0, error_rate=1.0)
+      with self.assertRaises(Completion_Failed):
+         self.run_mock(mock, lambda client: client.complete("prompt"))
+      self.assertEqual((mock.requests, mock.errors), (3, 3))
+
+   def test_load(self):
+      mock = Mock_LLM(load_script(), latency=0.005)
+      report = asyncio.run(run_load(4, 2, mock))
+      summary = report.summary()
+      self.assertEqual((summary["turns"], summary["failed_turns"], summary["unscripted_prompts"]), (8, 0, 0))
+      self.assertGreaterEqual(report.completions, 8 * 4)
+      self.assertTrue(0 < summary["p50"] <= summary["p90"] <= summary["p99"] <= summary["max"])
+      self.assertGreater(summary["turns_per_second"], 0)
+
+class Test_Speculative_Prompt(Fake_LLM_Test_Case):
+
+   def before_input(self, test_name:str) -> Game:
+      game = load_game(test_name)
+      return game if main.awaiting_player(game) else Game(list(game.events)[:-1])
+
+   def test_matches_full_render(self):
+      for test_name in ["town_talk", "town_idle", "on_the_move"]:
+         game = self.before_input(test_name)
+         speculation = asyncio.run(main.speculate_prompt(game))
+         assert speculation is not None
+         main.add_player_input(game, 'I ask "where is the inn?"', [])
+         self.assertEqual(speculation.render(game), main.get_prompt_from_game_state(game)[0], test_name)
+
+   def test_with_prompt_budget(self):
+      async def summarize(section:str, previous:str, content:str) -> str:
+         return f"{section} summary"
+      prompt_budget = Prompt_Budget(summarize, { "CONVERSATION":300 }, chunk_lines=4, summary_tokens=20)
+      game = self.before_input("town_talk")
+      for i in range(40):
+         game.add_event(E.Speak_Event("Gilda", i % 2 == 0, f"This is line number {i} of a conversation that keeps on going"))
+      speculation = asyncio.run(main.speculate_prompt(game, prompt_budget))
+      assert speculation is not None
+      main.add_player_input(game, "And then?", [])
+      self.assertEqual(asyncio.run(main.get_budgeted_prompt(game, prompt_budget, speculation)), asyncio.run(main.get_budgeted_prompt(game, prompt_budget)))
+      self.assertIsNotNone(speculation.render(game, asyncio.run(prompt_budget.compact(game))))
+
+   def test_invalidated(self):
+      game = self.before_input("town_talk")
+      speculation = asyncio.run(main.speculate_prompt(game))
+      assert speculation is not None
+      fork = game.copy()
+      main.add_player_input(fork, "leave", [])
+      self.assertIsNone(speculation.render(fork))
+      main.add_player_input(game, "hello", [])
+      main.add_player_input(game, "again", [])
+      self.assertIsNone(speculation.render(game))
+
+   def test_decision_log_unchanged(self):
+      with open("test/inputs/town_talk_injects.json") as f:
+         injects: Dict[str,List[str]] = json.load(f)
+      game = self.before_input("town_talk")
+      speculation = asyncio.run(main.speculate_prompt(game))
+      main.add_player_input(game, "What do you sell?", [])
+      logs = []
+      for spec in (None, speculation):
+         outputs = list(injects["simple_case"])
+         async def output_from_prompt(_) -> str:
+            return outputs.pop(0)
+         decision_log: List[Dict] = []
+         self.assertIsNotNone(asyncio.run(main.process_game_state_async(game, output_from_prompt, decision_log, speculation=spec)))
+         logs.append(decision_log)
+      self.assertEqual(logs[0], logs[1])
+
+   def test_collected_in_background(self):
+      release = threading.Event()
+      async def summarize(section:str, previous:str, content:str) -> str:
+         await asyncio.get_running_loop().run_in_executor(None, release.wait)
+         return "summary"
+      prompt_budget = Prompt_Budget(summarize, { "CONVERSATION":300 }, chunk_lines=4, summary_tokens=20)
+      game = self.before_input("town_talk")
+      for i in range(40):
+         game.add_event(E.Speak_Event("Gilda", i % 2 == 0, f"This is line number {i} of a conversation that keeps on going"))
+      pending = main.run_in_background(main.speculate_prompt(game.copy(), prompt_budget))
+      self.assertIsNone(main.collect_speculation(pending))
+      release.set()
+      self.assertTrue(pending.cancelled())
+
+      pending = main.run_in_background(main.speculate_prompt(game.copy()))
+      pending.result()
+      speculation = main.collect_speculation(pending)
+      assert speculation is not None
+      main.add_player_input(game, "And then?", [])
+      self.assertEqual(speculation.render(game), main.get_prompt_from_game_state(game)[0])
+
+   def test_warm(self):
+      async def run():
+         client = Completion_Client(base_url=self.base_url)
+         try:
+            return await client.warm("the shared prefix")
+         finally:
+            await client.close()
+      self.assertTrue(asyncio.run(run()))
+      self.assertEqual(len(self.handler.bodies), 1)
+      self.assertEqual(self.handler.bodies[0]["max_tokens"], 1)
+      self.assertTrue(self.handler.bodies[0]["cache_prompt"])
+      self.assertEqual(self.handler.bodies[0]["messages"][0]["content"], "the shared prefix")
+
+   def test_warm_failure_swallowed(self):
+      self.handler.failures = 1
+      async def run():
+         client = Completion_Client(base_url=self.base_url, retries=0)
+         try:
+            return await client.warm("the shared prefix")
+         finally:
+            await client.close()
+      self.assertFalse(asyncio.run(run()))
+
+def png_bytes(width:int, height:int, pixels:bytes) -> bytes:
+   def chunk(kind:bytes, data:bytes) -> bytes:
+      return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+   rows = b"".join(b"\x00" + pixels[y*width*3:(y+1)*width*3] for y in range(height))
+   return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+class Fake_Generator:
+   delay: float
+   size: int
+   calls: List[str]
+
+   # stands in for a txt2img model with a solid color image picked from the description hash
+   def __init__(self, delay:float=0.0, size:int=8):
+      self.delay = delay
+      self.size = size
+      self.calls = []
+
+   async def __call__(self, description:str) -> bytes:
+      self.calls.append(description)
+      await asyncio.sleep(self.delay)
+      color = hashlib.sha256(description.encode()).digest()[:3]
+      return png_bytes(self.size, self.size, color * (self.size * self.size))
+
+class Test_Images(unittest.TestCase):
+
+   def setUp(self):
+      self.tempdir = tempfile.TemporaryDirectory()
+      self.cache = Image_Cache(self.tempdir.name)
+   def tearDown(self):
+      self.tempdir.cleanup()
+
+   def run_queue(self, queue:Image_Queue, fnx):
+      async def main():
+         try:
+            return await fnx()
+         finally:
+            await queue.close()
+      return asyncio.run(main())
+
+   def test_current_town_first(self):
+      game = load_game("town_idle")
+      game.add_event(E.Create_New_Town_Event("Far Reach", "a distant port", "harbor, ships, gulls"))
+      game.add_event(E.Create_Character_Event("Orin", "Far Reach", "a sailor", "beard, blue coat"))
+      game.add_event(E.Create_Character_Event("Mira", game.get_current_town(), "a baker", "apron, flour"))
+      generator = Fake_Generator()
+      queue = Image_Queue(generator, self.cache, workers=1)
+      async def run():
+         futures = queue.submit_events(game, game.events.tail(0))
+         await asyncio.gather(*futures)
+      self.run_queue(queue, run)
+      self.assertEqual(len(generator.calls), 4)
+      self.assertEqual(set(generator.calls[:2]), { game.get_town("Whisperwind Village").description, "apron, flour" })
+      self.assertEqual(set(generator.calls[2:]), { "harbor, ships, gulls", "beard, blue coat" })
+
+   def test_deduplicated_and_cached(self):
+      ready: List[str] = []
+      generator = Fake_Generator(delay=0.01)
+      queue = Image_Queue(generator, self.cache, on_ready=lambda job, path: ready.append(job.name))
+      async def run():
+         return await asyncio.gather(queue.submit("town", "A", "hills, fog"), queue.submit("character", "B", "hills, fog"), queue.submit("character", "C", "red cloak"))
+      paths = self.run_queue(queue, run)
+      self.assertEqual(paths[0], paths[1])
+      self.assertEqual(len(generator.calls), 2)
+      self.assertEqual(sorted(ready), ["A", "C"])
+      with open(paths[0], "rb") as f:
+         self.assertTrue(f.read().startswith(b"\x89PNG"))
+
+      generator = Fake_Generator()
+      queue = Image_Queue(generator, Image_Cache(self.tempdir.name))
+      async def rerun():
+         return await queue.submit("town", "A", "hills, fog")
+      self.assertEqual(self.run_queue(queue, rerun), paths[0])
+      self.assertEqual(generator.calls, [])
+
+   def test_failure(self):
+      calls: List[str] = []
+      async def flaky(description:str) -> bytes:
+         calls.append(description)
+         if len(calls) == 1:
+            raise RuntimeError("generator crashed")
+         return b"image"
+      queue = Image_Queue(flaky, self.cache)
+      async def run():
+         with self.assertRaises(RuntimeError):
+            await queue.submit("town", "A", "hills, fog")
+         return await queue.submit("town", "A", "hills, fog")
+      path = self.run_queue(queue, run)
+      self.assertEqual(queue.failed, 1)
+      self.assertEqual(len(calls), 2)
+      self.assertTrue(os.path.exists(path))
+
+class Test_Template(unittest.TestCase):
+
+   def test_render(self):
+      template = Template("%%A%% and %%B%%", "%%A%% again")
+      template["A"] = "first"
+      template["B"] = "second"
+      template["UNUSED"] = "ignored"
+      self.assertEqual(template.render(), "first and second\n\nfirst again")
+
+   def test_missing_key(self):
+      template = Template("%%A%% and %%B%%")
+      template["A"] = "first"
+      with self.assertRaises(ValueError):
+         template.render()
+
+   def test_values_not_rescanned(self):
+      template = Template("%%A%% then %%B%%")
+      template["A"] = "a literal %%B%%"
+      template["B"] = "second"
+      self.assertEqual(template.render(), "a literal %%B%% then second")
+
+   def test_intro_cached_per_state(self):
+      for state in [State.TOWN_IDLE, State.TOWN_TALK, State.ON_THE_MOVE]:
+         self.assertIs(make_intro_prompt(state), make_intro_prompt(state))
+         self.assertIs(Template(make_intro_prompt(state)).compiled, Template(make_intro_prompt(state)).compiled)
+      for test_name in ["town_talk", "town_idle", "on_the_move"]:
+         game = load_game(test_name)
+         prompt, _ = main.get_prompt_from_game_state(game)
+         self.assertNotIn("%%", prompt)
+         self.assertIn(game.get_overview(), prompt)
+
+class Test_Function_Map(unittest.TestCase):
+
+   def test_frozen(self):
+      self.assertTrue(Function_Map.frozen)
+      with self.assertRaises(RuntimeError):
+         Function_Map.register(Function(lambda _: (True, None), "late_function", "registered too late"), State.TOWN_IDLE)
+      self.assertNotIn("late_function", [f.name for f in Function_Map.get(State.TOWN_IDLE)])
+
+   def test_api_text(self):
+      for state in [State.TOWN_IDLE, State.TOWN_TALK, State.ON_THE_MOVE]:
+         funcs = Function_Map.get(state)
+         self.assertEqual(Function_Map.api_short[state], "".join(f.render_short() for f in funcs))
+         self.assertTrue(all(f.render_long() in Function_Map.api_long[state] for f in funcs if len(f.params) > 0))
+
+   def test_prefixes_shared(self):
+      evolvers = [Prompt_Evolver(State.TOWN_TALK) for _ in range(2)]
+      self.assertIs(evolvers[0].prefixes, evolvers[1].prefixes)
+      self.assertIs(evolvers[0].get_extension(), evolvers[1].get_extension())
+      self.assertIsNot(extension_prefixes(State.TOWN_TALK, True), evolvers[0].prefixes)
+
+async def describe_outputs(prompt:str, **kwargs) -> str:
+   await asyncio.sleep(0)
+   if prompt.endswith("describe_surroundings("):
+      return '"A quiet square with a fountain")'
+   if prompt.endswith("<calling>"):
+      return "describe_surroundings()"
+   return "" if "</calling>" in prompt else "Describe the square"
+
+class Test_Streaming(Fake_LLM_Test_Case):
+
+   def test_quoted_text_stream(self):
+      text_stream = Quoted_Text_Stream()
+      self.assertEqual([text_stream.feed(c) for c in ["'Well", " met,", ' "friend"', "'", ", mood=1)"]], ["Well", " met,", ' "friend"', "", ""])
+      self.assertTrue(text_stream.done)
+      self.assertEqual(Quoted_Text_Stream().feed(")"), "")
+
+   def test_first_delta_before_completion(self):
+      self.handler.reply = '"A quiet square with a fountain")'
+      self.handler.chunk_delay = 0.02
+      async def main():
+         client = Completion_Client(base_url=self.base_url)
+         arrivals = []
+         start = time.perf_counter()
+         try:
+            output = await client.stream("prompt", lambda delta: arrivals.append((time.perf_counter() - start, delta)))
+         finally:
+            await client.close()
+         return output, arrivals, time.perf_counter() - start
+      output, arrivals, total = asyncio.run(main())
+      self.assertEqual(output, self.handler.reply)
+      self.assertEqual("".join(delta for _, delta in arrivals), self.handler.reply)
+      self.assertLess(arrivals[0][0], total / 2)
+
+   def test_process_game_state_streams_text(self):
+      self.handler.reply = '"A quiet square with a fountain")'
+      self.handler.chunk_delay = 0.01
+      game = main.new_game()
+      game.add_event(E.Player_Input_Event("look around"))
+      async def run():
+         client = Completion_Client(base_url=self.base_url)
+         shown = []
+         try:
+            new_game = await main.process_game_state_async(game, describe_outputs, [], stream_from_prompt=client.stream, on_player_text=shown.append)
+         finally:
+            await client.close()
+         return new_game, shown
+      new_game, shown = asyncio.run(run())
+      assert new_game is not None
+      self.assertGreater(len(shown), 2)
+      self.assertEqual("".join(shown), "A quiet square with a fountain\n")
+      self.assertEqual(new_game.get_last_event(E.Describe_Environment_Event).description, "A quiet square with a fountain")
+
+class Test_Harness(unittest.TestCase):
+
+   def test_summarize_decisions(self):
+      decision_log = [
+         {"event":"Got Extension", "micro_state":"SELECT_FUNCTION"},
+         {"event":"ERROR: Got Back Not-OK Processing Output", "message":""},
+         {"event":"Got Extension", "micro_state":"FILL_FUNCTION"},
+         {"event":"ERROR: Got Back Not-OK Calling Function", "message":""},
+         {"event":"Looping Evolver"},
+         {"event":"Got Extension", "micro_state":"FILL_FUNCTION"},
+         {"event":"ERROR: Got Back Not-OK Processing Output", "message":""},
+      ]
+      stats = summarize_decisions(decision_log, True)
+      self.assertEqual(stats.loops, 1)
+      self.assertEqual(stats.errors, {"SELECT_FUNCTION":1, "FILL_FUNCTION":2})
+
+   def run_describe_jobs(self, count:int, concurrency:int):
+      game = main.new_game()
+      game.add_event(E.Player_Input_Event("look around"))
+      async def slow_outputs(prompt:str) -> str:
+         await asyncio.sleep(0.02)
+         return await describe_outputs(prompt)
+      jobs = [Job("town", f"Iteration_{i+1}", slow_outputs) for i in range(count)]
+      start = time.perf_counter()
+      results = asyncio.run(run_jobs({"town":game}, jobs, concurrency))
+      return results, time.perf_counter() - start
+
+   def test_parallel_runs(self):
+      serial, serial_time = self.run_describe_jobs(8, 1)
+      parallel, parallel_time = self.run_describe_jobs(8, 8)
+      self.assertEqual([r.decision_log for r in serial], [r.decision_log for r in parallel])
+      self.assertLess(parallel_time, serial_time / 3)
+      summary = summarize(parallel)["town"]
+      self.assertEqual((summary["runs"], summary["successes"], summary["success_rate"]), (8, 8, 1.0))
+      self.assertLess(summary["wall_time"], summary["mean_run_time"] * 3)
+
+class Test_Fused_Evolver(unittest.TestCase):
+
+   def test_fused_call(self):
+      evolver = Prompt_Evolver(State.TOWN_TALK, fused=True)
+      self.assertTrue(evolver.get_extension().endswith("<scratchpad>"))
+      ok, msg = evolver.process_output('Greet the player\nspeak_npc_to_player("Hello")')
+      self.assertEqual((ok, msg), (True, ""))
+      self.assertEqual(evolver.micro_state, Micro_State.UPDATE_SCRATCHPAD)
+      self.assertEqual(evolver.scratchpad, "Greet the player")
+
+   def test_fused_player_input(self):
+      evolver = Prompt_Evolver(State.TOWN_TALK, fused=True)
+      self.assertTrue(evolver.process_output("get_player_input()")[0])
+      self.assertEqual(evolver.micro_state, Micro_State.DONE)
+
+   def test_fallbacks(self):
+      for output, exp_state in [
+         ('Greet the player\nspeak_npc_to_player()',        Micro_State.FILL_FUNCTION),
+         ('Greet the player\nspeak_npc_to_player("Hello"',  Micro_State.CHOOSE_FUNCTION),
+         ('Greet the player',                                Micro_State.CHOOSE_FUNCTION),
+         ('speak_npc_to_player("Hello"',                     Micro_State.CREATE_SCRATCHPAD),
+         ('Greet the player\ndance("Hello")',               Micro_State.CHOOSE_FUNCTION),
+      ]:
+         evolver = Prompt_Evolver(State.TOWN_TALK, fused=True)
+         ok, msg = evolver.process_output(output)
+         self.assertTrue(ok, output)
+         self.assertIn("falling back", msg, output)
+         self.assertEqual(evolver.micro_state, exp_state, output)
+
+   def test_revert_after_full_call(self):
+      evolver = Prompt_Evolver(State.TOWN_IDLE, fused=True)
+      self.assertTrue(evolver.process_output('Talk to them\nstart_conversation("Nobody Here")')[0])
+      self.assertEqual(evolver.call(load_game("town_idle").copy())[0], False)
+      evolver.revert()
+      self.assertFalse(evolver.should_stream())
+      self.assertTrue(evolver.get_extension().endswith("\nstart_conversation("))
+      evolver = Prompt_Evolver(State.TOWN_IDLE)
+      evolver.process_output("Describe the square")
+      self.assertTrue(evolver.process_output('describe_surroundings("A quiet square")')[0])
+      evolver.revert()
+      self.assertTrue(evolver.should_stream())
+      self.assertTrue(evolver.get_extension().endswith("\ndescribe_surroundings("))
+
+   def test_fallback_keeps_plan(self):
+      evolver = Prompt_Evolver(State.TOWN_IDLE, fused=True)
+      fused_prompt = evolver.get_extension()
+      ok, msg = evolver.process_output("Describe the square\nDone")
+      self.assertTrue(ok)
+      self.assertIn("falling back", msg)
+      self.assertEqual(evolver.micro_state, Micro_State.CHOOSE_FUNCTION)
+      self.assertEqual(evolver.scratchpad, "Describe the square\nDone")
+      self.assertEqual(evolver.get_extension(), fused_prompt + "\nDescribe the square\nDone" + CHOOSE_FUNCTION_TAIL)
+
+   def test_wrong_arity_call(self):
+      evolver = Prompt_Evolver(State.TOWN_IDLE, fused=True)
+      ok, msg = evolver.process_output('describe_surroundings("a", "b")')
+      self.assertTrue(ok)
+      self.assertIn("falling back", msg)
+      self.assertEqual(evolver.micro_state, Micro_State.CREATE_SCRATCHPAD)
+      self.assertEqual(evolver.get_extension(), evolver.prefixes.scratchpad)
+      evolver = Prompt_Evolver(State.TOWN_IDLE, fused=True)
+      fused_prompt = evolver.get_extension()
+      self.assertTrue(evolver.process_output('Describe the square\ndescribe_surroundings("a", "b")')[0])
+      self.assertEqual(evolver.micro_state, Micro_State.FILL_FUNCTION)
+      self.assertEqual(evolver.scratchpad, "Describe the square")
+      self.assertEqual(evolver.get_extension(), fused_prompt + "\nDescribe the square" + CHOOSE_FUNCTION_TAIL + "\ndescribe_surroundings(")
+
+   def test_injects_comparable(self):
+      names = ["town_talk", "town_idle", "on_the_move"]
+      games = { name: load_game(name) for name in names }
+      summaries = [summarize(asyncio.run(run_jobs(games, inject_jobs(names, fused), 4))) for fused in (False, True)]
+      for name in names:
+         step, fused = summaries[0][name], summaries[1][name]
+         self.assertEqual(step["success_rate"], 1.0, name)
+         self.assertEqual(fused["success_rate"], 1.0, name)
+         self.assertLess(fused["completions"] / fused["runs"], step["completions"] / step["runs"], name)
+
+async def noisy_outputs(prompt:str, grammar:Optional[Grammar]=None) -> str:
+   await asyncio.sleep(0)
+   if prompt.endswith("describe_surroundings("):
+      candidates = ['A quiet square with a fountain)', '"A quiet square with a fountain")']
+   elif prompt.endswith("<calling>"):
+      candidates = ["look_around()", "describe_surroundings()"]
+   else:
+      candidates = ["" if "</calling>" in prompt else "Describe the square"]
+   if grammar is not None:
+      candidates = [c for c in candidates if grammar.matches(c)]
+   return candidates[0]
+
+class Test_Grammar(Fake_LLM_Test_Case):
+
+   def test_fill_function(self):
+      grammar = fill_function_grammar(Function_Map.get(State.TOWN_TALK, "add_quest")[0])
+      self.assertTrue(grammar.matches('"Kill the orcs", "Orc Extermination")'))
+      for output in ['"Kill the orcs")', "Kill the orcs, Orc Extermination)", '"Kill the orcs", "Orc Extermination"', '"Kill\nthe orcs", "Orc Extermination")']:
+         self.assertFalse(grammar.matches(output), output)
+
+   def test_gbnf_matches_regex(self):
+      evolver = Prompt_Evolver(State.TOWN_TALK, fused=True)
+      grammar = evolver.get_grammar()
+      assert grammar is not None
+      pattern = gbnf_to_regex(grammar.gbnf())
+      for output in ['Greet the player\nspeak_npc_to_player("Hello")', "get_player_input()", 'speak_npc_to_player(Hello)', "Greet the player", 'add_quest("a")']:
+         self.assertEqual(re.fullmatch(pattern, output) is not None, grammar.matches(output), output)
+
+   def test_accepts_inject_outputs(self):
+      names = ["town_talk", "town_idle", "on_the_move"]
+      jobs = inject_jobs(names) + [job for job in inject_jobs(names, True) if not job.key.startswith("fallback")]
+      checked = []
+      for job in jobs:
+         async def output_from_prompt(prompt:str, grammar:Optional[Grammar]=None, inner=job.output_from_prompt) -> Optional[str]:
+            output = await inner(prompt)
+            if grammar is not None and output is not None:
+               checked.append(output)
+               self.assertTrue(grammar.matches(output), output)
+            return output
+         job.output_from_prompt = output_from_prompt
+         job.use_grammar = True
+      results = asyncio.run(run_jobs({ name: load_game(name) for name in names }, jobs, 4))
+      self.assertTrue(all(r.ok for r in results))
+      self.assertGreater(len(checked), len(jobs))
+
+   def test_no_syntax_retries(self):
+      game = main.new_game()
+      game.add_event(E.Player_Input_Event("look around"))
+      for use_grammar in (False, True):
+         decision_log: List[Dict] = []
+         new_game = asyncio.run(main.process_game_state_async(game, noisy_outputs, decision_log, use_grammar=use_grammar))
+         errors = summarize_decisions(decision_log, new_game is not None).errors
+         if use_grammar:
+            self.assertIsNotNone(new_game)
+            self.assertEqual(errors, {})
+         else:
+            self.assertIsNone(new_game)
+            self.assertEqual(sum(errors.values()), 3)
+
+   def test_stand_in_server(self):
+      self.handler.candidates = ['A quiet square with a fountain)', '"A quiet square with a fountain")']
+      grammar = fill_function_grammar(Function_Map.get(State.TOWN_IDLE, "describe_surroundings")[0])
+      async def run(grammar_format:Optional[str]):
+         client = Completion_Client(base_url=self.base_url, grammar_format=grammar_format)
+         try:
+            return await client.complete("prompt", grammar=grammar)
+         finally:
+            await client.close()
+      self.assertEqual(asyncio.run(run(None)), 'A quiet square with a fountain)')
+      self.assertEqual(asyncio.run(run("gbnf")),  '"A quiet square with a fountain")')
+      self.assertEqual(asyncio.run(run("regex")), '"A quiet square with a fountain")')
+      self.assertEqual([("grammar" in r, "guided_regex" in r) for r in self.handler.grammars], [(True, False), (False, True)])
+
+class Test_Session_Server(unittest.TestCase):
+
+   def setUp(self):
+      from server import Session_Server
+      self.tmpdir = tempfile.TemporaryDirectory()
+      self.server = Session_Server(self.tmpdir.name, describe_outputs, memory_budget=2**20)
+   def tearDown(self):
+      self.server.close()
+      self.tmpdir.cleanup()
+
+   async def play(self, port:int, session_id:str, inputs:List[str]) -> List[List[str]]:
+      reader, writer = await asyncio.open_connection("127.0.0.1", port)
+      replies = [await read_until_prompt(reader)]
+      writer.write(f"{session_id}\n".encode())
+      replies.append(await read_until_prompt(reader))
+      for text in inputs:
+         writer.write(f"{text}\n".encode())
+         replies.append(await read_until_prompt(reader))
+      writer.write(b"/quit\n")
+      await writer.drain()
+      await reader.read()
+      writer.close()
+      return replies
+
+   def run_server(self, fnx):
+      async def main():
+         server = await self.server.serve("127.0.0.1", 0)
+         port = server.sockets[0].getsockname()[1]
+         async with server:
+            return await fnx(port)
+      return asyncio.run(main())
+
+   def test_turn(self):
+      replies = self.run_server(lambda port: self.play(port, "alice", ["look around"]))
+      self.assertEqual(replies[0], ["session?"])
+      self.assertEqual(replies[1][-2:], ["You arrive at Whisperwind Village", "Response?"])
+      self.assertEqual(replies[2], ["Your Input: look around", "A quiet square with a fountain", "Response?"])
+
+   def test_reply_ends_at_marker(self):
+      replies = self.run_server(lambda port: self.play(port, "alice", ["is anyone here?", "look around"]))
+      self.assertEqual(replies[2], ["Your Input: is anyone here?", "A quiet square with a fountain", "Response?"])
+      self.assertEqual(replies[3], ["Your Input: look around", "A quiet square with a fountain", "Response?"])
+
+   def test_concurrent_sessions(self):
+      async def many(port):
+         return await asyncio.gather(*(self.play(port, f"player-{i}", ["look around", "look again"]) for i in range(5)))
+      for replies in self.run_server(many):
+         self.assertEqual(replies[3], ["Your Input: look again", "A quiet square with a fountain", "Response?"])
+      self.assertEqual(len(self.server.sessions), 5)
+
+   def test_evicted_session_resumes(self):
+      self.server.memory_budget = 0
+      self.run_server(lambda port: self.play(port, "alice", ["look around"]))
+      self.assertEqual(len(self.server.sessions), 0)
+      self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, "alice", "game.jsonl")))
+      replies = self.run_server(lambda port: self.play(port, "alice", []))
+      self.assertEqual(replies[1][-3:], ["Your Input: look around", "A quiet square with a fountain", "Response?"])
+
+   def test_idle_eviction(self):
+      self.run_server(lambda port: self.play(port, "alice", []))
+      self.assertEqual(len(self.server.sessions), 1)
+      self.server.evict(self.server.sessions["alice"].last_used + self.server.idle_seconds + 1.0)
+      self.assertEqual(len(self.server.sessions), 0)
+
+   def test_bad_session_name(self):
+      replies = self.run_server(lambda port: self.play(port, "../etc", []))
+      self.assertIn("invalid session name", replies[1][0])
+
+   def test_turn_error(self):
+      from server import TURN_FAILED_MESSAGE
+      async def failing(prompt:str, **kwargs) -> str:
+         raise RuntimeError("model went away")
+      self.server.output_from_prompt = failing
+      replies = self.run_server(lambda port: self.play(port, "alice", ["look around"]))
+      self.assertEqual(replies[2], ["Your Input: look around", TURN_FAILED_MESSAGE, "Response?"])
+      with open(os.path.join(self.tmpdir.name, "alice", "decision_log.jsonl")) as f:
+         entries = [json.loads(line) for line in f]
+      self.assertEqual(entries[-1]["event"], "ERROR: Unhandled Exception")
+      self.assertIn("model went away", entries[-1]["error"])
+      self.assertEqual(self.server.sessions["alice"].journal.written, len(self.server.sessions["alice"].game.events))
+
+   def test_release_refreshes_lru(self):
+      alice = self.server.acquire("alice")
+      bob = self.server.acquire("bob")
+      self.server.release(bob)
+      self.server.release(alice)
+      self.assertEqual(list(self.server.sessions.keys()), ["bob", "alice"])
+
+   def test_turn_deadline(self):
+      deadlines = []
+      async def outputs(prompt:str, **kwargs) -> str:
+         deadlines.append(kwargs.get("deadline"))
+         return await describe_outputs(prompt)
+      self.server.output_from_prompt = outputs
+      self.server.turn_budget = 30.0
+      replies = self.run_server(lambda port: self.play(port, "alice", ["look around"]))
+      self.assertEqual(replies[2], ["Your Input: look around", "A quiet square with a fountain", "Response?"])
+      self.assertGreater(len(deadlines), 0)
+      self.assertTrue(all(isinstance(d, Deadline) and 0 < d.remaining() <= 30.0 for d in deadlines))
+
+   def test_prompt_budget(self):
+      async def summarize(section:str, previous:str, content:str, **kwargs) -> str:
+         return "summary"
+      self.server.summarize = summarize
+      self.run_server(lambda port: self.play(port, "alice", ["look around"]))
+      session = self.server.sessions["alice"]
+      self.assertIsNotNone(session.prompt_budget)
+      self.assertEqual(session.prompt_budget.path, os.path.join(self.tmpdir.name, "alice", "summaries.jsonl"))
+
+class Test_Completion_Cache(Fake_LLM_Test_Case):
+
+   def setUp(self):
+      super().setUp()
+      self.tmpdir = tempfile.TemporaryDirectory()
+   def tearDown(self):
+      super().tearDown()
+      self.tmpdir.cleanup()
+
+   def complete_all(self, cache:Completion_Cache, prompts:List[str], variant:int=0) -> List[str]:
+      async def main():
+         client = Completion_Client(base_url=self.base_url, cache=cache)
+         try:
+            return [await client.complete(p, variant=variant) for p in prompts]
+         finally:
+            await client.close()
+      return asyncio.run(main())
+
+   def test_record_then_replay(self):
+      self.handler.reply = "first"
+      cache = Completion_Cache(self.tmpdir.name, "record")
+      self.assertEqual(self.complete_all(cache, ["a", "b", "a"]), ["first"] * 3)
+      self.assertEqual(self.handler.requests, 2)
+      self.handler.reply = "second"
+      self.assertEqual(self.complete_all(Completion_Cache(self.tmpdir.name, "replay"), ["a", "b"]), ["first"] * 2)
+      self.assertEqual(self.handler.requests, 2)
+      self.assertEqual(self.complete_all(cache, ["a"], variant=1), ["second"])
+
+   def test_replay_miss_fails(self):
+      with self.assertRaises(Completion_Failed) as ctx:
+         self.complete_all(Completion_Cache(self.tmpdir.name, "replay"), ["never seen"])
+      self.assertIsInstance(ctx.exception.__cause__, Cache_Miss)
+      self.assertEqual(self.handler.requests, 0)
+
+   def test_passthrough(self):
+      cache = Completion_Cache(self.tmpdir.name, "passthrough")
+      self.complete_all(cache, ["a", "a"])
+      self.assertEqual(self.handler.requests, 2)
+      self.assertEqual(cache.total_bytes, 0)
+
+   def test_size_eviction(self):
+      cache = Completion_Cache(self.tmpdir.name, "record", max_bytes=2000)
+      params = { "model":"fake" }
+      for i in range(50):
+         cache.put(f"prompt {i}", params, "x" * 100)
+         os.utime(cache._path(Completion_Cache.key(f"prompt {i}", params)), (i, i))
+      self.assertLessEqual(cache.total_bytes, 2000)
+      self.assertIsNotNone(cache.get("prompt 49", params))
+      self.assertIsNone(cache.get("prompt 0", params))
+
+   def test_import_log(self):
+      json_log = os.path.join(self.tmpdir.name, "prompts.json")
+      with open(json_log, "w") as f:
+         json.dump({"queries": [{"prompt": ["line 1", "line 2"], "response": ["logged <|im_end|>"]}]}, f)
+      client = Completion_Client(base_url=self.base_url)
+      cache = Completion_Cache(os.path.join(self.tmpdir.name, "cache"), "replay")
+      self.assertEqual(cache.import_log(json_log, client.sampling_params()), 1)
+      self.assertEqual(self.complete_all(cache, ["line 1\nline 2"]), ["logged"])
+      self.assertEqual(self.handler.requests, 0)
+
+class Test_Completion_Log(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.TemporaryDirectory()
+      self.path = os.path.join(self.tmpdir.name, "prompts.jsonl")
+   def tearDown(self):
+      self.tmpdir.cleanup()
+
+   def entries(self, count:int) -> List[Dict]:
+      return [{"prompt": [f"prompt {i}", "second line"], "response": [f"response {i}"]} for i in range(count)]
+
+   def test_writes_in_order(self):
+      log = Completion_Log(self.path, batch_size=7)
+      for entry in self.entries(100):
+         self.assertTrue(log.write(entry))
+      log.close()
+      self.assertEqual(list(read_completion_log(self.path)), self.entries(100))
+      self.assertEqual(log.written, 100)
+
+   def test_full_queue_drops_instead_of_blocking(self):
+      log = Completion_Log(self.path, max_queue=2)
+      log.close()
+      results = [log.write(entry) for entry in self.entries(3)]
+      self.assertEqual(results, [True, True, False])
+      self.assertEqual(log.dropped, 1)
+
+   def test_convert_matches_pretty_json(self):
+      for count in (0, 1, 5):
+         path = os.path.join(self.tmpdir.name, f"log_{count}.jsonl")
+         log = Completion_Log(path)
+         for entry in self.entries(count):
+            log.write(entry)
+         log.close()
+         out = os.path.join(self.tmpdir.name, f"log_{count}.json")
+         self.assertEqual(convert(path, out), count)
+         with open(out) as f:
+            self.assertEqual(f.read(), json.dumps({"queries": self.entries(count)}, indent="\t"))
+
+
 # function_pool = [
 #    Function((lambda s,a,b: a+b), "add_text", "", Parameter("first",str), Parameter("second",str)),
 #    Function((lambda s,a,b: a+b), "add_nums", "", Parameter("a",int), Parameter("b",int))